@@ -26,6 +26,16 @@ SNAP_PARENT = [
 
 kinematic_tree = [2, 3, 4, 6, 7, 8, 10, 11, 12, 14, 15, 16, 18, 19, 20]
 
+# kinematic_tree grouped by depth; joints in the same level only depend on the previous one.
+kinematic_levels = [
+	[2, 6, 10, 14, 18],
+	[3, 7, 11, 15, 19],
+	[4, 8, 12, 16, 20],
+]
+
+# joints sharing the root rotation R0
+root_children = [1, 5, 9, 13, 17]
+
 ID2ROT = { # right
 		2: 13, 3: 14, 4: 15,
 		6: 1, 7: 2, 8: 3,
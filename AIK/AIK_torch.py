@@ -23,10 +23,8 @@ def rotation_to_axis_angle(rotation_mat):
 
     # axis_angle = AR.CustomRotation.from_matrix(rotation_mat[0]).as_rotvec().reshape(-1)
 
-    axis_angle = torch.zeros(rotation_mat.shape[0], 48).to(rotation_mat.device)
-
-    for idx in range(rotation_mat.shape[0]):
-        axis_angle[idx] = AR.CustomRotation.from_matrix(rotation_mat[idx]).as_rotvec().reshape(-1)
+    num_b = rotation_mat.shape[0]
+    axis_angle = AR.CustomRotation.from_matrix(rotation_mat.reshape(-1, 3, 3)).as_rotvec().reshape(num_b, -1)
 
     return axis_angle
 
@@ -80,110 +78,109 @@ def axangle2mat(axis, angle, is_normalized=False):
     return torch.stack([x*xC+c,   xyC-zs,   zxC+ys,xyC+zs,   y*yC+c,   yzC-xs, zxC-ys,   yzC+xs,   z*zC+c ], dim = 0).reshape(3,3)
 
 
+def batch_axangle2mat(axis, angle):
+    '''
+    Batch version of "axangle2mat".
+    :param axis: N*3, not normalized.
+    :param angle: N
+    :return: N*3*3 rotation matrices.
+    '''
+    axis = axis / torch.norm(axis, dim=-1, keepdim=True)
+    x, y, z = axis.unbind(-1)
+
+    c = torch.cos(angle); s = torch.sin(angle); C = 1-c
+    xs = x*s;   ys = y*s;   zs = z*s
+    xC = x*C;   yC = y*C;   zC = z*C
+    xyC = x*yC; yzC = y*zC; zxC = z*xC
+
+    return torch.stack([x*xC+c,   xyC-zs,   zxC+ys,xyC+zs,   y*yC+c,   yzC-xs, zxC-ys,   yzC+xs,   z*zC+c ], dim=-1).reshape(-1,3,3)
+
+
+# array-based kinematic tree
+_PARENT = torch.tensor(cfg.SNAP_PARENT)
+_LEVELS = [torch.tensor(level) for level in cfg.kinematic_levels]
+_ROOT_CHILDREN = torch.tensor(cfg.root_children)
+_ROT_JOINT = torch.tensor(list(cfg.ID2ROT.keys()))
+_ROT_SLOT = torch.tensor(list(cfg.ID2ROT.values()))
+
+
 def adaptive_IK(T_, P_):
     '''
     Computes pose parameters given template and predictions.
     We think the twist of hand bone could be omitted.
+    All samples, and all joints of the same kinematic level, are solved together.
     :param T: template, 21*3
-    :param P: target, 21*3
-    :return: pose params.
+    :param P: target, B*21*3
+    :return: pose params, B*48
     '''
+    device = P_.device
+    T = T_.to(device=device, dtype=torch.float32)
+    P = P_.to(torch.float32)
+    B = P.shape[0]
 
-    gt_rotatiation = np.array([])
-    
-    for _, idx in enumerate(range(P_.shape[0])):
-                
-        T = T_.clone().to(torch.float32)
-        P = P_[idx].clone().to(torch.float32)
-        
-        T = T.transpose(1, 0)
-        P = P.transpose(1, 0)
-        
-        # to dict
-        P = to_dict_new(P)
-        T = to_dict_new(T)
-        
-        # some globals
-        R = {}
-        R_pa_k = {}
-        q = {}
+    # compute R0, here we think R0 is not only a Orthogonal matrix, but also a Rotation matrix.
+    # you can refer to paper "Least-Squares Fitting of Two 3-D Point Sets. K. S. Arun; T. S. Huang; S. D. Blostein"
+    # It is slightly different from  https://github.com/Jeff-sjtu/HybrIK/blob/main/hybrik/utils/pose_utils.py#L4, in which R0 is regard as orthogonal matrix only.
+    # Using their method might further boost accuracy.
+    root_children = _ROOT_CHILDREN.to(device)
+    P_0 = (P[:, root_children] - P[:, :1]).transpose(1, 2)  # B*3*5
+    T_0 = (T[root_children] - T[:1]).transpose(0, 1)        # 3*5
 
-        q[0] = T[0]  # in fact, q[0] = P[0] = T[0].
+    H = torch.matmul(T_0, P_0.transpose(1, 2))
 
-        # compute R0, here we think R0 is not only a Orthogonal matrix, but also a Rotation matrix.
-        # you can refer to paper "Least-Squares Fitting of Two 3-D Point Sets. K. S. Arun; T. S. Huang; S. D. Blostein"
-        # It is slightly different from  https://github.com/Jeff-sjtu/HybrIK/blob/main/hybrik/utils/pose_utils.py#L4, in which R0 is regard as orthogonal matrix only.
-        # Using their method might further boost accuracy.
-        
-        P_0 = torch.cat([P[1] - P[0], P[5] - P[0],
-                            P[9] - P[0], P[13] - P[0],
-                            P[17] - P[0]], axis=-1)
-        
-        T_0 = torch.cat([T[1] - T[0], T[5] - T[0],
-                            T[9] - T[0], T[13] - T[0],
-                            T[17] - T[0]], axis=-1)
-        
-        H = torch.matmul(T_0, P_0.T)
-
-        U, S, V = torch.svd(H)
+    U, S, V = torch.svd(H)
 
-        R0 = torch.matmul(V, U.T)
+    R0 = torch.matmul(V, U.transpose(1, 2))
 
-        det0 = torch.det(R0)
+    det0 = torch.det(R0)
+    flip = (torch.abs(det0 + 1) < 1e-6) & (torch.abs(S) < 1e-4).any(dim=-1)
+    if flip.any():
+        V_ = V.clone()
+        V_[flip, :, 2] = -V_[flip, :, 2]
+        R0 = torch.where(flip[:, None, None], torch.matmul(V_, U.transpose(1, 2)), R0)
 
-        if abs(det0 + 1) < 1e-6:
-            V_ = V.clone()
+    # some globals
+    R = torch.zeros((B, 21, 3, 3), device=device)
+    R_pa_k = torch.zeros((B, 21, 3, 3), device=device)
+    q = torch.zeros((B, 21, 3), device=device)
 
-            if (abs(S) < 1e-4).sum():
-                V_[:, 2] = -V_[:, 2]
-                R0 = torch.matmul(V_, U.T)
+    q[:, 0] = T[0]  # in fact, q[0] = P[0] = T[0].
+    R[:, 0] = R0
 
-        R[0] = R0
+    # the bone from 1,5,9,13,17 to 0 has same rotations
+    R[:, root_children] = R0[:, None]
 
-        # the bone from 1,5,9,13,17 to 0 has same rotations
-        R[1] = R[0].clone()
-        R[5] = R[0].clone()
-        R[9] = R[0].clone()
-        R[13] = R[0].clone()
-        R[17] = R[0].clone()
+    # compute rotation along kinematics, one tree level at a time
+    parent = _PARENT.to(device)
+    for level in _LEVELS:
+        k = level.to(device)
+        pa = parent[k]
+        pa_pa = parent[pa]
+        n = k.shape[0]
 
-        # compute rotation along kinematics
-        for k in cfg.kinematic_tree:
-            pa = cfg.SNAP_PARENT[k]
-            pa_pa = cfg.SNAP_PARENT[pa]
-            q[pa] = torch.matmul(R[pa], (T[pa] - T[pa_pa])) + q[pa_pa]
-            delta_p_k = torch.matmul(torch.inverse(R[pa]), P[k] - q[pa])
-            delta_p_k = delta_p_k.reshape((3,))
+        R_pa = R[:, pa]
+        q[:, pa] = torch.matmul(R_pa, (T[pa] - T[pa_pa])[None, ..., None])[..., 0] + q[:, pa_pa]
+        delta_p_k = torch.matmul(torch.inverse(R_pa), (P[:, k] - q[:, pa])[..., None])[..., 0]
 
-            delta_t_k = T[k] - T[pa]
-            delta_t_k = delta_t_k.reshape((3,))
-            
-            temp_axis = torch.cross(delta_t_k, delta_p_k)
-            axis = temp_axis / (temp_axis.pow(2).sum().pow(1/2) + 1e-8 )
-            temp = (torch.norm(delta_t_k,dim=0) + 1e-8) * (torch.norm(delta_p_k,dim=0) + 1e-8)
-            cos_alpha = torch.dot(delta_t_k, delta_p_k) / temp
+        delta_t_k = (T[k] - T[pa])[None].expand(B, n, 3)
 
-            alpha = torch.acos(cos_alpha)
+        temp_axis = torch.cross(delta_t_k, delta_p_k, dim=-1)
+        axis = temp_axis / (temp_axis.pow(2).sum(-1, keepdim=True).pow(1/2) + 1e-8 )
+        temp = (torch.norm(delta_t_k,dim=-1) + 1e-8) * (torch.norm(delta_p_k,dim=-1) + 1e-8)
+        cos_alpha = (delta_t_k * delta_p_k).sum(-1) / temp
 
-            twist = delta_t_k
-            D_sw = axangle2mat(axis=axis, angle=alpha, is_normalized=False)
-            D_tw = axangle2mat(axis=twist, angle=angels0[:, k], is_normalized=False)
+        alpha = torch.acos(cos_alpha)
 
-            R_pa_k[k] = torch.matmul(D_sw, D_tw)
-            R[k] = torch.matmul(R[pa], R_pa_k[k]).to(torch.float32)
-
-        pose_R = torch.zeros((1, 16, 3, 3)).to(T_.device)
-        pose_R[0, 0] = R[0]
-        for key in cfg.ID2ROT.keys():
-            value = cfg.ID2ROT[key]
-            pose_R[0, value] = R_pa_k[key]
-        
-        pose_R = rotation_to_axis_angle(pose_R)
+        twist = delta_t_k
+        twist_angle = torch.as_tensor(angels0[0], dtype=torch.float32, device=device)[k].expand(B, n)
+        D_sw = batch_axangle2mat(axis=axis.reshape(-1, 3), angle=alpha.reshape(-1))
+        D_tw = batch_axangle2mat(axis=twist.reshape(-1, 3), angle=twist_angle.reshape(-1))
 
-        if idx == 0:
-            gt_rotatiation = pose_R.reshape(1,-1)
-        else:
-            gt_rotatiation = torch.cat([gt_rotatiation, pose_R.reshape(1,-1)],dim=0)
+        R_pa_k[:, k] = torch.matmul(D_sw, D_tw).reshape(B, n, 3, 3)
+        R[:, k] = torch.matmul(R_pa, R_pa_k[:, k])
 
-    return gt_rotatiation
+    pose_R = torch.zeros((B, 16, 3, 3), device=device)
+    pose_R[:, 0] = R0
+    pose_R[:, _ROT_SLOT.to(device)] = R_pa_k[:, _ROT_JOINT.to(device)]
 
+    return rotation_to_axis_angle(pose_R)
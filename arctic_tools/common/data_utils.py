@@ -281,9 +281,9 @@ def denormalize_images(images):
     return images
 
 
-def read_img(img_fn, dummy_shape):
+def read_img(img_fn, dummy_shape, cache=None):
     try:
-        cv_img = _read_img(img_fn)
+        cv_img = _read_img(img_fn, cache)
     except:
         logger.warning(f"Unable to load {img_fn}")
         cv_img = np.zeros(dummy_shape, dtype=np.float32)
@@ -291,8 +291,13 @@ def read_img(img_fn, dummy_shape):
     return cv_img, True
 
 
-def _read_img(img_fn):
-    img = cv2.cvtColor(cv2.imread(img_fn), cv2.COLOR_BGR2RGB)
+def _read_img(img_fn, cache=None):
+    if cache is not None:
+        # decoded straight from the shared-memory cache (util/shm_cache.py)
+        img = cache.load(img_fn, lambda buf: cv2.imdecode(buf, cv2.IMREAD_COLOR))
+    else:
+        img = cv2.imread(img_fn)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     return img.astype(np.float32)
 
 
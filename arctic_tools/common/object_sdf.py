@@ -0,0 +1,76 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from common.rot import axis_angle_to_quaternion, quaternion_apply, quaternion_invert
+
+# top: 1, bottom: 2 as "parts_ids" of ObjectTensors
+PARTS = [1, 2]
+
+
+class ObjectSDF(nn.Module):
+    """
+    Signed-distance grids of the object parts in canonical space, built offline by tools/build_object_sdf.py.
+    Distances are in meters and negative inside the object.
+    """
+
+    def __init__(self, sdf_p):
+        super(ObjectSDF, self).__init__()
+        data = torch.load(sdf_p, map_location="cpu")
+        self.rows = {}
+        grids, bbox_min, bbox_max = [], [], []
+        for name, parts in data.items():
+            for part in PARTS:
+                self.rows[(name, part)] = len(grids)
+                grids.append(parts[part]["sdf"].float())
+                bbox_min.append(parts[part]["bbox_min"].float())
+                bbox_max.append(parts[part]["bbox_max"].float())
+        # (P, 1, D, H, W), indexed by (z, y, x) as grid_sample expects
+        self.register_buffer("grids", torch.stack(grids, dim=0)[:, None])
+        self.register_buffer("bbox_min", torch.stack(bbox_min, dim=0))
+        self.register_buffer("bbox_max", torch.stack(bbox_max, dim=0))
+
+    def forward(self, points, query_names, radian, rot, transl):
+        """
+        Signed distance of points to the posed objects (same pose as "ObjectTensors.forward").
+        Differentiable w.r.t. the points and the object pose.
+        :param points: (B, N, 3)
+        :param radian: (B, 1) articulation angle
+        :param rot: (B, 3) global orientation (axis-angle)
+        :param transl: (B, 3)
+        :return: (B, N), the minimum over the parts
+        """
+        z_axis = torch.tensor([0.0, 0.0, -1.0], device=points.device, dtype=points.dtype)
+        quat_arti = axis_angle_to_quaternion(z_axis[None, :] * radian.view(-1, 1))
+        quat_global = axis_angle_to_quaternion(rot.view(-1, 3))
+
+        # camera coord -> frame of the bottom part -> frame of the top part
+        bottom = quaternion_apply(quaternion_invert(quat_global)[:, None, :], points - transl.view(-1, 1, 3))
+        top = quaternion_apply(quaternion_invert(quat_arti)[:, None, :], bottom)
+        cano = {1: top, 2: bottom}
+
+        B, N = points.shape[:2]
+        sdf = points.new_full((B, N), float("inf"))
+        for name in set(query_names):
+            batch_idx = [b for b, query in enumerate(query_names) if query == name]
+            batch_idx = torch.tensor(batch_idx, device=points.device)
+            for part in PARTS:
+                row = self.rows[(name, part)]
+                lo, hi = self.bbox_min[row], self.bbox_max[row]
+                part_points = cano[part][batch_idx].reshape(-1, 3)
+
+                # trilinear lookup; all the samples of an object share the grid
+                coords = 2 * (part_points - lo) / (hi - lo) - 1
+                values = F.grid_sample(
+                    self.grids[row : row + 1],
+                    coords.view(1, -1, 1, 1, 3),
+                    mode="bilinear",
+                    padding_mode="border",
+                    align_corners=True,
+                ).view(-1)
+
+                # the grid is clamped at its border, add the distance to it for points outside
+                outside = (part_points - torch.max(torch.min(part_points, hi), lo)).norm(dim=-1)
+                values = (values + outside).view(len(batch_idx), N)
+                sdf[batch_idx] = torch.min(sdf[batch_idx], values)
+        return sdf
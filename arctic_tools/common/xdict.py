@@ -1,3 +1,5 @@
+from operator import contains
+
 import numpy as np
 import torch
 
@@ -23,29 +25,153 @@ def _print_stat(key, thing):
         print("{:<20}: {:}".format(key, mytype))
 
 
+def _namespace(key):
+    """
+    Top-level namespace of a key, e.g. "pred." for "pred.mano.j3d.cam.r"; None for a key without a dot.
+    """
+    pos = key.find(".") if isinstance(key, str) else -1
+    return key[: pos + 1] if pos >= 0 else None
+
+
+def _group_tensors(values, moved):
+    """
+    Indices of the tensors in values, grouped by (device, dtype), for which moved(tensor) is True.
+    """
+    groups = {}
+    for idx, v in enumerate(values):
+        if isinstance(v, torch.Tensor) and moved(v):
+            groups.setdefault((v.device, v.dtype), []).append(idx)
+    return groups
+
+
+def _flat_cat(tensors):
+    """
+    Concatenates the flattened tensors, returns the buffer and the shapes and sizes to split it again.
+    """
+    shapes = [t.shape for t in tensors]
+    sizes = [t.numel() for t in tensors]
+    return torch.cat([t.reshape(-1) for t in tensors]), shapes, sizes
+
+
 class xdict(dict):
     """
     A subclass of Python's built-in dict class, which provides additional methods for manipulating and operating on dictionaries.
+
+    Keys are grouped by their top-level namespace ("pred.", "targets.", "meta_info.", ...). The groups and the
+    results of key searches are indexed on the first search and then kept up to date as keys are added or
+    removed, so search() calls between insertions only touch the keys of the matching group.
     """
 
+    # {"ns": {namespace: [keys]}, "count": {namespace: occurrences in all keys}, "search": {keyword: [keys]}},
+    # built on demand; None until then
+    _index = None
+
     def __init__(self, mydict=None):
         """
         Constructor for the xdict class. Creates a new xdict object and optionally initializes it with key-value pairs from the provided dictionary mydict. If mydict is not provided, an empty xdict is created.
         """
+        self._index = None
         if mydict is None:
             return
+        dict.update(self, mydict)
+
+    @classmethod
+    def _from_keys(cls, keys, values):
+        """
+        Builds an xdict from parallel sequences of keys and values without going through __setitem__.
+        """
+        out = cls()
+        dict.update(out, zip(keys, values))
+        return out
 
-        for k, v in mydict.items():
-            super().__setitem__(k, v)
+    def __reduce__(self):
+        # pickle and deepcopy only the items, the index is rebuilt on demand
+        return (self.__class__, (dict(self),))
+
+    def _touch(self):
+        self._index = None
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = {"ns": {}, "count": {}, "search": {}}
+            for k in self.keys():
+                self._index_add(k)
+        return self._index
+
+    def _index_add(self, key):
+        """
+        Adds a key, already inserted in the dict, to the index.
+        """
+        index = self._index
+        if index is None:
+            return
+        groups, count = index["ns"], index["count"]
+        if isinstance(key, str):
+            ns = _namespace(key)
+            if ns is not None and ns not in groups:
+                # once per namespace: its occurrences in the other keys
+                groups[ns] = []
+                count[ns] = sum(k.count(ns) for k in self.keys() if isinstance(k, str) and k != key)
+            if ns is not None:
+                groups[ns].append(key)
+            for n in count:
+                count[n] += key.count(n)
+        for keyword, keys in index["search"].items():
+            if contains(key, keyword):
+                keys.append(key)
+
+    def _index_remove(self, key):
+        """
+        Removes a key, already deleted from the dict, from the index.
+        """
+        index = self._index
+        if index is None:
+            return
+        groups, count = index["ns"], index["count"]
+        if isinstance(key, str):
+            for n in count:
+                count[n] -= key.count(n)
+            ns = _namespace(key)
+            if ns is not None:
+                groups[ns].remove(key)
+                if len(groups[ns]) == 0:
+                    del groups[ns]
+                    del count[ns]
+        for keys in index["search"].values():
+            if key in keys:
+                keys.remove(key)
+
+    def _search_keys(self, keyword):
+        """
+        Keys containing keyword, in insertion order. A namespace keyword such as "pred." is answered from its group
+        when it does not occur anywhere else in the keys.
+        """
+        index = self._get_index()
+        cache = index["search"]
+        if keyword in cache:
+            return cache[keyword]
+
+        group = index["ns"].get(keyword) if isinstance(keyword, str) else None
+        if group is not None and _namespace(keyword) == keyword and index["count"][keyword] == len(group):
+            # every occurrence of the keyword is the leading one of a group key
+            keys = list(group)
+        else:
+            keys = list(filter(lambda k: contains(k, keyword), self.keys()))
+        cache[keyword] = keys
+        return keys
+
+    def namespaces(self):
+        """
+        Returns the top-level namespaces of the keys (e.g. ["pred.", "targets.", "meta_info."]).
+        """
+        return list(self._get_index()["ns"].keys())
 
     def subset(self, keys):
         """
         Returns a new xdict object containing only the key-value pairs with keys in the provided list 'keys'.
         """
-        out_dict = {}
-        for k in keys:
-            out_dict[k] = self[k]
-        return xdict(out_dict)
+        keys = list(keys)
+        return xdict._from_keys(keys, map(self.__getitem__, keys))
 
     def __setitem__(self, key, val):
         """
@@ -53,38 +179,79 @@ class xdict(dict):
         """
         assert key not in self.keys(), f"Key already exists {key}"
         super().__setitem__(key, val)
+        self._index_add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._index_remove(key)
+
+    def pop(self, key, *args):
+        found = key in self
+        out = super().pop(key, *args)
+        if found:
+            self._index_remove(key)
+        return out
+
+    def popitem(self):
+        key, val = super().popitem()
+        self._index_remove(key)
+        return key, val
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        super().__setitem__(key, default)
+        self._index_add(key)
+        return default
+
+    def clear(self):
+        self._index = None
+        super().clear()
+
+    def update(self, *args, **kwargs):
+        if self._index is None:
+            super().update(*args, **kwargs)
+            return
+        other = dict(*args, **kwargs)
+        new_keys = [k for k in other.keys() if k not in self]
+        super().update(other)
+        for k in new_keys:
+            self._index_add(k)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
 
     def search(self, keyword, replace_to=None):
         """
         Returns a new xdict object containing only the key-value pairs with keys that contain the provided keyword.
         """
-        out_dict = {}
-        for k in self.keys():
-            if keyword in k:
-                if replace_to is None:
-                    out_dict[k] = self[k]
-                else:
-                    out_dict[k.replace(keyword, replace_to)] = self[k]
-        return xdict(out_dict)
+        keys = self._search_keys(keyword)
+        values = map(self.__getitem__, keys)
+        if replace_to is None:
+            return xdict._from_keys(keys, values)
+        return xdict._from_keys([k.replace(keyword, replace_to) for k in keys], values)
 
     def rm(self, keyword, keep_list=[], verbose=False):
         """
         Returns a new xdict object with keys that contain keyword removed. Keys in keep_list are excluded from the removal.
         """
-        out_dict = {}
-        for k in self.keys():
-            if keyword not in k or k in keep_list:
-                out_dict[k] = self[k]
-            else:
-                if verbose:
+        removed = set(self._search_keys(keyword)).difference(keep_list)
+        if verbose:
+            for k in self.keys():
+                if k in removed:
                     print(f"Removing: {k}")
-        return xdict(out_dict)
+        keys = [k for k in self.keys() if k not in removed]
+        return xdict._from_keys(keys, map(self.__getitem__, keys))
 
     def overwrite(self, k, v):
         """
         The original assignment operation of Python dict
         """
+        found = k in self
         super().__setitem__(k, v)
+        if not found:
+            self._index_add(k)
 
     def merge(self, dict2):
         """
@@ -134,10 +301,7 @@ class xdict(dict):
         Returns:
             xdict: The xdict instance with the added prefix.
         """
-        out_dict = {}
-        for k in self.keys():
-            out_dict[text + k] = self[k]
-        return xdict(out_dict)
+        return xdict._from_keys([text + k for k in self.keys()], self.values())
 
     def replace_keys(self, str_src, str_tar):
         """
@@ -150,12 +314,7 @@ class xdict(dict):
         Returns:
             xdict: The xdict instance with the replaced keys.
         """
-        out_dict = {}
-        for k in self.keys():
-            old_key = k
-            new_key = old_key.replace(str_src, str_tar)
-            out_dict[new_key] = self[k]
-        return xdict(out_dict)
+        return xdict._from_keys([k.replace(str_src, str_tar) for k in self.keys()], self.values())
 
     def postfix(self, text):
         """
@@ -167,10 +326,7 @@ class xdict(dict):
         Returns:
             xdict: The xdict instance with the added postfix.
         """
-        out_dict = {}
-        for k in self.keys():
-            out_dict[k + text] = self[k]
-        return xdict(out_dict)
+        return xdict._from_keys([k + text for k in self.keys()], self.values())
 
     def sorted_keys(self):
         """
@@ -184,6 +340,7 @@ class xdict(dict):
     def to(self, dev):
         """
         Moves the xdict instance to a specific device.
+        Tensors of the same device and dtype are moved together with a single copy and split into views again.
 
         Args:
             dev (torch.device): The device to move the instance to.
@@ -193,8 +350,28 @@ class xdict(dict):
         """
         if dev is None:
             return self
-        raw_dict = dict(self)
-        return xdict(thing.thing2dev(raw_dict, dev))
+        try:
+            target = torch.device(dev)
+        except (TypeError, RuntimeError):
+            # not a device (e.g. a dtype)
+            return xdict(thing.thing2dev(dict(self), dev))
+        if target.type == "cuda" and target.index is None and torch.cuda.is_available():
+            target = torch.device("cuda", torch.cuda.current_device())
+
+        values = list(self.values())
+        out = [None] * len(values)
+        groups = _group_tensors(values, lambda v: v.device != target)
+        for indices in groups.values():
+            if len(indices) == 1:
+                continue
+            flat, shapes, sizes = _flat_cat([values[idx] for idx in indices])
+            chunks = flat.to(target).split(sizes)
+            for idx, chunk, shape in zip(indices, chunks, shapes):
+                out[idx] = chunk.view(shape)
+        for idx, v in enumerate(values):
+            if out[idx] is None:
+                out[idx] = thing.thing2dev(v, dev)
+        return xdict._from_keys(list(self.keys()), out)
 
     def to_torch(self):
         """
@@ -212,7 +389,19 @@ class xdict(dict):
         Returns:
         xdict: A new xdict with numpy arrays as values.
         """
-        return xdict(thing.thing2np(self))
+        values = list(self.values())
+        out = [None] * len(values)
+        # tensors that are not on the CPU are copied with one transfer per (device, dtype)
+        groups = _group_tensors(values, lambda v: v.device.type != "cpu")
+        for indices in groups.values():
+            flat, shapes, sizes = _flat_cat([values[idx].detach() for idx in indices])
+            chunks = np.split(flat.cpu().numpy(), np.cumsum(sizes)[:-1])
+            for idx, chunk, shape in zip(indices, chunks, shapes):
+                out[idx] = chunk.reshape(shape)
+        for idx, v in enumerate(values):
+            if out[idx] is None:
+                out[idx] = thing.thing2np(v)
+        return xdict._from_keys(list(self.keys()), out)
 
     def tolist(self):
         """
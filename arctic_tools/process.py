@@ -6,6 +6,7 @@ from arctic_tools.common.body_models import MANODecimator, build_mano_aa
 from arctic_tools.src.callbacks.process.process_arctic import process_data
 
 import arctic_tools.src.utils.interfield as inter
+from arctic_tools.src.utils.interfield import ObjectPartIndex
 import arctic_tools.common.data_utils as data_utils
 from arctic_tools.common.xdict import xdict
 from pytorch3d.transforms import matrix_to_axis_angle
@@ -14,7 +15,7 @@ import arctic_tools.common.ld_utils as ld_utils
 from arctic_tools.src.nets.obj_heads.obj_head import ArtiHead
 from arctic_tools.src.nets.hand_heads.mano_head import MANOHead
 from arctic_tools.common.body_models import build_layers
-from arctic_tools.src.utils.eval_modules import eval_fn_dict
+from arctic_tools.src.utils.eval_modules import eval_fn_dict, required_fields
 from arctic_tools.src.utils.loss_modules import get_NN
 
 def get_arctic_item(outputs, cfg, device='cuda'):
@@ -69,12 +70,36 @@ def get_arctic_item(outputs, cfg, device='cuda'):
 
     return [root_l, root_r, root_o], [mano_pose_l, mano_pose_r], [mano_shape_l, mano_shape_r], [obj_rot, obj_rad]
 
+# MANO/object layers are built once per (device, focal_length, img_res).
+_pre_process_models = {}
+_output_heads = {}
+
+def get_pre_process_models(args):
+    key = (str(args.device), args.focal_length, args.img_res)
+    if key not in _pre_process_models:
+        _pre_process_models[key] = {
+            "mano_r": build_mano_aa(is_rhand=True).to(args.device),
+            "mano_l": build_mano_aa(is_rhand=False).to(args.device),
+            "arti_head": ArtiHead(focal_length=args.focal_length, img_res=args.img_res, device=args.device).to(args.device)
+        }
+        if getattr(args, 'interfield_index', False):
+            _pre_process_models[key]["obj_index"] = ObjectPartIndex(
+                _pre_process_models[key]["arti_head"].object_tensors.obj_tensors
+            )
+    return _pre_process_models[key]
+
+def get_output_heads(args):
+    key = (str(args.device), args.focal_length, args.img_res)
+    if key not in _output_heads:
+        _output_heads[key] = (
+            MANOHead(is_rhand=True, focal_length=args.focal_length, img_res=args.img_res).to(args.device),
+            MANOHead(is_rhand=False, focal_length=args.focal_length, img_res=args.img_res).to(args.device),
+            ArtiHead(focal_length=args.focal_length, img_res=args.img_res, device=args.device),
+        )
+    return _output_heads[key]
+
 def arctic_pre_process(args, targets, meta_info):
-    pre_process_models = {
-        "mano_r": build_mano_aa(is_rhand=True).to(args.device),
-        "mano_l": build_mano_aa(is_rhand=False).to(args.device),
-        "arti_head": ArtiHead(focal_length=args.focal_length, img_res=args.img_res, device=args.device).to(args.device)
-    }
+    pre_process_models = get_pre_process_models(args)
     with torch.no_grad():
         inputs, targets, meta_info = process_data(
             pre_process_models, None, targets, meta_info, 'extract', args
@@ -106,9 +131,7 @@ def post_process_arctic_output(outputs, meta_info, args, cfg):
 
 def make_output(args, root, mano_pose, mano_shape, obj_angle, query_names, K):
     # model settings
-    mano_r_head = MANOHead(is_rhand=True, focal_length=args.focal_length, img_res=args.img_res).to(args.device)
-    mano_l_head = MANOHead(is_rhand=False, focal_length=args.focal_length, img_res=args.img_res).to(args.device)
-    arti_head = ArtiHead(focal_length=args.focal_length, img_res=args.img_res, device=args.device)
+    mano_r_head, mano_l_head, arti_head = get_output_heads(args)
 
     root_l, root_r, root_o = root
     mano_pose_l, mano_pose_r = mano_pose
@@ -246,9 +269,52 @@ def prepare_interfield(targets, max_dist):
     targets["idx.ol"] = dist_ol_idx
     return targets
 
-def prepare_data(args, outputs, targets, meta_info, cfg, pred=None, flag='eval'):
+def _select(data, fields):
+    if fields is None:
+        return data
+    return data.subset([key for key in data.keys() if key in fields])
+
+
+def prepare_targets(args, targets, meta_info, keys, flag='eval', fields=None):
+    '''
+    Ground-truth part of "prepare_data". It only depends on the batch and the prediction keys,
+    so it can be shared by the predictions of several models on the same batch.
+    :param keys: keys of the post-processed prediction.
+    :param fields: keys of the output that are used (see "required_fields"). None keeps all of them.
+    :return: xdict with "targets." and "meta_info." prefixes.
+    '''
     targets = xdict(targets)
     meta_info = xdict(meta_info)
+    for key in keys:
+        # denormalize 2d keypoints
+        if "2d.norm" in key:
+            denorm_key = key.replace(".norm", "")
+            if fields is not None and "targets." + denorm_key not in fields:
+                continue
+            assert key in targets.keys(), f"Do not have key {key}"
+            targets[denorm_key] = data_utils.unormalize_kp2d(targets[key], args.img_res)
+
+    gt = xdict()
+    gt.merge(targets.prefix("targets."))
+    gt.merge(meta_info.prefix("meta_info."))
+    # only the used keys are copied to the host
+    gt = _select(gt, fields)
+    if flag=='eval':
+        gt = gt.to("cpu")
+    return gt
+
+
+def prepare_data(args, outputs, targets, meta_info, cfg, pred=None, flag='eval', gt=None, fields=None):
+    '''
+    :param gt: output of "prepare_targets" for this batch. If None, it is computed here.
+    :param fields: keys of the output that are used, e.g. required_fields(args.eval_metrics).
+        Derived quantities that are not requested are not computed and only these keys are copied to the host.
+        None computes and keeps everything.
+    '''
+    meta_info = xdict(meta_info)
+
+    def needed(key):
+        return fields is None or f"pred.{key}" in fields
 
     if pred is None:
         assert outputs is not None
@@ -258,26 +324,17 @@ def prepare_data(args, outputs, targets, meta_info, cfg, pred=None, flag='eval')
         # denormalize 2d keypoints
         if "2d.norm" in key:
             denorm_key = key.replace(".norm", "")
-            assert key in targets.keys(), f"Do not have key {key}"
-
-            val_pred = pred[key]
-            val_gt = targets[key]
-
-            val_denorm_pred = data_utils.unormalize_kp2d(
-                val_pred, args.img_res
-            )
-            val_denorm_gt = data_utils.unormalize_kp2d(val_gt, args.img_res)
-
-            pred[denorm_key] = val_denorm_pred
-            targets[denorm_key] = val_denorm_gt
+            if needed(denorm_key):
+                pred[denorm_key] = data_utils.unormalize_kp2d(pred[key], args.img_res)
+    if gt is None:
+        gt = prepare_targets(args, targets, meta_info, keys, flag=flag, fields=fields)
     
     # layers = build_layers(args.device)
-    pred.overwrite(
-        "mano.pose.r", matrix_to_axis_angle(pred["mano.pose.r"])
-    )
-    pred.overwrite(
-        "mano.pose.l", matrix_to_axis_angle(pred["mano.pose.l"])
-    )
+    for side in ["r", "l"]:
+        if needed(f"mano.pose.{side}"):
+            pred.overwrite(
+                f"mano.pose.{side}", matrix_to_axis_angle(pred[f"mano.pose.{side}"])
+            )
 
     # fk_params_batch
     # targets = fk_params_batch(xdict(targets), layers, meta_info, args.device)
@@ -286,18 +343,33 @@ def prepare_data(args, outputs, targets, meta_info, cfg, pred=None, flag='eval')
     # meta_info.overwrite("diameter", targets["object.diameter"])
     # targets = prepare_interfield(targets, max_dist=0.1)
 
-    pred['nn_dist_r'], pred['nn_idx_r'] = get_NN(pred["object.v.cam"], pred["mano.v3d.cam.r"])
-    pred['nn_dist_l'], pred['nn_idx_l'] = get_NN(pred["object.v.cam"], pred["mano.v3d.cam.l"])
+    # hand-object correspondences of the penetration loss
+    for side in ["r", "l"]:
+        if needed(f"nn_dist_{side}") or needed(f"nn_idx_{side}"):
+            pred[f'nn_dist_{side}'], pred[f'nn_idx_{side}'] = get_NN(pred["object.v.cam"], pred[f"mano.v3d.cam.{side}"])
 
     data = xdict()
     data.merge(pred.prefix("pred."))
-    data.merge(targets.prefix("targets."))
-    data.merge(meta_info.prefix("meta_info."))
+    data = _select(data, fields)
     if flag=='eval':
         data = data.to("cpu")
+    data.merge(gt)
 
     return data
 
+def get_eval_fields(args, vis=False):
+    '''
+    Keys of "prepare_data" used to evaluate a batch with "args.eval_metrics". The smoothing of the
+    evaluation loop ("--iter") also reads the predicted meshes. None (everything) for the visualization.
+    '''
+    if vis:
+        return None
+    extra = []
+    if getattr(args, 'iter', 0) > 0:
+        extra = ["pred.object.v.cam", "pred.mano.v3d.cam.r", "pred.mano.v3d.cam.l"]
+    return required_fields(args.eval_metrics, extra)
+
+
 def measure_error(data, metrics):
     pred = data.search("pred.", replace_to="")
     targets = data.search("targets.", replace_to="")
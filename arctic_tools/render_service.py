@@ -0,0 +1,257 @@
+import os
+import os.path as op
+import sys
+import atexit
+import multiprocessing as mp
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+"""
+Headless, batch-oriented rendering of ARCTIC predictions.
+
+Meshes of a whole batch (or sequence) are handed to a pool of worker processes,
+each of which keeps its own offscreen renderer, cached MANO/object faces, and
+writes frames (and optionally a video) to disk. The caller only pays for
+copying the vertices to host memory.
+"""
+
+# setup camera (same as arctic_tools.visualizer)
+FOCAL = 1000.0
+ROWS = 224
+COLS = 224
+
+
+# ------------------------------------------------------------------------
+# worker side
+# ------------------------------------------------------------------------
+
+_renderer = None
+
+
+def _init_worker(parent_sys_path):
+    # `common.*` is resolved through ./arctic_tools, which main.py prepends at runtime.
+    sys.path = list(parent_sys_path)
+
+
+def _get_renderer(img_res):
+    global _renderer
+    if _renderer is None or _renderer.img_res != img_res:
+        from common.rend_utils import Renderer
+        _renderer = Renderer(img_res=img_res)
+    return _renderer
+
+
+@lru_cache(maxsize=None)
+def load_mano_faces():
+    '''
+    Sealed MANO faces of (right, left) hands. Loaded once per process.
+    '''
+    import torch
+    from common.body_models import build_mano_aa, SEAL_FACES_R
+
+    faces = []
+    for is_rhand in [True, False]:
+        f3d = build_mano_aa(is_rhand).faces.astype(np.int64)
+        seal_faces = np.array(SEAL_FACES_R, dtype=np.int64)
+        if not is_rhand:
+            # left hand
+            seal_faces = seal_faces[:, np.array([1, 0, 2])]  # invert face normal
+        faces.append(torch.LongTensor(np.concatenate([f3d, seal_faces], axis=0)))
+    return tuple(faces)
+
+
+@lru_cache(maxsize=None)
+def load_object_faces(obj_name):
+    import trimesh
+
+    return trimesh.load(
+        f"./data/arctic_data/data/meta/object_vtemplates/{obj_name}/mesh.obj",
+        process=False,
+    ).faces
+
+
+def _read_image(imgname, img_res):
+    import cv2
+
+    if imgname is None or not op.exists(imgname):
+        return None
+    img = cv2.imread(imgname)[..., ::-1]
+    if img.shape[0] != img_res or img.shape[1] != img_res:
+        img = cv2.resize(img, (img_res, img_res))
+    return img.astype(np.float32) / 255.0
+
+
+def render_frames(job):
+    '''
+    Render every frame of a job and write it to disk.
+    :param job: dict made by "ArcticRenderService.make_job".
+    :return: output folder.
+    '''
+    import cv2
+    from common.mesh import Mesh
+    from common.rend_utils import color2material
+    from src.callbacks.vis.visualize_arctic import mesh_color_dict
+
+    img_res = job["img_res"]
+    out_folder = job["out_folder"]
+    renderer = _get_renderer(img_res)
+
+    f3d_r, f3d_l = [f.numpy() for f in load_mano_faces()]
+    f3d_o = load_object_faces(job["obj_name"])
+    materials = [color2material(mesh_color_dict[name]) for name in ["right", "left", "object"]]
+
+    # K is defined on the 224x224 crop
+    scale = img_res / COLS
+    K = np.array([[FOCAL * scale, 0, img_res / 2.0], [0, FOCAL * scale, img_res / 2.0], [0, 0, 1]])
+
+    os.makedirs(op.join(out_folder, "images", "rgb"), exist_ok=True)
+    writer = None
+    if "video" in job["render_types"]:
+        fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+        vid_p = op.join(out_folder, f"video_{job['frame_names'][0]}.mp4")
+        writer = cv2.VideoWriter(vid_p, fourcc, job["fps"], (img_res, img_res))
+
+    for fidx, frame_name in enumerate(job["frame_names"]):
+        meshes = [
+            Mesh(v=job["v3d_r"][fidx], f=f3d_r),
+            Mesh(v=job["v3d_l"][fidx], f=f3d_l),
+            Mesh(v=job["v3d_o"][fidx], f=f3d_o),
+        ]
+        img = _read_image(job["imgnames"][fidx], img_res)
+        rend_img = renderer.render_meshes_pose(
+            cam_transl=None,
+            meshes=meshes,
+            image=img,
+            materials=materials,
+            sideview_angle=None,
+            K=K,
+        )
+        rend_img = rend_img[..., ::-1]
+        if "rgb" in job["render_types"]:
+            cv2.imwrite(op.join(out_folder, "images", "rgb", f"{frame_name}.png"), rend_img)
+        if writer is not None:
+            writer.write(np.ascontiguousarray(rend_img))
+
+    if writer is not None:
+        writer.release()
+    return out_folder
+
+
+# ------------------------------------------------------------------------
+# caller side
+# ------------------------------------------------------------------------
+
+def seal_vertices(v3d):
+    '''
+    numpy version of "common.body_models.seal_mano_mesh" on vertices only.
+    '''
+    from common.body_models import CIRCLE_V_ID
+
+    centers = v3d[:, CIRCLE_V_ID].mean(axis=1)[:, None, :]
+    return np.concatenate((v3d, centers), axis=1)
+
+
+class ArcticRenderService:
+    '''
+    Pool of headless renderers fed with whole batches of predicted vertices.
+    The number of pending jobs is bounded by "max_pending" so that host memory stays flat.
+    '''
+
+    def __init__(self, out_folder, num_workers=2, img_res=ROWS, render_types=None, fps=30, max_pending=None):
+        self.out_folder = out_folder
+        self.img_res = img_res
+        self.render_types = list(render_types) if render_types is not None else ["rgb", "video"]
+        self.fps = fps
+        self.num_workers = num_workers
+        self.max_pending = max_pending if max_pending is not None else 2 * max(num_workers, 1)
+        self.pending = []
+
+        if num_workers > 0:
+            self.pool = ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=mp.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(list(sys.path),),
+            )
+        else:
+            self.pool = None
+
+    def make_jobs(self, data, flag, imgnames):
+        '''
+        Split a batch into one job per sequence; all tensors are copied to host here.
+        '''
+        def to_np(x):
+            if hasattr(x, "detach"):
+                x = x.detach().cpu().numpy()
+            return np.asarray(x, dtype=np.float32)
+
+        v3d_r = seal_vertices(to_np(data[f"{flag}.mano.v3d.cam.r"]))
+        v3d_l = seal_vertices(to_np(data[f"{flag}.mano.v3d.cam.l"]))
+        v3d_o = to_np(data[f"{flag}.object.v.cam"])
+        query_names = data["meta_info.query_names"]
+        num_frames = min(len(imgnames), v3d_o.shape[0])
+
+        # group frames by sequence, e.g) s05/box_grab_01/1/00010.jpg
+        groups = {}
+        for fidx in range(num_frames):
+            seq_name = "/".join(imgnames[fidx].split("/")[-4:-1])
+            groups.setdefault(seq_name, []).append(fidx)
+
+        jobs = []
+        for seq_name, idx in groups.items():
+            jobs.append({
+                "out_folder": op.join(self.out_folder, seq_name),
+                "obj_name": query_names[idx[0]],
+                "v3d_r": v3d_r[idx],
+                "v3d_l": v3d_l[idx],
+                "v3d_o": v3d_o[idx],
+                "imgnames": [imgnames[i] for i in idx],
+                "frame_names": [op.splitext(op.basename(imgnames[i]))[0] for i in idx],
+                "img_res": self.img_res,
+                "render_types": self.render_types,
+                "fps": self.fps,
+            })
+        return jobs
+
+    def submit(self, data, flag, imgnames):
+        for job in self.make_jobs(data, flag, imgnames):
+            if self.pool is None:
+                render_frames(job)
+                continue
+            while len(self.pending) >= self.max_pending:
+                self.pending.pop(0).result()
+            self.pending.append(self.pool.submit(render_frames, job))
+
+    def wait(self):
+        while len(self.pending) > 0:
+            self.pending.pop(0).result()
+
+    def close(self):
+        self.wait()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+_service = None
+
+
+def get_render_service(args, out_folder):
+    global _service
+    if _service is None:
+        _service = ArcticRenderService(
+            out_folder,
+            num_workers=getattr(args, 'render_workers', 2),
+        )
+        atexit.register(close_render_service)
+    return _service
+
+
+def close_render_service():
+    global _service
+    if _service is not None:
+        _service.close()
+        _service = None
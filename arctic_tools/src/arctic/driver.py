@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import os.path as op
+import sys
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+from loguru import logger
+from tqdm import tqdm
+
+"""
+Parallel ARCTIC preprocessing.
+
+"process": runs "processing.process_seq" for every raw sequence on a pool of worker processes.
+Each worker builds its MANO/SMPL-X/object layers once on its own device, and at most
+"num_workers" sequences are in flight, so host memory stays bounded.
+Finished sequences are recorded in a manifest, so an interrupted run resumes where it stopped.
+
+"split": builds columnar splits with "split.build_split".
+
+Run from the ARCTIC root (where ./data/arctic_data lives), e.g.
+    python arctic_tools/src/arctic/driver.py process --devices cuda:0 cuda:1 --num_workers 4
+    python arctic_tools/src/arctic/driver.py split --protocol p1 --split train val
+"""
+
+_layers = None
+_statcams = None
+_dev = None
+
+
+def load_manifest(manifest_p):
+    if not op.exists(manifest_p):
+        return {}
+    with open(manifest_p, "r") as f:
+        return json.load(f)["done"]
+
+
+def update_manifest(manifest_p, done):
+    # write-then-rename so that an interrupted run never leaves a broken manifest.
+    tmp_p = manifest_p + ".tmp"
+    with open(tmp_p, "w") as f:
+        json.dump({"done": done}, f, indent=2, sort_keys=True)
+    os.replace(tmp_p, manifest_p)
+
+
+def _init_worker(parent_sys_path, dev_queue):
+    global _layers, _statcams, _dev
+    sys.path = list(parent_sys_path)
+
+    import numpy as np
+    import torch
+    from common.body_models import construct_layers
+    from common.object_tensors import ObjectTensors
+
+    _dev = dev_queue.get()
+    if _dev.startswith("cuda"):
+        torch.cuda.set_device(_dev)
+
+    _layers = construct_layers(_dev)
+    object_tensor = ObjectTensors()
+    object_tensor.to(_dev)
+    _layers["object"] = object_tensor
+
+    with open("./data/arctic_data/data/meta/misc.json", "r") as f:
+        misc = json.load(f)
+    _statcams = {}
+    for sub in misc.keys():
+        _statcams[sub] = {
+            "world2cam": torch.FloatTensor(np.array(misc[sub]["world2cam"])),
+            "intris_mat": torch.FloatTensor(np.array(misc[sub]["intris_mat"])),
+        }
+
+
+def _process_one(mano_p, export_verts):
+    import torch
+    from src.arctic.processing import process_seq
+
+    task = [mano_p, _dev, _statcams, _layers, None]
+    out_p = process_seq(task, export_verts=export_verts)
+    if _dev.startswith("cuda"):
+        torch.cuda.empty_cache()
+    return out_p
+
+
+def process_seqs(mano_ps, devices, num_workers, export_verts=False, manifest_p=None):
+    '''
+    Process raw sequences in parallel.
+    :param mano_ps: list of "./data/arctic_data/data/raw_seqs/{sid}/{seq}.mano.npy".
+    :param devices: devices assigned to workers in round-robin.
+    :param num_workers: number of worker processes, also the number of sequences in flight.
+    '''
+    if manifest_p is None:
+        folder = "processed_verts" if export_verts else "processed"
+        manifest_p = f"./outputs/{folder}/manifest.json"
+    os.makedirs(op.dirname(manifest_p), exist_ok=True)
+
+    done = load_manifest(manifest_p)
+    todo = [mano_p for mano_p in mano_ps if mano_p not in done or not op.exists(done[mano_p])]
+    logger.info(f"{len(mano_ps) - len(todo)} seqs already processed, {len(todo)} remaining")
+    if len(todo) == 0:
+        return done
+
+    num_workers = max(1, min(num_workers, len(todo)))
+    ctx = mp.get_context("spawn")
+    dev_queue = ctx.Queue()
+    for idx in range(num_workers):
+        dev_queue.put(devices[idx % len(devices)])
+
+    pbar = tqdm(total=len(todo))
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(list(sys.path), dev_queue),
+    ) as pool:
+        pending = deque()
+        task_iter = iter(todo)
+
+        def submit_next():
+            for mano_p in task_iter:
+                pending.append((mano_p, pool.submit(_process_one, mano_p, export_verts)))
+                return
+
+        for _ in range(num_workers):
+            submit_next()
+        while len(pending) > 0:
+            mano_p, future = pending.popleft()
+            out_p = future.result()
+            submit_next()
+
+            done[mano_p] = out_p
+            update_manifest(manifest_p, done)
+            pbar.set_description(f"Saved {out_p}")
+            pbar.update(1)
+    pbar.close()
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser('ARCTIC preprocessing driver')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_proc = subparsers.add_parser("process")
+    parser_proc.add_argument("--mano_p", type=str, default=None)
+    parser_proc.add_argument("--devices", type=str, nargs="+", default=["cuda:0"])
+    parser_proc.add_argument("--num_workers", type=int, default=2)
+    parser_proc.add_argument("--export_verts", action="store_true")
+    parser_proc.add_argument("--manifest", type=str, default=None)
+
+    parser_split = subparsers.add_parser("split")
+    parser_split.add_argument("--protocol", type=str, default="p1")
+    parser_split.add_argument("--split", type=str, nargs="+", default=["train", "val", "test"])
+    parser_split.add_argument("--process_folder", type=str, default="./outputs/processed/seqs")
+    parser_split.add_argument("--request_keys", type=str, nargs="+",
+                              default=["cam_coord", "2d", "bbox", "params"])
+    parser_split.add_argument("--num_workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "process":
+        if args.mano_p is not None:
+            mano_ps = [args.mano_p]
+        else:
+            mano_ps = sorted(glob("./data/arctic_data/data/raw_seqs/*/*.mano.npy"))
+        process_seqs(mano_ps, args.devices, args.num_workers, args.export_verts, args.manifest)
+    else:
+        from src.arctic.split import build_split
+
+        for split in args.split:
+            build_split(args.protocol, split, args.request_keys, args.process_folder, args.num_workers)
+
+
+if __name__ == "__main__":
+    sys.path = [op.join(op.dirname(op.abspath(__file__)), "..", "..")] + sys.path
+    main()
@@ -490,5 +490,7 @@ def process_seq(task, export_verts=False):
         if not op.exists(out_folder):
             os.makedirs(out_folder)
 
-        pbar.set_description(f"Save to {out_p}")
+        if pbar is not None:
+            pbar.set_description(f"Save to {out_p}")
         np.save(out_p, out)
+        return out_p + ".npy"
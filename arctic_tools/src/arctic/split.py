@@ -1,6 +1,10 @@
+import itertools
 import json
 import os
 import os.path as op
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 from loguru import logger
@@ -138,7 +142,85 @@ def sanity_check_annot(seq_name, data):
             assert num_frames == side_dict.shape[0]
 
 
-def build_split(protocol, split, request_keys, process_folder):
+def _load_seq(seq_p, request_keys):
+    data = np.load(seq_p, allow_pickle=True).item()
+    sanity_check_annot(seq_p, data)
+    return {k: v for k, v in data.items() if k in request_keys}
+
+
+def _flatten_seq(data):
+    # {"params": {"rot_r": arr}, "bbox": arr} -> {"params/rot_r": arr, "bbox": arr}
+    columns = {}
+    for pkey, side_dict in data.items():
+        if isinstance(side_dict, dict):
+            for key, val in side_dict.items():
+                columns[f"{pkey}/{key}"] = np.ascontiguousarray(val)
+        else:
+            columns[pkey] = np.ascontiguousarray(side_dict)
+    return columns
+
+
+class ColumnarSplitWriter:
+    """
+    Appends sequences to a columnar split, one raw file per annotation key.
+    Layout of "{out_dir}":
+        index.json             columns (dtype, per-frame shape), seq offsets, imgnames
+        {pkey}__{key}.bin      frames of all sequences concatenated along dim 0
+    The folder is first written as "{out_dir}.tmp" and renamed once complete.
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.tmp_dir = out_dir + ".tmp"
+        if op.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        self.columns = None
+        self.files = {}
+        self.seqs = {}
+        self.num_frames = 0
+
+    def write(self, seq, data):
+        columns = _flatten_seq(data)
+        if self.columns is None:
+            self.columns = {
+                key: {"dtype": val.dtype.str, "shape": list(val.shape[1:])}
+                for key, val in columns.items()
+            }
+            for key in self.columns.keys():
+                fname = key.replace("/", "__") + ".bin"
+                self.columns[key]["file"] = fname
+                self.files[key] = open(op.join(self.tmp_dir, fname), "wb")
+        assert set(columns.keys()) == set(self.columns.keys()), f"{seq}: keys differ"
+
+        num_frames = data["params"]["rot_r"].shape[0]
+        for key, val in columns.items():
+            col = self.columns[key]
+            assert val.dtype != object, f"{seq}: {key} is not a numeric array"
+            assert val.dtype.str == col["dtype"], f"{seq}: {key} dtype differs"
+            assert list(val.shape[1:]) == col["shape"], f"{seq}: {key} shape differs"
+            assert val.shape[0] == num_frames
+            self.files[key].write(val.tobytes())
+        self.seqs[seq] = {"offset": self.num_frames, "num_frames": num_frames}
+        self.num_frames += num_frames
+
+    def close(self, imgnames):
+        for f in self.files.values():
+            f.close()
+        index = {
+            "num_frames": self.num_frames,
+            "columns": self.columns,
+            "seqs": self.seqs,
+            "imgnames": imgnames,
+        }
+        with open(op.join(self.tmp_dir, "index.json"), "w") as f:
+            json.dump(index, f)
+        if op.exists(self.out_dir):
+            shutil.rmtree(self.out_dir)
+        os.replace(self.tmp_dir, self.out_dir)
+
+
+def build_split(protocol, split, request_keys, process_folder, num_workers=4):
     logger.info(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
     logger.info(f"Constructing split {split} for protocol {protocol}")
     # extract seq_names
@@ -152,41 +234,48 @@ def build_split(protocol, split, request_keys, process_folder):
     logger.info(chosen_views)
     fseqs = chosen_seqs
 
+    if "_verts" in process_folder:
+        logger.warning(
+            "Trying to build split with verts. This will require lots of storage"
+        )
+        out_dir = f"./outputs/splits_verts/{protocol}_{split}"
+    else:
+        out_dir = f"./outputs/splits/{protocol}_{split}"
+    out_folder = op.dirname(out_dir)
+    if not op.exists(out_folder):
+        os.makedirs(out_folder)
+
+    # sequences are loaded and checked by a pool of workers, then streamed to disk in order.
+    # at most "num_workers" sequences are held in memory besides the one being written.
     # do not need world in reconstruction
-    data_dict = {}
-    for seq in tqdm(fseqs):
-        seq_p = op.join(process_folder, f"{seq}.npy")
-        if "_verts" in seq_p:
-            logger.warning(
-                "Trying to build split with verts. This will require lots of storage"
+    writer = ColumnarSplitWriter(out_dir)
+    fnames = []
+    with ProcessPoolExecutor(max_workers=max(num_workers, 1)) as pool:
+        pending = deque()
+        seq_iter = iter(fseqs)
+        for seq in itertools.islice(seq_iter, max(num_workers, 1)):
+            seq_p = op.join(process_folder, f"{seq}.npy")
+            pending.append((seq, pool.submit(_load_seq, seq_p, request_keys)))
+        pbar = tqdm(total=len(fseqs))
+        while len(pending) > 0:
+            seq, future = pending.popleft()
+            data = future.result()
+            for next_seq in itertools.islice(seq_iter, 1):
+                seq_p = op.join(process_folder, f"{next_seq}.npy")
+                pending.append((next_seq, pool.submit(_load_seq, seq_p, request_keys)))
+
+            writer.write(seq, data)
+            fnames.append(
+                glob_fnames(data["params"]["rot_r"].shape[0], seq, chosen_views)
             )
-        data = np.load(seq_p, allow_pickle=True).item()
-        sanity_check_annot(seq_p, data)
-        data = {k: v for k, v in data.items() if k in request_keys}
-        data_dict[seq] = data
+            del data
+            pbar.update(1)
+        pbar.close()
 
-    logger.info(f"Constructing image filenames from {len(fseqs)} seqs")
-    fnames = []
-    for seq in tqdm(fseqs):
-        fnames.append(
-            glob_fnames(data_dict[seq]["params"]["rot_r"].shape[0], seq, chosen_views)
-        )
     fnames = sum(fnames, [])
     assert len(fnames) == len(set(fnames))
-
     logger.info(f"Done. Total {len(fnames)} images")
 
-    out_data = {}
-    out_data["data_dict"] = data_dict
-    out_data["imgnames"] = fnames
-
-    if "_verts" in process_folder:
-        out_p = f"./outputs/splits_verts/{protocol}_{split}.npy"
-    else:
-        out_p = f"./outputs/splits/{protocol}_{split}.npy"
-    out_folder = op.dirname(out_p)
-    if not op.exists(out_folder):
-        os.makedirs(out_folder)
-    logger.info("Dumping data")
-    np.save(out_p, out_data)
-    logger.info(f"Exported: {out_p}")
+    logger.info("Dumping index")
+    writer.close(fnames)
+    logger.info(f"Exported: {out_dir}")
@@ -0,0 +1,490 @@
+import argparse
+import itertools
+import json
+import os
+import os.path as op
+import pickle
+import sys
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+
+"""
+Synthetic ARCTIC data for benchmarks and smoke tests.
+
+Writes a small dataset in the layouts read by ArcticDataset, TempoDataset and TempoInferenceDataset:
+    data/body_models/mano/MANO_{RIGHT,LEFT}.pkl
+    data/arctic_data/data/meta/misc.json, object_meta.json, mano_decimator_195.npy
+    data/arctic_data/data/meta/object_vtemplates/{obj}/
+    data/arctic_data/data/splits/{setup}_{split}/                        columnar split (see split.py)
+    data/arctic_data/data/cropped_images/{sid}/{seq}/{view}/{frame}.jpg
+    data/arctic_data/data/feat/{img_feat_version}/{setup}_{split}.pt     "global_fm" features
+    data/pickle/{setup}/{train|val}/{sid}+{seq}+{view}+{frame}.pkl       "local_fm" features (--local_fm)
+The body models and object templates are random, but the annotations are consistent with them:
+hands and objects are posed with the MANO/object layers and projected with the static and egocentric cameras.
+
+    python arctic_tools/src/arctic/synthetic.py --root /tmp/synthetic/arctic --num_seqs 2 --num_frames 40
+Then run from "{root}" with "--coco_path /tmp/synthetic --dataset_file arctic".
+"""
+
+_NUM_ALLO = 8
+_IMAGE_SIZE = (2800, 2000)  # width, height
+_CROP_DIM = 1000  # px, see data_utils.transform_kp2d
+_EGO_IMAGE_SCALE = 0.3
+_SPLIT_SUBJECTS = {
+    "train": ["s01", "s02", "s04", "s06", "s07", "s08", "s09", "s10"],
+    "val": ["s05"],
+    "test": ["s03"],
+}
+_MANO_PARENTS = [-1, 0, 1, 2, 0, 4, 5, 0, 7, 8, 0, 10, 11, 0, 13, 14]
+
+
+@contextmanager
+def _chdir(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def look_at(eye, target, world_up=(0.0, 0.0, 1.0)):
+    # world2cam (4, 4); camera x right, y down, z forward
+    eye = np.asarray(eye, dtype=np.float64)
+    z = np.asarray(target, dtype=np.float64) - eye
+    z /= np.linalg.norm(z)
+    x = np.cross(-np.asarray(world_up), z)
+    x /= np.linalg.norm(x)
+    y = np.cross(z, x)
+    R = np.stack((x, y, z), axis=0)
+    world2cam = np.eye(4)
+    world2cam[:3, :3] = R
+    world2cam[:3, 3] = -R @ eye
+    return world2cam
+
+
+def make_mano(is_rhand, rng):
+    """
+    MANO-like model with the same array shapes as MANO_{RIGHT,LEFT}.pkl (778 vertices, 16 joints).
+    """
+    sign = 1.0 if is_rhand else -1.0
+    joints = np.zeros((16, 3))
+    for finger in range(5):
+        direction = np.array([sign * (finger - 2) * 0.25, 1.0, 0.0])
+        direction /= np.linalg.norm(direction)
+        for k in range(3):
+            joints[1 + 3 * finger + k] = direction * (0.06 + 0.025 * k)
+
+    num_verts = 778
+    owner = np.arange(num_verts) % 16
+    v_template = joints[owner] + rng.normal(scale=0.008, size=(num_verts, 3))
+    weights = np.zeros((num_verts, 16))
+    weights[np.arange(num_verts), owner] = 1.0
+    J_regressor = weights.T / weights.sum(axis=0)[:, None]
+
+    # triangles between vertices of the same joint
+    a = np.arange(1538) % (num_verts - 32)
+    faces = np.stack((a, a + 16, a + 32), axis=1)
+
+    kintree_table = np.array([_MANO_PARENTS, list(range(16))], dtype=np.int64)
+    kintree_table[0, 0] = 4294967295
+    return {
+        "v_template": v_template,
+        "f": faces.astype(np.int64),
+        "J_regressor": J_regressor,
+        "weights": weights,
+        "kintree_table": kintree_table,
+        "shapedirs": rng.normal(scale=1e-3, size=(num_verts, 3, 10)),
+        "posedirs": rng.normal(scale=1e-4, size=(num_verts, 3, 135)),
+        "hands_components": np.eye(45),
+        "hands_mean": rng.normal(scale=0.05, size=45),
+    }
+
+
+def make_object(out_dir, rng):
+    import trimesh
+
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    # mm
+    v = mesh.vertices * rng.uniform(60, 150) * rng.uniform(0.6, 1.4, size=3)
+    top = v[:, 1] > 0
+    top_idx = np.where(top)[0]
+    bottom_idx = np.where(~top)[0]
+
+    def corners(pts):
+        lo, hi = pts.min(axis=0), pts.max(axis=0)
+        return np.array([[x, y, z] for x, y, z in itertools.product(*zip(lo, hi))])
+
+    params = {
+        "mocap_top": v[rng.choice(top_idx, 5, replace=False)].tolist(),
+        "mocap_bottom": v[rng.choice(bottom_idx, 5, replace=False)].tolist(),
+        "bbox_top": corners(v[top_idx]).tolist(),
+        "bbox_bottom": corners(v[bottom_idx]).tolist(),
+        "keypoints_top": v[rng.choice(top_idx, 16, replace=False)].tolist(),
+        "keypoints_bottom": v[rng.choice(bottom_idx, 16, replace=False)].tolist(),
+    }
+
+    os.makedirs(out_dir, exist_ok=True)
+    trimesh.Trimesh(v, mesh.faces, process=False).export(op.join(out_dir, "mesh.obj"))
+    with open(op.join(out_dir, "parts.json"), "w") as f:
+        json.dump(top.tolist(), f)
+    with open(op.join(out_dir, "object_params.json"), "w") as f:
+        json.dump(params, f)
+    for part, idx in [("top", top_idx), ("bottom", bottom_idx)]:
+        sub = v[rng.choice(idx, 300, replace=True)] + rng.normal(scale=0.5, size=(300, 3))
+        with open(op.join(out_dir, f"{part}_keypoints_300.json"), "w") as f:
+            json.dump({"keypoints": sub.tolist()}, f)
+
+    # meter
+    return float(np.linalg.norm(v.max(axis=0) - v.min(axis=0)) / 1000)
+
+
+def make_meta(root, subjects, rng):
+    from common.object_tensors import OBJECTS
+
+    meta_p = op.join(root, "data/arctic_data/data/meta")
+    mano_p = op.join(root, "data/body_models/mano")
+    os.makedirs(meta_p, exist_ok=True)
+    os.makedirs(mano_p, exist_ok=True)
+
+    for is_rhand in [True, False]:
+        name = "MANO_RIGHT.pkl" if is_rhand else "MANO_LEFT.pkl"
+        with open(op.join(mano_p, name), "wb") as f:
+            pickle.dump(make_mano(is_rhand, rng), f, protocol=2)
+
+    decimator = {}
+    for side in ["right", "left"]:
+        D = np.zeros((195, 778), dtype=np.float32)
+        D[np.arange(195), rng.choice(778, 195, replace=False)] = 1.0
+        decimator[f"D_{side}"] = D
+    np.save(op.join(meta_p, "mano_decimator_195.npy"), decimator)
+
+    object_meta = {}
+    for obj_name in OBJECTS:
+        out_dir = op.join(meta_p, "object_vtemplates", obj_name)
+        object_meta[obj_name] = {"diameter": make_object(out_dir, rng)}
+    with open(op.join(meta_p, "object_meta.json"), "w") as f:
+        json.dump(object_meta, f)
+
+    # static cameras on a ring around the origin
+    world2cam = []
+    for view_idx in range(_NUM_ALLO):
+        angle = 2 * np.pi * view_idx / _NUM_ALLO
+        eye = [np.cos(angle), np.sin(angle), 0.4]
+        world2cam.append(look_at(eye, [0.0, 0.0, 0.0]).tolist())
+    intris_mat = [[[3000.0, 0.0, 1400.0], [0.0, 3000.0, 1000.0], [0.0, 0.0, 1.0]]] * _NUM_ALLO
+
+    misc = {}
+    for sid in subjects:
+        misc[sid] = {
+            "world2cam": world2cam,
+            "intris_mat": intris_mat,
+            "image_size": [list(_IMAGE_SIZE)] * (_NUM_ALLO + 1),
+            "ioi_offset": 0,
+            "gender": "female",
+        }
+    with open(op.join(meta_p, "misc.json"), "w") as f:
+        json.dump(misc, f)
+    return misc
+
+
+def _smooth(rng, num_frames, dim, scale):
+    # sum of a few random sinusoids, smooth over time
+    t = np.linspace(0, 1, num_frames)[:, None]
+    out = np.zeros((num_frames, dim))
+    for _ in range(3):
+        freq = rng.uniform(0.5, 2.0, size=dim)
+        phase = rng.uniform(0, 2 * np.pi, size=dim)
+        out += np.sin(2 * np.pi * freq * t + phase)
+    return (out * scale / 3).astype(np.float32)
+
+
+def make_params(num_frames, rng):
+    params = {}
+    for side, offset in [("r", 0.12), ("l", -0.12)]:
+        params[f"rot_{side}"] = _smooth(rng, num_frames, 3, 0.5)
+        params[f"pose_{side}"] = _smooth(rng, num_frames, 45, 0.2)
+        params[f"shape_{side}"] = np.repeat(
+            rng.normal(scale=0.5, size=(1, 10)).astype(np.float32), num_frames, axis=0
+        )
+        params[f"trans_{side}"] = _smooth(rng, num_frames, 3, 0.02) + np.float32([offset, 0.0, 0.05])
+    params["obj_rot"] = _smooth(rng, num_frames, 3, 0.6)
+    params["obj_trans"] = _smooth(rng, num_frames, 3, 20.0)  # mm
+    params["obj_arti"] = np.abs(_smooth(rng, num_frames, 1, 1.2))[:, 0]
+
+    world2ego = []
+    for frame_idx in range(num_frames):
+        eye = np.array([0.0, -0.35, 0.55]) + rng.normal(scale=0.01, size=3)
+        world2ego.append(look_at(eye, rng.normal(scale=0.02, size=3)))
+    params["world2ego"] = np.array(world2ego, dtype=np.float32)
+    K_ego = np.array([[1800.0, 0.0, 1400.0], [0.0, 1800.0, 1000.0], [0.0, 0.0, 1.0]])
+    params["K_ego"] = np.repeat(K_ego[None].astype(np.float32), num_frames, axis=0)
+    dist = np.zeros(8, dtype=np.float32)
+    dist[:2] = rng.normal(scale=0.01, size=2)
+    params["dist"] = np.repeat(dist[None], num_frames, axis=0)
+    return params
+
+
+def _rot_cam(rot_world, R):
+    import common.rot as rot
+
+    quat = rot.quaternion_multiply(rot.matrix_to_quaternion(R), rot.axis_angle_to_quaternion(rot_world))
+    return rot.quaternion_to_axis_angle(quat)
+
+
+def _inside(pts2d, box):
+    # box: (num_frames, 4) xmin, ymin, xmax, ymax
+    x, y = pts2d[..., 0], pts2d[..., 1]
+    return (
+        (box[:, None, 0] <= x) & (x <= box[:, None, 2]) & (box[:, None, 1] <= y) & (y <= box[:, None, 3])
+    )
+
+
+def make_seq(layers, obj_name, params, world2cam, intris_mat):
+    """
+    Same keys and shapes as a processed sequence (processing.process_seq), without the world coordinates:
+        cam_coord: points (F, 10, N, 3) in [ego, 8 static views, distorted ego], rotations (F, 9, 3), validity (F, 9)
+        2d: points (F, 10, N, 2)
+        bbox: (F, 9, 3), cx, cy, scale
+    """
+    import torch
+    import common.transforms as tf
+
+    num_frames = params["rot_r"].shape[0]
+    batch = {k: torch.from_numpy(v) for k, v in params.items()}
+    world = {}
+    for side, name in [("r", "right"), ("l", "left")]:
+        out = layers[name](
+            global_orient=batch[f"rot_{side}"],
+            hand_pose=batch[f"pose_{side}"],
+            betas=batch[f"shape_{side}"],
+        )
+        world[f"joints.{name}"] = out.joints + batch[f"trans_{side}"][:, None, :]
+    obj_out = layers["object"].forward(
+        angles=batch["obj_arti"].view(-1, 1),
+        global_orient=batch["obj_rot"],
+        transl=batch["obj_trans"] / 1000,
+        query_names=[obj_name] * num_frames,
+    )
+    world["kp3d"] = obj_out["kp3d"]
+    world["bbox3d"] = obj_out["bbox3d"]
+    world["verts.object"] = obj_out["v"]
+
+    world2cams = [batch["world2ego"]] + [
+        torch.FloatTensor(np.array(world2cam[view_idx]))[None].repeat(num_frames, 1, 1)
+        for view_idx in range(_NUM_ALLO)
+    ]
+    Ks = [batch["K_ego"]] + [
+        torch.FloatTensor(np.array(intris_mat[view_idx]))[None].repeat(num_frames, 1, 1)
+        for view_idx in range(_NUM_ALLO)
+    ]
+
+    cam_coord = {}
+    data_2d = {}
+    for key, pts in world.items():
+        pts_views = [tf.transform_points_batch(w2c, pts.float()) for w2c in world2cams]
+        pts_views.append(tf.distort_pts3d_all(pts_views[0], batch["dist"][0]))
+        pts2d_views = [tf.project2d_batch(K, p) for K, p in zip(Ks + [Ks[0]], pts_views)]
+        cam_coord[key] = torch.stack(pts_views, dim=1)
+        data_2d[key] = torch.stack(pts2d_views, dim=1)
+    for key, rot_key in [("rot_r", "rot_r_cam"), ("rot_l", "rot_l_cam"), ("obj_rot", "obj_rot_cam")]:
+        cam_coord[rot_key] = torch.stack(
+            [_rot_cam(batch[key], w2c[:, :3, :3]) for w2c in world2cams], dim=1
+        )
+
+    # crop boxes around the object in the static views; the egocentric crop is the whole image
+    v2d = data_2d.pop("verts.object").numpy()
+    cam_coord.pop("verts.object")
+    bbox = np.zeros((num_frames, _NUM_ALLO + 1, 3), dtype=np.float32)
+    bbox[:, 0] = [_IMAGE_SIZE[0] / 2.0, _IMAGE_SIZE[1] / 2.0, _IMAGE_SIZE[0] / 200.0]
+    lo, hi = v2d[:, 1:_NUM_ALLO + 1].min(axis=2), v2d[:, 1:_NUM_ALLO + 1].max(axis=2)
+    bbox[:, 1:, :2] = (lo + hi) / 2
+    bbox[:, 1:, 2] = np.clip((hi - lo).max(axis=2) * 1.6 / 200.0, 3.0, None)
+
+    is_valid = np.zeros((num_frames, _NUM_ALLO + 1), dtype=np.int64)
+    right_valid = np.zeros_like(is_valid)
+    left_valid = np.zeros_like(is_valid)
+    j2d_r = data_2d["joints.right"].numpy()
+    j2d_l = data_2d["joints.left"].numpy()
+    for view_idx in range(_NUM_ALLO + 1):
+        # distorted points for the egocentric view
+        src_idx = _NUM_ALLO + 1 if view_idx == 0 else view_idx
+        cx, cy, scale = bbox[:, view_idx, 0], bbox[:, view_idx, 1], bbox[:, view_idx, 2] * 200
+        box = np.stack((cx - scale / 2, cy - scale / 2, cx + scale / 2, cy + scale / 2), axis=1)
+        box = np.maximum(box, 1)
+        box[:, 2] = np.minimum(box[:, 2], _IMAGE_SIZE[0])
+        box[:, 3] = np.minimum(box[:, 3], _IMAGE_SIZE[1])
+        is_valid[:, view_idx] = _inside(v2d[:, src_idx].mean(axis=1, keepdims=True), box)[:, 0]
+        for j2d, valid in [(j2d_r, right_valid), (j2d_l, left_valid)]:
+            inside = _inside(j2d[:, src_idx], box)
+            valid[:, view_idx] = inside[:, 0] & (inside.sum(axis=1) >= 3)
+    cam_coord["is_valid"] = is_valid
+    cam_coord["right_valid"] = right_valid
+    cam_coord["left_valid"] = left_valid
+
+    def to_np(d):
+        return {k: v.numpy().astype(np.float32) if torch.is_tensor(v) else v for k, v in d.items()}
+
+    return {
+        "cam_coord": to_np(cam_coord),
+        "2d": to_np(data_2d),
+        "bbox": bbox,
+        "params": params,
+    }
+
+
+def write_image(img_p, width, height, rng):
+    # smooth noise, so that the jpg size and decoding time are closer to real frames
+    small = rng.integers(0, 255, size=(max(height // 40, 1), max(width // 40, 1), 3), dtype=np.uint8)
+    img = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+    os.makedirs(op.dirname(img_p), exist_ok=True)
+    cv2.imwrite(img_p, img)
+
+
+def local_fm_shapes(hidden_dim, img_res, num_feature_levels):
+    # backbone strides 8, 16, 32, and one extra stride-2 level per additional feature level
+    shapes = []
+    size = int(np.ceil(img_res / 8))
+    for _ in range(num_feature_levels):
+        shapes.append((hidden_dim, size, size))
+        size = int(np.ceil(size / 2))
+    return shapes
+
+
+def generate(
+    root,
+    setup="p1",
+    splits=("train", "val"),
+    num_seqs=2,
+    num_frames=40,
+    img_feat_version="synthetic",
+    feat_dim=2048,
+    local_fm=False,
+    hidden_dim=256,
+    img_res=224,
+    num_feature_levels=4,
+    seed=0,
+):
+    """
+    Write a synthetic ARCTIC dataset to "root" (the "{coco_path}/{dataset_file}" folder).
+    :return: the generation config, also saved to "{root}/synthetic.json".
+    """
+    import torch
+
+    from common.body_models import build_mano_aa
+    from common.object_tensors import OBJECTS
+    from src.arctic.split import ColumnarSplitWriter, get_selected_views, glob_fnames
+
+    config = {
+        "setup": setup,
+        "splits": list(splits),
+        "num_seqs": num_seqs,
+        "num_frames": num_frames,
+        "img_feat_version": img_feat_version,
+        "feat_dim": feat_dim,
+        "local_fm": local_fm,
+        "hidden_dim": hidden_dim,
+        "img_res": img_res,
+        "num_feature_levels": num_feature_levels,
+        "seed": seed,
+    }
+    assert num_frames > 20, "the first and last 10 frames are not used"
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    root = op.abspath(root)
+    os.makedirs(root, exist_ok=True)
+    subjects = sorted(set(sum([_SPLIT_SUBJECTS[split] for split in splits], [])))
+    misc = make_meta(root, subjects, rng)
+
+    # the layers read the templates relative to the working directory
+    with _chdir(root):
+        from common.object_tensors import ObjectTensors
+
+        layers = {
+            "right": build_mano_aa(is_rhand=True),
+            "left": build_mano_aa(is_rhand=False),
+            "object": ObjectTensors(),
+        }
+
+    split_root = op.join(root, "data/arctic_data/data/splits")
+    os.makedirs(split_root, exist_ok=True)
+    fm_shapes = local_fm_shapes(hidden_dim, img_res, num_feature_levels)
+    for split in splits:
+        views = get_selected_views(setup, split)
+        writer = ColumnarSplitWriter(op.join(split_root, f"{setup}_{split}"))
+        imgnames = []
+        for seq_idx in range(num_seqs):
+            sid = _SPLIT_SUBJECTS[split][seq_idx % len(_SPLIT_SUBJECTS[split])]
+            obj_name = OBJECTS[seq_idx % len(OBJECTS)]
+            seq = f"{sid}/{obj_name}_grab_{seq_idx + 1:02d}"
+            params = make_params(num_frames, rng)
+            with torch.no_grad():
+                data = make_seq(layers, obj_name, params, misc[sid]["world2cam"], misc[sid]["intris_mat"])
+            writer.write(seq, data)
+            imgnames += glob_fnames(num_frames, seq, views)
+        writer.close(imgnames)
+
+        fm_split = "val" if "val" in split else "train"
+        for imgname in tqdm(imgnames, desc=f"{setup}_{split} images"):
+            view_idx = int(imgname.split("/")[-2])
+            img_p = op.join(root, imgname[2:].replace("/images/", "/cropped_images/"))
+            if view_idx == 0:
+                width, height = [int(dim * _EGO_IMAGE_SCALE) for dim in _IMAGE_SIZE]
+            else:
+                width = height = _CROP_DIM
+            write_image(img_p, width, height, rng)
+
+            if local_fm:
+                name = op.splitext("+".join(imgname.split("/")[-4:]))[0]
+                fm_p = op.join(root, f"data/pickle/{setup}/{fm_split}/{name}.pkl")
+                os.makedirs(op.dirname(fm_p), exist_ok=True)
+                with open(fm_p, "wb") as f:
+                    pickle.dump([torch.randn(*shape) for shape in fm_shapes], f)
+
+        feat_p = op.join(root, f"data/arctic_data/data/feat/{img_feat_version}/{setup}_{split}.pt")
+        os.makedirs(op.dirname(feat_p), exist_ok=True)
+        torch.save({"imgnames": imgnames, "feat_vec": torch.randn(len(imgnames), feat_dim)}, feat_p)
+        logger.info(f"{setup}_{split}: {num_seqs} seqs, {len(imgnames)} images")
+
+    with open(op.join(root, "synthetic.json"), "w") as f:
+        json.dump(config, f, indent=2)
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser('Synthetic ARCTIC data')
+    parser.add_argument("--root", type=str, required=True, help="{coco_path}/{dataset_file}")
+    parser.add_argument("--setup", type=str, default="p1")
+    parser.add_argument("--splits", type=str, nargs="+", default=["train", "val"])
+    parser.add_argument("--num_seqs", type=int, default=2)
+    parser.add_argument("--num_frames", type=int, default=40)
+    parser.add_argument("--img_feat_version", type=str, default="synthetic")
+    parser.add_argument("--feat_dim", type=int, default=2048)
+    parser.add_argument("--local_fm", action="store_true")
+    parser.add_argument("--hidden_dim", type=int, default=256)
+    parser.add_argument("--num_feature_levels", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate(
+        args.root,
+        setup=args.setup,
+        splits=args.splits,
+        num_seqs=args.num_seqs,
+        num_frames=args.num_frames,
+        img_feat_version=args.img_feat_version,
+        feat_dim=args.feat_dim,
+        local_fm=args.local_fm,
+        hidden_dim=args.hidden_dim,
+        num_feature_levels=args.num_feature_levels,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    sys.path = [op.join(op.dirname(op.abspath(__file__)), "..", "..")] + sys.path
+    main()
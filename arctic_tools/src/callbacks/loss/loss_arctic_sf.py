@@ -15,7 +15,8 @@ from arctic_tools.src.utils.loss_modules import (
     object_kp3d_loss,
     vector_loss,
     compute_penetration_loss,
-    compute_smooth_loss
+    compute_smooth_loss,
+    sdf_penetration_loss,
 )
 from arctic_tools.src.utils.eval_modules import compute_error_accel, eval_acc_pose
 
@@ -378,6 +379,23 @@ def compute_small_loss(pred, gt, meta_info, pre_process_models, img_res, device=
         loss_cd += cd_lo
     loss_dict["loss/cd"] = loss_cd
 
+    # penetration of the hands into the object, with the SDF grids of --penetr_loss_coef
+    if "object_sdf" in pre_process_models:
+        loss_penetr = torch.tensor(0).to(torch.float32).to(device)
+        for side, hand_valid in [("r", right_valid), ("l", left_valid)]:
+            if f"mano.v3d.cam.{side}" in tmp_pred:
+                loss_penetr = loss_penetr + sdf_penetration_loss(
+                    pre_process_models["object_sdf"],
+                    tmp_pred[f"mano.v3d.cam.{side}"],
+                    query_names,
+                    pred_radian.view(-1, 1),
+                    pred_rot,
+                    cam_t_o,
+                    is_valid,
+                    hand_valid,
+                )
+        loss_dict["loss/penetr"] = loss_penetr
+
     # # motion smooth loss
     # loss_dict["loss/smooth/2d"] = compute_smooth_loss(batch_size, window_size, 2,
     #     pred_projected_keypoints_2d_r, gt_keypoints_2d_r,
@@ -1,7 +1,76 @@
+import torch
+
 import common.camera as camera
 import common.data_utils as data_utils
 import common.transforms as tf
 import src.callbacks.process.process_generic as generic
+from common.rot import axis_angle_to_quaternion, quaternion_apply
+from common.xdict import xdict
+
+
+def group_views(targets, meta_info):
+    """
+    Group the samples that share every view-independent parameter, i.e. the camera views of the same frame.
+    Within a group only the global orientations of the hands and the object differ.
+    :return: index of the first sample of each group (G,), group index of each sample (B,)
+    """
+    query_names = meta_info["query_names"]
+    obj_ids = {name: idx for idx, name in enumerate(sorted(set(query_names)))}
+    pose_r = targets["mano.pose.r"]
+    obj_idx = torch.tensor(
+        [obj_ids[name] for name in query_names], dtype=pose_r.dtype, device=pose_r.device
+    )
+    keys = torch.cat(
+        (
+            pose_r[:, 3:],
+            targets["mano.beta.r"],
+            targets["mano.pose.l"][:, 3:],
+            targets["mano.beta.l"],
+            targets["object.radian"].view(-1, 1),
+            obj_idx[:, None],
+        ),
+        dim=1,
+    )
+    _, inverse = torch.unique(keys, dim=0, return_inverse=True)
+
+    first = {}
+    for idx, group in enumerate(inverse.tolist()):
+        first.setdefault(group, idx)
+    first = torch.LongTensor([first[group] for group in range(len(first))]).to(inverse.device)
+    return first, inverse
+
+
+def forward_mano_grouped(mano_layer, pose, betas, first, inverse):
+    # pose MANO once per group with identity global orientation,
+    # then rotate each sample about its root joint (as the global orientation does in LBS)
+    out = mano_layer(
+        betas=betas[first],
+        hand_pose=pose[first, 3:],
+        global_orient=torch.zeros_like(pose[first, :3]),
+        transl=None,
+    )
+    joints = out.joints[inverse]
+    vertices = out.vertices[inverse]
+    root = joints[:, :1]
+    quat = axis_angle_to_quaternion(pose[:, :3])[:, None, :]
+    joints = quaternion_apply(quat, joints - root) + root
+    vertices = quaternion_apply(quat, vertices - root) + root
+    return joints, vertices
+
+
+def forward_object_grouped(object_tensors, angles, global_orient, query_names, first, inverse):
+    # articulate the object once per group without global rotation, then rotate each sample
+    out = object_tensors.forward(
+        angles=angles[first],
+        global_orient=torch.zeros_like(global_orient[first]),
+        transl=None,
+        query_names=[query_names[idx] for idx in first.tolist()],
+    )
+    out = xdict({key: val[inverse] for key, val in out.items()})
+    quat = axis_angle_to_quaternion(global_orient)[:, None, :]
+    for key in ["v", "v_sub", "bbox3d", "kp3d"]:
+        out.overwrite(key, quaternion_apply(quat, out[key]))
+    return out
 
 
 def process_data(
@@ -18,12 +87,18 @@ def process_data(
     gt_kp2d_b = targets["object.kp2d.norm.b"]  # 2D keypoints for object base
     gt_object_rot = targets["object.rot"].view(-1, 3)
 
+    # views of the same frame share the kinematics up to a global rotation,
+    # so the forward passes run once per frame
+    first, inverse = group_views(targets, meta_info)
+
     # pose the object without translation (call it object cano space)
-    out = models["arti_head"].object_tensors.forward(
-        angles=targets["object.radian"].view(-1, 1),
-        global_orient=gt_object_rot,
-        transl=None,
-        query_names=meta_info["query_names"],
+    out = forward_object_grouped(
+        models["arti_head"].object_tensors,
+        targets["object.radian"].view(-1, 1),
+        gt_object_rot,
+        meta_info["query_names"],
+        first,
+        inverse,
     ).to(args['device'])
 
     diameters = out["diameter"]
@@ -42,25 +117,15 @@ def process_data(
     joints3d_l0 = tf.rigid_tf_torch_batch(targets["mano.j3d.full.l"], R0, T0)
 
     # pose MANO in MANO canonical space
-    gt_out_r = models["mano_r"](
-        betas=gt_betas_r,
-        hand_pose=gt_pose_r[:, 3:],
-        global_orient=gt_pose_r[:, :3],
-        transl=None,
+    gt_model_joints_r, gt_vertices_r = forward_mano_grouped(
+        models["mano_r"], gt_pose_r, gt_betas_r, first, inverse
     )
-    gt_model_joints_r = gt_out_r.joints
-    gt_vertices_r = gt_out_r.vertices
-    gt_root_cano_r = gt_out_r.joints[:, 0]
-
-    gt_out_l = models["mano_l"](
-        betas=gt_betas_l,
-        hand_pose=gt_pose_l[:, 3:],
-        global_orient=gt_pose_l[:, :3],
-        transl=None,
+    gt_root_cano_r = gt_model_joints_r[:, 0]
+
+    gt_model_joints_l, gt_vertices_l = forward_mano_grouped(
+        models["mano_l"], gt_pose_l, gt_betas_l, first, inverse
     )
-    gt_model_joints_l = gt_out_l.joints
-    gt_vertices_l = gt_out_l.vertices
-    gt_root_cano_l = gt_out_l.joints[:, 0]
+    gt_root_cano_l = gt_model_joints_l[:, 0]
 
     # map MANO mesh to object canonical space
     Tr0 = (joints3d_r0 - gt_model_joints_r).mean(dim=1)
@@ -133,13 +198,6 @@ def process_data(
     targets["object.kp3d.cam"] = gt_kp3d_o
     targets["object.bbox3d.cam"] = gt_bbox3d_o
 
-    out = models["arti_head"].object_tensors.forward(
-        angles=targets["object.radian"].view(-1, 1),
-        global_orient=gt_object_rot,
-        transl=None,
-        query_names=meta_info["query_names"],
-    ).to(args['device'])
-
     # GT vertices relative to right hand root
     targets["object.v.cam"] = out["v"] + gt_transl[:, None, :]
     targets["object.v_len"] = out["v_len"]
@@ -149,6 +207,9 @@ def process_data(
     targets["object.diameter"] =  out["diameter"]
     targets["object.parts_ids"] =  out["parts_ids"]
 
-    targets = generic.prepare_interfield(targets, field_max)
+    targets = generic.prepare_interfield(
+        targets, field_max, obj_index=models["obj_index"] if "obj_index" in models else None,
+        query_names=meta_info["query_names"]
+    )
 
     return inputs, targets, meta_info
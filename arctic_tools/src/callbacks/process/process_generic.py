@@ -94,31 +94,51 @@ def prepare_object_template(batch_size, object_tensors, query_names):
     return (ref_vertices, parts_idx, v_template, mask)
 
 
-def prepare_interfield(targets, max_dist):
+def prepare_interfield(targets, max_dist, obj_index=None, query_names=None):
+    """
+    :param obj_index: "ObjectPartIndex" of the object templates. If given, the distances are queried with KD-trees
+        instead of brute-force knn; "object.radian", "object.rot" and "object.cam_t" of targets give the object pose.
+    """
     dist_min = 0.0
     dist_max = max_dist
-    dist_ro, dist_ro_idx = inter.compute_dist_mano_to_obj(
+    if obj_index is not None:
+        pose = (
+            query_names,
+            targets["object.radian"].view(-1, 1),
+            targets["object.rot"].view(-1, 3),
+            targets["object.cam_t"].view(-1, 3),
+        )
+        dist_ro, dist_ro_idx = inter.compute_dist_mano_to_obj_index(
+            obj_index, targets["mano.v3d.cam.r"], *pose, dist_min, dist_max
+        )
+        dist_lo, dist_lo_idx = inter.compute_dist_mano_to_obj_index(
+            obj_index, targets["mano.v3d.cam.l"], *pose, dist_min, dist_max
+        )
+        compute_dist_obj_to_mano = inter.compute_dist_obj_to_mano_tree
+    else:
+        dist_ro, dist_ro_idx = inter.compute_dist_mano_to_obj(
+            targets["mano.v3d.cam.r"],
+            targets["object.v.cam"],
+            targets["object.v_len"],
+            dist_min,
+            dist_max,
+        )
+        dist_lo, dist_lo_idx = inter.compute_dist_mano_to_obj(
+            targets["mano.v3d.cam.l"],
+            targets["object.v.cam"],
+            targets["object.v_len"],
+            dist_min,
+            dist_max,
+        )
+        compute_dist_obj_to_mano = inter.compute_dist_obj_to_mano
+    dist_or, dist_or_idx = compute_dist_obj_to_mano(
         targets["mano.v3d.cam.r"],
         targets["object.v.cam"],
         targets["object.v_len"],
         dist_min,
         dist_max,
     )
-    dist_lo, dist_lo_idx = inter.compute_dist_mano_to_obj(
-        targets["mano.v3d.cam.l"],
-        targets["object.v.cam"],
-        targets["object.v_len"],
-        dist_min,
-        dist_max,
-    )
-    dist_or, dist_or_idx = inter.compute_dist_obj_to_mano(
-        targets["mano.v3d.cam.r"],
-        targets["object.v.cam"],
-        targets["object.v_len"],
-        dist_min,
-        dist_max,
-    )
-    dist_ol, dist_ol_idx = inter.compute_dist_obj_to_mano(
+    dist_ol, dist_ol_idx = compute_dist_obj_to_mano(
         targets["mano.v3d.cam.l"],
         targets["object.v.cam"],
         targets["object.v_len"],
@@ -18,6 +18,7 @@ from arctic_tools.common.data_utils import unormalize_kp2d
 from arctic_tools.common.data_utils import transform, get_transform
 
 from cfg import Config as cfg
+from util.shm_cache import SharedImageCache
 
 class ArcticDataset(Dataset):
     def __init__(self, args, split, seq=None):
@@ -141,7 +142,7 @@ class ArcticDataset(Dataset):
                 "/arctic_data/", "/data/arctic_data/data/"
             ).replace("/data/data/", "/data/")
             # imgname = imgname.replace("/arctic_data/", "/data/arctic_data/")
-            cv_img, img_status = read_img(op.join(root, imgname[2:]), (2800, 2000, 3))
+            cv_img, img_status = read_img(op.join(root, imgname[2:]), (2800, 2000, 3), self.image_cache)
 
             if img_status==False:
                 is_valid == 0            
@@ -451,7 +452,7 @@ class ArcticDataset(Dataset):
             root, f"data/arctic_data/data/splits/{args.setup}_{short_split}.npy"
         )
         logger.info(f"Loading {data_p}")
-        data = np.load(data_p, allow_pickle=True).item()
+        data = dataset_utils.load_split_data(data_p)
 
         self.data = data["data_dict"]
         self.imgnames = data["imgnames"]
@@ -481,6 +482,9 @@ class ArcticDataset(Dataset):
         self.obj_names = object_tensors.obj_tensors["names"]
         self.egocam_k = None
 
+        # node-wide cache of the encoded images, shared by all ranks and workers
+        self.image_cache = SharedImageCache.from_args(args) if args.cache_mode else None
+
     def __len__(self):
         return len(self.imgnames)
 
@@ -527,7 +531,7 @@ class ArcticDataset(Dataset):
             if speedup:
                 imgname = imgname.replace("/images/", "/cropped_images/")
             imgname = imgname.replace("/arctic_data/", "/data/arctic_data/data/").replace("/data/data/", "/data/")
-            cv_img, img_status = read_img(imgname, (2800, 2000, 3))
+            cv_img, img_status = read_img(imgname, (2800, 2000, 3), self.image_cache)
         else:
             norm_img = None
 
@@ -12,19 +12,39 @@ import src.datasets.dataset_utils as dataset_utils
 from src.datasets.arctic_dataset import ArcticDataset
 
 
-def create_windows(imgnames, window_size):
+def create_windows(imgnames, window_size, stride=None):
+    """
+    Windows of window_size frames of each sequence, every stride frames (window_size by default, no overlap).
+    The last window of a sequence is padded by repeating its last frame.
+    Each real frame is kept by the window whose center is nearest to it, so that the kept frames of all windows
+    stitch back into one prediction per frame.
+    :return: windows (lists of imgnames) and masks (1 for the frames kept by the window, 0 for padded and
+        overlapping frames)
+    """
+    stride = stride or window_size
+    assert 0 < stride <= window_size, f"stride ({stride}) must be in (0, window_size ({window_size})]"
+    center = (window_size - 1) / 2
+
     def chunks(lst, n):
-        """Yield successive n-sized chunks from lst."""
-        my_chunks = [lst[i : i + n] for i in range(0, len(lst), n)]
-        if len(my_chunks[-1]) == n:
-            return my_chunks
-        last_chunk = my_chunks[-1]
-        last_element = last_chunk[-1]
-        last_chunk_pad = [last_element for _ in range(n)]
-        for idx, element in enumerate(last_chunk):
-            last_chunk_pad[idx] = element
-        my_chunks[-1] = last_chunk_pad
-        return my_chunks
+        num = len(lst)
+        starts = [0]
+        while starts[-1] + n < num:
+            starts.append(starts[-1] + stride)
+
+        # frame -> (distance to the window center, window)
+        owner = {}
+        for w, start in enumerate(starts):
+            for i in range(min(n, num - start)):
+                dist = abs(i - center)
+                if start + i not in owner or dist < owner[start + i][0]:
+                    owner[start + i] = (dist, w)
+
+        my_chunks = []
+        my_masks = []
+        for w, start in enumerate(starts):
+            my_chunks.append([lst[min(start + i, num - 1)] for i in range(n)])
+            my_masks.append([int(start + i < num and owner[start + i][1] == w) for i in range(n)])
+        return my_chunks, my_masks
 
     img_seq_dict = {}
     for imgname in imgnames:
@@ -35,11 +55,12 @@ def create_windows(imgnames, window_size):
         img_seq_dict[seq_name].append(imgname)
 
     windows = []
+    masks = []
     for seq_name in img_seq_dict.keys():
-        windows.append(chunks(sorted(img_seq_dict[seq_name]), window_size))
-
-    windows = sum(windows, [])
-    return windows
+        seq_windows, seq_masks = chunks(sorted(img_seq_dict[seq_name]), window_size)
+        windows += seq_windows
+        masks += seq_masks
+    return windows, masks
 
 
 class TempoInferenceDataset(ArcticDataset):
@@ -94,9 +115,11 @@ class TempoInferenceDataset(ArcticDataset):
         self._process_imgnames(seq, split)
 
         # split imgnames by windowsize into chunks
-        # no overlappping frames btw chunks
-        windows = create_windows(self.imgnames, self.window_size)
-        windows = dataset_utils.downsample(windows, split)
+        # chunks overlap by window_size - window_stride frames
+        self.window_stride = getattr(args, 'window_stride', 0) or self.window_size
+        windows, masks = create_windows(self.imgnames, self.window_size, self.window_stride)
+        windows = dataset_utils.downsample(list(zip(windows, masks)), split)
+        windows, masks = [list(item[0]) for item in windows], [item[1] for item in windows]
 
         self.args = args
         self.root = op.join(args.coco_path, args.dataset_file)
@@ -104,7 +127,10 @@ class TempoInferenceDataset(ArcticDataset):
 
         self.split_window = args.split_window
         self.windows = windows
-        num_imgnames = len(sum(self.windows, []))
+        self.window_masks = masks
+        # False with --base_cache: SmoothNet reads the base outputs from the cache, only targets are loaded
+        self.load_inputs = True
+        num_imgnames = int(sum(sum(mask) for mask in masks))
         logger.info(
             f"TempoInferDataset Loaded {self.split} split, num samples {num_imgnames}"
         )
@@ -116,14 +142,25 @@ class TempoInferenceDataset(ArcticDataset):
         meta_list = []
         img_feats = []
         # load_rgb = not self.args.eval  # test.py do not load rgb
-        load_rgb = True if self.args.feature_type == 'origin' else False
+        load_rgb = True if self.args.feature_type == 'origin' and self.load_inputs else False
+        loaded = {}
         for imgname in imgnames:
             short_imgname = "/".join(imgname.split("/")[-4:])
             # always load rgb because in training, we need to visualize
             # too complicated if not load rgb in eval or other situations
             # thus: load both rgb and features
-            
-            if not load_rgb:
+
+            # padded frames repeat the last frame of the window, load it once
+            if imgname in loaded:
+                feat, inputs, targets, meta_info = loaded[imgname]
+                if feat is not None:
+                    img_feats.append(feat)
+                inputs_list.append({'img':inputs})
+                targets_list.append(targets)
+                meta_list.append(meta_info)
+                continue
+
+            if not load_rgb and self.load_inputs:
                 if self.args.feature_type == 'local_fm':
                     split = 'val' if 'val' in self.split else 'train'
                     name = '+'.join(imgname.split("/")[-4:])
@@ -134,6 +171,8 @@ class TempoInferenceDataset(ArcticDataset):
                     img_feats.append(self.vec_dict[short_imgname])
 
             inputs, targets, meta_info = self.getitem(imgname, load_rgb=load_rgb)
+            feat = img_feats[-1] if not load_rgb and self.load_inputs else None
+            loaded[imgname] = (feat, inputs, targets, meta_info)
             inputs_list.append({'img':inputs})
             targets_list.append(targets)
             meta_list.append(meta_info)
@@ -142,6 +181,9 @@ class TempoInferenceDataset(ArcticDataset):
             inputs_list = ld_utils.stack_dl(
                 ld_utils.ld2dl(inputs_list), dim=0, verbose=False
             )
+        elif not self.load_inputs:
+            # empty placeholder, so that the collate function and the prefetcher stay unchanged
+            inputs_list = {"img": torch.zeros(len(imgnames), 0)}
         else:
             inputs_list = {}
             if self.args.feature_type == 'local_fm':
@@ -176,6 +218,7 @@ class TempoInferenceDataset(ArcticDataset):
         meta_list["center"] = torch.FloatTensor(np.array(meta_list["center"]))
         meta_list["is_flipped"] = torch.FloatTensor(np.array(meta_list["is_flipped"]))
         meta_list["rot_angle"] = torch.FloatTensor(np.array(meta_list["rot_angle"]))
+        meta_list["window_valid"] = torch.FloatTensor(self.window_masks[index])
         return inputs_list, targets_list, meta_list
 
     def __len__(self):
@@ -42,4 +42,5 @@ class TempoInferenceDatasetEval(TempoInferenceDataset):
         meta_list["center"] = torch.FloatTensor(np.array(meta_list["center"]))
         meta_list["is_flipped"] = torch.FloatTensor(np.array(meta_list["is_flipped"]))
         meta_list["rot_angle"] = torch.FloatTensor(np.array(meta_list["rot_angle"]))
+        meta_list["window_valid"] = torch.FloatTensor(self.window_masks[index])
         return inputs_list, targets_list, meta_list
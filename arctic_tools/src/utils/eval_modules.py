@@ -462,3 +462,67 @@ eval_fn_dict = {
     "acc_err_pose": eval_acc_pose,
     "acc_err_field": eval_acc_field,
 }
+
+_HAND_VALID = ["is_valid", "left_valid", "right_valid"]
+_DIST = ["dist.ro", "dist.lo", "dist.or", "dist.ol"]
+
+# keys of pred, targets and meta_info read by each metric of eval_fn_dict
+eval_field_dict = {
+    "aae": {
+        "pred": ["object.radian"],
+        "targets": ["is_valid", "object.radian"],
+    },
+    "mpjpe.ra": {
+        "pred": ["mano.j3d.cam.r", "mano.j3d.cam.l"],
+        "targets": ["mano.j3d.cam.r", "mano.j3d.cam.l"] + _HAND_VALID,
+    },
+    "mrrpe": {
+        "pred": ["mano.j3d.cam.r", "mano.j3d.cam.l", "object.v.cam"],
+        "targets": ["mano.j3d.cam.r", "mano.j3d.cam.l", "object.v.cam", "object.v_len"] + _HAND_VALID,
+        "meta_info": ["part_ids"],
+    },
+    "success_rate": {
+        "pred": ["object.v.cam"],
+        "targets": ["is_valid", "object.v.cam", "object.v_len"],
+        "meta_info": ["part_ids", "diameter"],
+    },
+    "avg_err_field": {
+        "pred": _DIST,
+        "targets": ["is_valid"] + _DIST,
+        "meta_info": ["object.v_len"],
+    },
+    "cdev": {
+        "pred": ["object.v.cam", "mano.v3d.cam.r", "mano.v3d.cam.l"],
+        "targets": ["dist.ro", "dist.lo", "idx.ro", "idx.lo"] + _HAND_VALID,
+    },
+    "mdev": {
+        "pred": ["object.v.cam", "mano.v3d.cam.r", "mano.v3d.cam.l"],
+        "targets": ["dist.ro", "dist.lo", "idx.ro", "idx.lo", "object.v.cam"] + _HAND_VALID,
+    },
+    "acc_err_pose": {
+        "pred": ["object.v.cam", "mano.v3d.cam.r", "mano.v3d.cam.l", "mano.j3d.cam.r", "mano.j3d.cam.l"],
+        "targets": [
+            "object.v.cam", "mano.v3d.cam.r", "mano.v3d.cam.l", "mano.j3d.cam.r", "mano.j3d.cam.l",
+            "object.parts_ids",
+        ] + _HAND_VALID,
+    },
+    "acc_err_field": {
+        "pred": _DIST,
+        "targets": _DIST + _HAND_VALID,
+    },
+}
+
+
+def required_fields(metrics, extra=()):
+    """
+    Keys of the data of "prepare_data" ("pred.*", "targets.*", "meta_info.*") read by the metrics.
+    :param extra: other keys of the data used by the caller.
+    :return: set of keys, or None if a metric does not declare its fields in eval_field_dict.
+    """
+    fields = set(extra)
+    for metric in metrics:
+        if metric not in eval_field_dict:
+            return None
+        for group, keys in eval_field_dict[metric].items():
+            fields.update(f"{group}.{key}" for key in keys)
+    return fields
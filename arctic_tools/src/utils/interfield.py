@@ -1,5 +1,9 @@
+import numpy as np
 import torch
 from pytorch3d.ops import knn_points
+from scipy.spatial import cKDTree
+
+from common.rot import axis_angle_to_quaternion, quaternion_apply, quaternion_invert
 
 
 def compute_dist_mano_to_obj(batch_mano_v, batch_v, batch_v_len, dist_min, dist_max):
@@ -25,6 +29,104 @@ def compute_dist_obj_to_mano(batch_mano_v, batch_v, batch_v_len, dist_min, dist_
     return knn_dists[:, :, 0], knn_idx[:, :, 0]
 
 
+class ObjectPartIndex:
+    """
+    KD-trees over the template vertices of each object part (top: 1, bottom: 2) in canonical space.
+    The parts are rigid, so a posed object is queried by mapping the query points into the frame of each part.
+    """
+
+    def __init__(self, obj_tensors):
+        self.trees = {}
+        for obj_idx, name in enumerate(obj_tensors["names"]):
+            v_len = int(obj_tensors["v_len"][obj_idx])
+            v = obj_tensors["v"][obj_idx, :v_len].cpu().numpy().astype(np.float64)
+            parts_ids = obj_tensors["parts_ids"][obj_idx, :v_len].cpu().numpy()
+            for part in [1, 2]:
+                vidx = np.nonzero(parts_ids == part)[0]
+                if len(vidx) > 0:
+                    self.trees[(name, part)] = (cKDTree(v[vidx]), vidx)
+
+    def query(self, points, query_names, radian, rot, transl, dist_max=float("inf")):
+        """
+        Nearest vertex of the posed objects (same pose as "ObjectTensors.forward") for each point.
+        :param points: (B, N, 3)
+        :param radian: (B, 1) articulation angle
+        :param rot: (B, 3) global orientation (axis-angle)
+        :param transl: (B, 3)
+        :return: distance (B, N) and index of the object vertex (B, N). Points farther than dist_max from the object
+            get the distance dist_max and the index 0.
+        """
+        z_axis = torch.tensor([0.0, 0.0, -1.0], device=points.device, dtype=points.dtype)
+        quat_arti = axis_angle_to_quaternion(z_axis[None, :] * radian.view(-1, 1))
+        quat_global = axis_angle_to_quaternion(rot.view(-1, 3))
+
+        # camera coord -> frame of the bottom part -> frame of the top part
+        bottom = quaternion_apply(quaternion_invert(quat_global)[:, None, :], points - transl.view(-1, 1, 3))
+        top = quaternion_apply(quaternion_invert(quat_arti)[:, None, :], bottom)
+        cano = {1: top.cpu().numpy(), 2: bottom.cpu().numpy()}
+
+        B, N = points.shape[:2]
+        dist = np.full((B, N), np.inf)
+        idx = np.zeros((B, N), dtype=np.int64)
+        for name in set(query_names):
+            batch_idx = np.array([b for b, query in enumerate(query_names) if query == name])
+            for part, part_points in cano.items():
+                if (name, part) not in self.trees:
+                    continue
+                tree, vidx = self.trees[(name, part)]
+                # one query for all the samples of the object
+                part_dist, part_idx = tree.query(
+                    part_points[batch_idx].reshape(-1, 3), k=1, distance_upper_bound=dist_max, workers=-1
+                )
+                part_dist = part_dist.reshape(len(batch_idx), N)
+                part_idx = part_idx.reshape(len(batch_idx), N)
+                closer = part_dist < dist[batch_idx]
+                found = np.where(closer, vidx[np.minimum(part_idx, len(vidx) - 1)], idx[batch_idx])
+                dist[batch_idx] = np.minimum(part_dist, dist[batch_idx])
+                idx[batch_idx] = found
+
+        dist = np.minimum(dist, dist_max)
+        dist = torch.from_numpy(dist).to(points.device, points.dtype)
+        idx = torch.from_numpy(idx).to(points.device)
+        return dist, idx
+
+
+def compute_dist_mano_to_obj_index(
+    obj_index, batch_mano_v, query_names, radian, rot, transl, dist_min, dist_max
+):
+    """
+    Same as "compute_dist_mano_to_obj" with the canonical part trees of "ObjectPartIndex".
+    """
+    knn_dists, knn_idx = obj_index.query(batch_mano_v, query_names, radian, rot, transl, dist_max)
+    knn_dists = torch.clamp(knn_dists, dist_min, dist_max)
+    return knn_dists, knn_idx
+
+
+def compute_dist_obj_to_mano_tree(batch_mano_v, batch_v, batch_v_len, dist_min, dist_max):
+    """
+    Same as "compute_dist_obj_to_mano" with a KD-tree over the hand vertices of each sample.
+    The hands are not rigid, so these trees are built per sample; they are small (778 vertices).
+    Object vertices farther than dist_max from the hand get the index 0.
+    """
+    mano_v = batch_mano_v.cpu().numpy()
+    obj_v = batch_v.cpu().numpy()
+    B, N = obj_v.shape[:2]
+    # padded vertices are 0 as with knn_points
+    dist = np.zeros((B, N), dtype=np.float64)
+    idx = np.zeros((B, N), dtype=np.int64)
+    for b in range(B):
+        v_len = int(batch_v_len[b])
+        tree = cKDTree(mano_v[b])
+        b_dist, b_idx = tree.query(obj_v[b, :v_len], k=1, distance_upper_bound=dist_max, workers=-1)
+        valid = np.isfinite(b_dist)
+        dist[b, :v_len] = np.where(valid, b_dist, dist_max)
+        idx[b, :v_len] = np.where(valid, b_idx, 0)
+
+    knn_dists = torch.from_numpy(dist).to(batch_v.device, batch_v.dtype)
+    knn_dists = torch.clamp(knn_dists, dist_min, dist_max)
+    return knn_dists, torch.from_numpy(idx).to(batch_v.device)
+
+
 def dist2contact(dist, contact_bnd):
     contact = (dist < contact_bnd).long()
     return contact
@@ -159,6 +159,18 @@ def penetration_loss(
     return penetr_dist
 
 
+def sdf_penetration_loss(object_sdf, pred_hand_xyz, query_names, radian, rot, transl, is_valid, hand_valid):
+    """
+    Penetration of the hand vertices into the object, looked up in the signed-distance grids of "ObjectSDF".
+    Same scale as "penetration_loss": 120 * squared penetration depth summed over the vertices, averaged over the batch.
+    """
+    B = pred_hand_xyz.size(0)
+    sdf = object_sdf(pred_hand_xyz, query_names, radian, rot, transl)
+    depth = torch.relu(-sdf)
+    valid_info = (hand_valid * is_valid).to(depth.dtype)
+    return 120 * (depth**2 * valid_info[:, None]).sum() / B
+
+
 def batched_index_select(input, index, dim=1):
     '''
     :param input: [B, N1, *]
@@ -3,23 +3,18 @@ import os.path as op
 
 import numpy as np
 import torch
-import trimesh
 
 import common.viewer as viewer_utils
-from common.body_models import build_layers, seal_mano_mesh
 from common.xdict import xdict
 from src.extraction.interface import prepare_data
 from src.extraction.keys.vis_pose import KEYS as keys
 from arctic_tools.common.viewer import ARCTICViewer, ViewerData
+from arctic_tools.render_service import get_render_service, load_mano_faces, load_object_faces, seal_vertices
 
 def construct_meshes(data, flag, device):
-    # load object faces
+    # load object faces (cached)
     obj_name = data['meta_info.query_names'][0]
-    f3d_o = trimesh.load(
-        f"./data/arctic_data/data/meta/object_vtemplates/{obj_name}/mesh.obj",
-        process=False,
-    ).faces
-    layers = build_layers(device)
+    f3d_o = load_object_faces(obj_name)
 
     # center verts
     v3d_r = data[f"{flag}.mano.v3d.cam.r"] 
@@ -30,24 +25,23 @@ def construct_meshes(data, flag, device):
     v3d_l -= cam_t[:, None, :] 
     v3d_o -= cam_t[:, None, :] 
 
-    # seal MANO mesh
-    f3d_r = torch.LongTensor(layers["right"].faces.astype(np.int64))
-    f3d_l = torch.LongTensor(layers["left"].faces.astype(np.int64))
-    v3d_r, f3d_r = seal_mano_mesh(v3d_r, f3d_r, True)
-    v3d_l, f3d_l = seal_mano_mesh(v3d_l, f3d_l, False)
+    # seal MANO mesh (faces are cached already sealed)
+    f3d_r, f3d_l = load_mano_faces()
+    v3d_r = seal_vertices(v3d_r.numpy())
+    v3d_l = seal_vertices(v3d_l.numpy())
 
     # AIT meshes
     hand_color = "white"
     object_color = "light-blue"
     right = {
-        "v3d": v3d_r.numpy(),
+        "v3d": v3d_r,
         "f3d": f3d_r.numpy(),
         "vc": None,
         "name": "right",
         "color": hand_color,
     }
     left = {
-        "v3d": v3d_l.numpy(),
+        "v3d": v3d_l,
         "f3d": f3d_l.numpy(),
         "vc": None,
         "name": "left",
@@ -72,19 +66,7 @@ def construct_meshes(data, flag, device):
     )
     return meshes, data
 
-def visualize_arctic_result(args, data, flag):
-    args.headless = False
-    viewer = ARCTICViewer(
-        interactive=not args.headless,
-        # size=(2048, 2048),
-        size=(1000, 1000),
-        render_types=["rgb", "video"],
-    )
-
-    meshes_all = xdict()
-    meshes, data = construct_meshes(data, flag, args.device)
-    meshes_all.merge(meshes)
-
+def get_imgnames(args, data):
     root = op.join(args.coco_path, args.dataset_file)
     if args.method == 'arctic_sf':
         # imgnames = [op.join(root, data['meta_info.imgname'][0][2:])]
@@ -97,6 +79,29 @@ def visualize_arctic_result(args, data, flag):
             op.join(root, 'data/arctic_data/data/cropped_images', img) if root not in img else img \
             for img in data['meta_info.imgname']
         ]
+    return imgnames
+
+
+def visualize_arctic_result(args, data, flag):
+    save_foler = op.join(f'results/{args.dataset_file}/{args.setup}')
+    imgnames = get_imgnames(args, data)
+
+    # offline rendering : frames are rendered by worker processes.
+    if getattr(args, 'headless', False):
+        service = get_render_service(args, save_foler)
+        service.submit(data, flag, imgnames)
+        return
+
+    viewer = ARCTICViewer(
+        interactive=True,
+        # size=(2048, 2048),
+        size=(1000, 1000),
+        render_types=["rgb", "video"],
+    )
+
+    meshes_all = xdict()
+    meshes, data = construct_meshes(data, flag, args.device)
+    meshes_all.merge(meshes)
 
     num_frames = min(len(imgnames), data[f"{flag}.object.cam_t"].shape[0])
 
@@ -115,9 +120,8 @@ def visualize_arctic_result(args, data, flag):
     data = ViewerData(Rt=Rt, K=K, cols=cols, rows=rows, imgnames=imgnames)
     batch = meshes_all, data
 
-    save_foler = op.join(f'results/{args.dataset_file}/{args.setup}')
     if not op.isdir(save_foler):
-        os.mkdir(save_foler)
+        os.makedirs(save_foler)
 
     viewer.check_format(batch)
     viewer.render_seq(batch, out_folder=save_foler)
\ No newline at end of file
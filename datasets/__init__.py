@@ -10,9 +10,6 @@
 import torch.utils.data
 from .torchvision_datasets import CocoDetection
 
-from .coco import build as build_coco
-from .coco_vid import build_vid as build_vid_coco
-
 
 def get_coco_api_from_dataset(dataset):
     for _ in range(10):
@@ -25,9 +22,12 @@ def get_coco_api_from_dataset(dataset):
 
 
 def build_dataset(image_set, args):
+    # imported here, so only the selected dataset pulls in its dependencies
+    from .coco import build as build_coco
     return build_coco(image_set, args)
     # if args.train_stage == 'pose':
     #     return build_coco(image_set, args)
     # else:
+    #     from .coco_vid import build_vid as build_vid_coco
     #     return build_vid_coco(image_set, args)
     
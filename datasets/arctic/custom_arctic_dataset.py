@@ -361,7 +361,7 @@ class ArcticDataset(VisionDataset):
             root, f"data/arctic_data/data/splits/{args.setup}_{short_split}.npy"
         )
         logger.info(f"Loading {data_p}")
-        data = np.load(data_p, allow_pickle=True).item()
+        data = dataset_utils.load_split_data(data_p)
 
         self.data = data["data_dict"]
         self.imgnames = data["imgnames"]
@@ -1,3 +1,4 @@
+import json
 import os
 import os.path as op
 from glob import glob
@@ -163,3 +164,41 @@ def downsample(fnames, split):
     num_samples = get_num_images(split, len(fnames))
     curr_keys = random.sample(fnames, num_samples)
     return curr_keys
+
+
+def load_split_data(data_p):
+    """
+    Load a split made by "src.arctic.split.build_split".
+    If "{name}/index.json" exists next to "{name}.npy", the columnar split is memory-mapped
+    and returned as the same {"data_dict": {seq: {pkey: {key: arr}}}, "imgnames": [...]} layout.
+    """
+    split_dir = op.splitext(data_p)[0]
+    index_p = op.join(split_dir, "index.json")
+    if not op.exists(index_p):
+        return np.load(data_p, allow_pickle=True).item()
+
+    with open(index_p, "r") as f:
+        index = json.load(f)
+    num_frames = index["num_frames"]
+    columns = {}
+    for key, col in index["columns"].items():
+        columns[key] = np.memmap(
+            op.join(split_dir, col["file"]),
+            dtype=np.dtype(col["dtype"]),
+            mode="r",
+            shape=tuple([num_frames] + col["shape"]),
+        )
+
+    data_dict = {}
+    for seq, info in index["seqs"].items():
+        start = info["offset"]
+        end = start + info["num_frames"]
+        seq_data = {}
+        for key, arr in columns.items():
+            if "/" in key:
+                pkey, skey = key.split("/", 1)
+                seq_data.setdefault(pkey, {})[skey] = arr[start:end]
+            else:
+                seq_data[key] = arr[start:end]
+        data_dict[seq] = seq_data
+    return {"data_dict": data_dict, "imgnames": index["imgnames"]}
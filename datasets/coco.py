@@ -11,7 +11,6 @@ COCO dataset which returns image_id for evaluation.
 
 Mostly copy-paste from https://github.com/pytorch/vision/blob/13b35ff/references/detection/coco_utils.py
 """
-import matplotlib.pyplot as plt
 from pathlib import Path
 import torch
 import torch.utils.data
@@ -21,12 +20,11 @@ import datasets.transforms as T
 import json
 
 from arctic_tools.src.factory import fetch_dataloader
-from datasets.arctic.build import fetch_dataloader as build_arctic
 
 class CocoDetection(TvCocoDetection):
-    def __init__(self, img_folder, ann_file, dataset, transforms, cache_mode=False, local_rank=0, local_size=1, mode='train'):
+    def __init__(self, img_folder, ann_file, dataset, transforms, cache_mode=False, cache_size=16 * 2**30, local_rank=0, local_size=1, mode='train'):
         super(CocoDetection, self).__init__(img_folder, ann_file,
-                                            cache_mode=cache_mode, local_rank=local_rank, local_size=local_size)
+                                            cache_mode=cache_mode, cache_size=cache_size, local_rank=local_rank, local_size=local_size)
         self.etc_ann = None   
         self._transforms = transforms
         self.prepare = ConvertCocoPolysToMask(self.coco, dataset, self.etc_ann)
@@ -51,10 +49,10 @@ class CocoDetection(TvCocoDetection):
 
 
 def cam2pixel(cam_coord, f, c):
-    x = cam_coord[:, 0] / (cam_coord[:, 2] + 1e-8) * f[0] + c[0]
-    y = cam_coord[:, 1] / (cam_coord[:, 2] + 1e-8) * f[1] + c[1]
-    z = cam_coord[:, 2]
-    img_coord = torch.cat((x[:,None], y[:,None], z[:,None]),1)
+    x = cam_coord[..., 0] / (cam_coord[..., 2] + 1e-8) * f[0] + c[0]
+    y = cam_coord[..., 1] / (cam_coord[..., 2] + 1e-8) * f[1] + c[1]
+    z = cam_coord[..., 2]
+    img_coord = torch.stack((x, y, z), -1)
     return img_coord
 
 class ConvertCocoPolysToMask(object):
@@ -141,12 +139,10 @@ class ConvertCocoPolysToMask(object):
         #     #         target[target < -1] = -1
         #     uvd = keypoints
         # else:
-        uvd = torch.stack([
-            cam2pixel(keypoints[i], (fx, fy), (cx, cy)) \
-                if keypoints[i].sum()!=0 else \
-            torch.zeros(21,3) \
-                for i in range(len(classes)) 
-        ])
+        # all hands at once, missing hands (all zero) stay zero
+        keypoints = keypoints[:len(classes)].view(-1, 21, 3)
+        uvd = cam2pixel(keypoints, (fx, fy), (cx, cy))
+        uvd[keypoints.sum(dim=(1, 2)) == 0] = 0
 
         if self.dataset == 'FPHA':
             uvd[...,2] /= 1000
@@ -315,6 +311,6 @@ def build(image_set, args):
 
     img_folder, ann_file = PATHS[image_set]
     dataset = CocoDetection(img_folder, ann_file, args.dataset_file, transforms=make_coco_transforms(image_set, args.img_size, args.make_pickle),
-                            cache_mode=args.cache_mode, local_rank=get_local_rank(), local_size=get_local_size(), mode=image_set)
+                            cache_mode=args.cache_mode, cache_size=args.cache_size * 2**30, local_rank=get_local_rank(), local_size=get_local_size(), mode=image_set)
     return dataset
 
@@ -29,9 +29,9 @@ import trimesh
 
 
 class CocoDetection_vid(TvCocoDetection):
-    def __init__(self, img_folder, ann_file, cache_mode=False, local_rank=0, local_size=1, mode=None, args=None):
+    def __init__(self, img_folder, ann_file, cache_mode=False, cache_size=16 * 2**30, local_rank=0, local_size=1, mode=None, args=None):
         super(CocoDetection_vid, self).__init__(img_folder, ann_file,
-                                            cache_mode=cache_mode, local_rank=local_rank, local_size=local_size, mode=mode, args=args)
+                                            cache_mode=cache_mode, cache_size=cache_size, local_rank=local_rank, local_size=local_size, mode=mode, args=args)
         
         self.data_list = []
     def __getitem__(self, idx):
@@ -69,5 +69,5 @@ def build_vid(image_set, args):
         
     img_folder, ann_file = PATHS[image_set]
     dataset = CocoDetection_vid(img_folder, ann_file,
-                            cache_mode=args.cache_mode, local_rank=get_local_rank(), local_size=get_local_size(), mode=image_set, args=args)
+                            cache_mode=args.cache_mode, cache_size=args.cache_size * 2**30, local_rank=get_local_rank(), local_size=get_local_size(), mode=image_set, args=args)
     return dataset
\ No newline at end of file
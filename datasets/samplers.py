@@ -226,3 +226,141 @@ class NodeDistributedSampler(Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+def get_seq_names(dataset):
+    """Sequence (sid/seq/view) of every item; items of windowed datasets are keyed by their first frame."""
+    if hasattr(dataset, 'windows'):
+        imgnames = [window[0] for window in dataset.windows]
+    elif hasattr(dataset, 'imgnames'):
+        imgnames = dataset.imgnames
+    else:
+        return None
+    return ["/".join(imgname.split("/")[-4:-1]) for imgname in imgnames]
+
+
+class SequenceChunkSampler(Sampler):
+    """Sampler that shuffles contiguous chunks of a sequence instead of single items.
+    Items of a chunk are consecutive frames (or windows) of the same sequence, so a
+    batch reads from one image directory / feature file and nearby `data_dict` entries.
+    .. note::
+        With `chunk_size` a multiple of the batch size, every batch comes from a single chunk.
+    Arguments:
+        dataset: Dataset with `imgnames` or `windows` attributes.
+        chunk_size: Number of consecutive items in a chunk.
+        num_replicas (optional): Number of processes participating in
+            distributed training.
+        rank (optional): Rank of the current process within num_replicas.
+        node_local (optional): Keep the item split of NodeDistributedSampler
+            (item % local_size == local_rank), e.g. for node-local caches.
+        shuffle_in_chunk (optional): Shuffle the order of items inside a chunk.
+        group_views (optional): Chunk the frames of a sequence over all camera views, and keep
+            the views of a frame next to each other. `chunk_size` then counts frames.
+            process_arctic.process_data runs the kinematics once for the views of a frame in a batch.
+    """
+
+    def __init__(self, dataset, chunk_size, num_replicas=None, rank=None, local_rank=None, local_size=None,
+                 shuffle=True, node_local=False, shuffle_in_chunk=True, group_views=False):
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            rank = dist.get_rank()
+        if local_rank is None:
+            local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        if local_size is None:
+            local_size = int(os.environ.get('LOCAL_SIZE', 1))
+        self.dataset = dataset
+        self.chunk_size = chunk_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.shuffle_in_chunk = shuffle_in_chunk
+        self.group_views = group_views
+        self.epoch = 0
+
+        if node_local:
+            self.num_parts = local_size
+            self.local_rank = local_rank
+        else:
+            self.num_parts = 1
+            self.local_rank = 0
+        self.num_samples = int(math.ceil(len(self.dataset) * 1.0 / self.num_replicas))
+        self.total_size_parts = self.num_samples * self.num_replicas // self.num_parts
+        self.chunks = self._build_chunks()
+
+    def _build_chunks(self):
+        # a chunk is a list of units, and a unit is a list of items kept together (the views of a frame)
+        indices = [i for i in range(len(self.dataset)) if i % self.num_parts == self.local_rank]
+        seq_names = get_seq_names(self.dataset)
+        if seq_names is None:
+            seq_names = [''] * len(self.dataset)
+
+        if self.group_views and seq_names[0] != '':
+            frame_names = get_frame_names(self.dataset)
+            seq_dict = {}
+            for i in indices:
+                sid, seq_name, view_idx = seq_names[i].split("/")
+                frames = seq_dict.setdefault(f"{sid}/{seq_name}", {})
+                frames.setdefault(frame_names[i], []).append((int(view_idx), i))
+            units_dict = {
+                seq_name: [[i for _, i in sorted(frames[frame])] for frame in sorted(frames.keys())]
+                for seq_name, frames in seq_dict.items()
+            }
+        else:
+            units_dict = {}
+            for i in indices:
+                units_dict.setdefault(seq_names[i], []).append([i])
+
+        chunks = []
+        for seq_name in sorted(units_dict.keys()):
+            units = units_dict[seq_name]
+            chunks += [units[i : i + self.chunk_size] for i in range(0, len(units), self.chunk_size)]
+        return chunks
+
+    def __iter__(self):
+        # deterministically shuffle based on epoch
+        g = torch.Generator()
+        g.manual_seed(self.epoch)
+        if self.shuffle:
+            order = torch.randperm(len(self.chunks), generator=g).tolist()
+        else:
+            order = range(len(self.chunks))
+
+        indices = []
+        for c in order:
+            chunk = self.chunks[c]
+            if self.shuffle and self.shuffle_in_chunk:
+                chunk = [chunk[i] for i in torch.randperm(len(chunk), generator=g).tolist()]
+            for unit in chunk:
+                indices += unit
+
+        # add extra samples to make it evenly divisible
+        indices += indices[:(self.total_size_parts - len(indices))]
+        assert len(indices) == self.total_size_parts
+
+        # subsample contiguous blocks, so chunks are not split across replicas
+        part_rank = self.rank // self.num_parts
+        offset = self.num_samples * part_rank
+        indices = indices[offset : offset + self.num_samples]
+        assert len(indices) == self.num_samples
+
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+def get_frame_names(dataset):
+    """Frame (image file name) of every item, see get_seq_names."""
+    if hasattr(dataset, 'windows'):
+        imgnames = [window[0] for window in dataset.windows]
+    else:
+        imgnames = dataset.imgnames
+    return [imgname.split("/")[-1] for imgname in imgnames]
@@ -16,6 +16,8 @@ import os.path
 import tqdm
 from io import BytesIO
 
+from util.shm_cache import SharedImageCache
+
 
 class CocoDetection(VisionDataset):
     """`MS Coco Detection <http://mscoco.org/dataset/#detections-challenge2016>`_ Dataset.
@@ -31,7 +33,7 @@ class CocoDetection(VisionDataset):
     """
 
     def __init__(self, root, annFile, transform=None, target_transform=None, transforms=None,
-                 cache_mode=False, local_rank=0, local_size=1):
+                 cache_mode=False, cache_size=16 * 2**30, local_rank=0, local_size=1):
         super(CocoDetection, self).__init__(root, transforms, transform, target_transform)
         from pycocotools.coco import COCO
         self.coco = COCO(annFile)
@@ -40,24 +42,23 @@ class CocoDetection(VisionDataset):
         self.local_rank = local_rank
         self.local_size = local_size
         if cache_mode:
-            self.cache = {}
+            self.cache = SharedImageCache(cache_size)
             self.cache_images()
 
     def cache_images(self):
-        self.cache = {}
-        for index, img_id in zip(tqdm.trange(len(self.ids)), self.ids):
+        # each local rank adds its share of the images to the node-wide cache
+        paths = []
+        for index, img_id in enumerate(self.ids):
             if index % self.local_size != self.local_rank:
                 continue
-            path = self.coco.loadImgs(img_id)[0]['file_name']
-            with open(os.path.join(self.root, path), 'rb') as f:
-                self.cache[path] = f.read()
+            paths.append(os.path.join(self.root, self.coco.loadImgs(img_id)[0]['file_name']))
+        self.cache.preload(tqdm.tqdm(paths))
 
     def get_image(self, path):
         if self.cache_mode:
-            if path not in self.cache.keys():
-                with open(os.path.join(self.root, path), 'rb') as f:
-                    self.cache[path] = f.read()
-            return Image.open(BytesIO(self.cache[path])).convert('RGB')
+            return self.cache.load(
+                os.path.join(self.root, path), lambda buf: Image.open(BytesIO(buf)).convert('RGB')
+            )
         if str(self.root).split('/')[-1] == 'FPHA':
             return Image.open(os.path.join(self.root, 'Video_files', path)).convert('RGB')
         return Image.open(os.path.join(self.root, path)).convert('RGB')
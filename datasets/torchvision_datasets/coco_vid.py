@@ -24,6 +24,8 @@ import math
 import trimesh
 import pickle
 
+from util.shm_cache import SharedImageCache
+
 class CocoDetection_vid(VisionDataset):
     """`MS Coco Detection <http://mscoco.org/dataset/#detections-challenge2016>`_ Dataset.
     Args:
@@ -37,7 +39,7 @@ class CocoDetection_vid(VisionDataset):
             and returns a transformed version.
     """
     def __init__(self, root, annFile, transform=None, target_transform=None, transforms=None,
-                 cache_mode=False, local_rank=0, local_size=1, mode=None, args=None):
+                 cache_mode=False, cache_size=16 * 2**30, local_rank=0, local_size=1, mode=None, args=None):
         super(CocoDetection_vid, self).__init__(root, transforms, transform, target_transform)
         from pycocotools.coco import COCO
         self.coco = COCO(annFile)
@@ -56,7 +58,7 @@ class CocoDetection_vid(VisionDataset):
         self.local_rank = local_rank
         self.local_size = local_size
         if cache_mode:
-            self.cache = {}
+            self.cache = SharedImageCache(cache_size)
             self.cache_images()
 
         self.coco.imgs.keys()
@@ -64,20 +66,19 @@ class CocoDetection_vid(VisionDataset):
         self.dataset = args.dataset_file
 
     def cache_images(self):
-        self.cache = {}
-        for index, img_id in zip(tqdm.trange(len(self.ids)), self.ids):
+        # each local rank adds its share of the images to the node-wide cache
+        paths = []
+        for index, img_id in enumerate(self.ids):
             if index % self.local_size != self.local_rank:
                 continue
-            path = self.coco.loadImgs(img_id)[0]['file_name']
-            with open(os.path.join(self.root, path), 'rb') as f:
-                self.cache[path] = f.read()
+            paths.append(os.path.join(self.root, self.coco.loadImgs(img_id)[0]['file_name']))
+        self.cache.preload(tqdm.tqdm(paths))
 
     def get_image(self, path):
         if self.cache_mode:
-            if path not in self.cache.keys():
-                with open(os.path.join(self.root, path), 'rb') as f:
-                    self.cache[path] = f.read()
-            return Image.open(BytesIO(self.cache[path])).convert('RGB')
+            return self.cache.load(
+                os.path.join(self.root, path), lambda buf: Image.open(BytesIO(buf)).convert('RGB')
+            )
         return Image.open(os.path.join(self.root, path)).convert('RGB')
     
     def __getitem__(self, index):
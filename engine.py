@@ -14,12 +14,10 @@ Train and eval functions used in main.py
 import os
 import sys
 import math
-import wandb
 import torch
 import numpy as np
 from tqdm import tqdm
 from typing import Iterable
-import matplotlib.pyplot as plt
 
 import util.misc as utils
 from datasets.data_prefetcher import data_prefetcher
@@ -27,16 +25,25 @@ from datasets.arctic_prefetcher import data_prefetcher as arctic_prefetcher
 
 from arctic_tools.common.torch_utils import nanmean
 from arctic_tools.common.xdict import xdict
-from arctic_tools.visualizer import visualize_arctic_result
-from arctic_tools.process import arctic_pre_process, prepare_data, measure_error, get_arctic_item, make_output
+from arctic_tools.render_service import close_render_service
+from arctic_tools.process import (
+    arctic_pre_process, prepare_data, prepare_targets, measure_error, get_arctic_item, make_output, get_eval_fields,
+    post_process_arctic_output
+)
+from util.profiler import StageProfiler
+from util.base_cache import BaseOutputCache
 from util.tools import (
-    extract_feature, visualize_assembly_result, eval_assembly_result, stat_round,
-    create_loss_dict, create_arctic_score_dict, arctic_smoothing, save_results
+    extract_feature, visualize_assembly_result, AssemblyEvaluator, stat_round,
+    create_loss_dict, create_arctic_score_dict, arctic_smoothing, save_results, extract_epoch
 )
 from torch.cuda.amp import autocast
 # os.environ["CUB_HOME"] = os.getcwd() + '/cub-1.10.0'
 
-from datasets.coco_eval import CocoEvaluator
+
+def visualize_arctic_result(args, data, flag):
+    # the viewer (aitviewer, OpenGL) is only loaded when a result is rendered
+    from arctic_tools.visualizer import visualize_arctic_result as _visualize_arctic_result
+    return _visualize_arctic_result(args, data, flag)
 
 def to_device(item, device):
     if isinstance(item, torch.Tensor):
@@ -49,6 +56,76 @@ def to_device(item, device):
         raise NotImplementedError("Call Shilong if you use other containers! type: {}".format(type(item)))
 
 
+def sync_loss_stats(loss_tracker, weight_dict, metric_logger):
+    '''
+    Reduce the loss terms accumulated by "loss_tracker" and log them.
+    Non-finite steps were already skipped by "utils.guarded_step"; training stops if every step of the window was.
+    :return: total scaled loss and scaled loss terms, or (None, None) if nothing was accumulated.
+    '''
+    loss_dict_reduced, n, skipped = loss_tracker.sync()
+    if loss_dict_reduced is None:
+        return None, None
+    if skipped > 0:
+        print(f"Skipped {skipped} steps with non-finite gradients")
+    loss_dict_reduced_unscaled = {f'{k}_unscaled': v
+                                  for k, v in loss_dict_reduced.items() if k != 'grad_norm'}
+    loss_dict_reduced_scaled = {k: v * weight_dict[k]
+                                for k, v in loss_dict_reduced.items() if k in weight_dict}
+    loss_value = sum(loss_dict_reduced_scaled.values())
+
+    if skipped >= n * utils.get_world_size() or not math.isfinite(loss_value):
+        print("Loss is not finite at any step of the last {} steps, stopping training".format(n))
+        for k,v in (loss_dict_reduced.items()):
+            print(f'{k} : {v}')
+        sys.exit(1)
+
+    metric_logger.update(n=n, loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
+    for k in ['class_error', 'grad_norm']:
+        if k in loss_dict_reduced:
+            metric_logger.update(n=n, **{k: loss_dict_reduced[k]})
+    return loss_value, loss_dict_reduced_scaled
+
+
+def find_unused_parameters(model, criterion, data_loader, device, args, num_steps=2):
+    '''
+    Run a few training steps without updating the model and find parameters that never receive gradients.
+    In distributed mode, a parameter used on any process is kept.
+    :return: names of the unused parameters.
+    '''
+    assert args.dataset_file == 'arctic', 'Not implemented yet!'
+    model.train()
+    criterion.train()
+    weight_dict = criterion.weight_dict
+    names = [n for n, p in model.named_parameters() if p.requires_grad]
+    used = torch.zeros(len(names), device=device)
+
+    prefetcher = arctic_prefetcher(data_loader, device, prefetch=(device.type == 'cuda'))
+    for _ in range(num_steps):
+        samples, targets, meta_info = prefetcher.next()
+        if samples is None:
+            break
+        targets, meta_info = arctic_pre_process(args, targets, meta_info)
+        if args.modelname == 'dino':
+            outputs = model(samples, targets=targets)
+        else:
+            outputs = model(samples)
+        loss_dict = criterion(outputs, targets, args, meta_info)
+        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+
+        model.zero_grad(set_to_none=True)
+        losses.backward()
+        params = dict(model.named_parameters())
+        for idx, n in enumerate(names):
+            if params[n].grad is not None:
+                used[idx] = 1
+    model.zero_grad(set_to_none=True)
+
+    if utils.is_dist_avail_and_initialized():
+        torch.distributed.all_reduce(used, op=torch.distributed.ReduceOp.MAX)
+    used = used.tolist()
+    return [n for n, u in zip(names, used) if u == 0]
+
+
 def train_dn(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, max_norm: float = 0, 
@@ -72,8 +149,12 @@ def train_dn(model: torch.nn.Module, criterion: torch.nn.Module,
     prefetcher = arctic_prefetcher(data_loader, device, prefetch=True)
     samples, targets, meta_info = prefetcher.next()
     pbar = tqdm(range(len(data_loader)))
+    loss_tracker = utils.LossTracker(sync_freq=args.log_freq)
+    loss_value = None
+    profiler = StageProfiler(args.profile, device)
 
     for _ in pbar:
+        profiler.tick()
         # test_debug(args, targets, samples, B=0, h=224, w=224)
 
         # # from cfg import Config
@@ -89,10 +170,12 @@ def train_dn(model: torch.nn.Module, criterion: torch.nn.Module,
         # continue
 
         targets, meta_info = arctic_pre_process(args, targets, meta_info)
+        profiler.mark('pre_process')
 
         # with torch.cuda.amp.autocast(enabled=args.amp):
         if need_tgt_for_training:
             outputs = model(samples, targets=targets) 
+            profiler.mark('forward')
 
             # if outputs['dn_meta']['output_known_lbs_bboxes']['pred_logits'].isnan().sum() != 0:
             #     outputs = model(samples, targets=targets) 
@@ -111,22 +194,7 @@ def train_dn(model: torch.nn.Module, criterion: torch.nn.Module,
             if len(v.shape) == 1:
                 loss_dict[k] = v[0]
 
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        loss_dict_reduced_unscaled = {f'{k}_unscaled': v
-                                      for k, v in loss_dict_reduced.items()}
-        loss_dict_reduced_scaled = {k: v * weight_dict[k]
-                                    for k, v in loss_dict_reduced.items() if k in weight_dict}
-        losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
-
-        loss_value = losses_reduced_scaled.item()
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            for k,v in (loss_dict_reduced.items()):
-                print(f'{k} : {v.item()}')
-            sys.exit(1)
-
+        profiler.mark('criterion')
 
         # amp backward function
         if args.amp:
@@ -142,31 +210,44 @@ def train_dn(model: torch.nn.Module, criterion: torch.nn.Module,
             # original backward function
             optimizer.zero_grad()
             losses.backward()
+            profiler.mark('backward')
             if max_norm > 0:
-                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-            optimizer.step()
+                grad_total_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+            else:
+                grad_total_norm = utils.get_total_grad_norm(model.parameters())
+            # the gradients are reduced over all GPUs, so every process skips the same steps
+            finite = torch.isfinite(grad_total_norm)
+            utils.guarded_step(optimizer, finite)
 
         if args.onecyclelr:
             lr_scheduler.step()
+        profiler.mark('optimizer')
 
-        metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
-        if 'class_error' in loss_dict_reduced:
-            metric_logger.update(class_error=loss_dict_reduced['class_error'])
+        # accumulate losses on device, they are reduced over all GPUs every "log_freq" steps
+        loss_tracker.update(loss_dict, valid=finite)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
-        
+        if loss_tracker.should_sync():
+            loss_value, loss_dict_reduced_scaled = sync_loss_stats(loss_tracker, weight_dict, metric_logger)
+            pbar.set_postfix(
+                create_loss_dict(
+                    loss_value, loss_dict_reduced_scaled,
+                    round_value=True, mode='small'
+                )
+            )
+        profiler.mark('logging')
+
         if args.debug:
             if _ == args.num_debug:
                 print("BREAK!"*5)
                 break
 
-        pbar.set_postfix(
-            create_loss_dict(
-                loss_value, loss_dict_reduced_scaled,
-                round_value=True, mode='small'
-            )
-        )
         samples, targets, meta_info = prefetcher.next()        
+        profiler.mark('data')
 
+    # flush the last window
+    last_value = sync_loss_stats(loss_tracker, weight_dict, metric_logger)[0]
+    if last_value is not None:
+        loss_value = last_value
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -175,10 +256,42 @@ def train_dn(model: torch.nn.Module, criterion: torch.nn.Module,
 
     # save results
     save_results(args, epoch, result, train_stat, flag='train')
+    profiler.export(args, epoch, flag='train')
     return train_stat
 
 
 @torch.no_grad()
+def early_exit_stats(model, samples, outputs, targets, meta_info, stats, cfg, args, fields=None, **kwargs):
+    '''
+    Number of decoder layers used with --early_exit. With --early_exit_compare, the full decoder also runs on the batch
+    and "delta/<metric>" is the change of each metric caused by the early exit.
+    '''
+    if 'dec_layers' not in outputs:
+        return stats
+    stats.overwrite('dec_layers', float(outputs['dec_layers']))
+    if not args.early_exit_compare:
+        return stats
+
+    net = model.module if hasattr(model, 'module') else model
+    threshold, net.early_exit = net.early_exit, 0.0
+    full_outputs = model(samples, **kwargs)
+    net.early_exit = threshold
+
+    pred = post_process_arctic_output(full_outputs, meta_info, args, cfg)
+    data = prepare_data(args, None, targets, meta_info, cfg, pred=pred, fields=fields)
+    if args.iter > 0:
+        cnt = args.iter
+        data.overwrite("pred.object.v.cam", arctic_smoothing(data["pred.object.v.cam"], cnt))
+        data.overwrite("pred.mano.v3d.cam.r", arctic_smoothing(data["pred.mano.v3d.cam.r"], cnt))
+        data.overwrite("pred.mano.v3d.cam.l", arctic_smoothing(data["pred.mano.v3d.cam.l"], cnt))
+    full_stats = measure_error(data, args.eval_metrics)
+    for k, v in full_stats.items():
+        not_non_idx = ~np.isnan(v)
+        if k in stats and not_non_idx.any():
+            stats.overwrite(f'delta/{k}', stats[k] - float(v[not_non_idx].mean()))
+    return stats
+
+
 def eval_dn(model, cfg, data_loader, device, wo_class_error=False, args=None, vis=None, epoch=None):
     try:
         need_tgt_for_training = args.use_dn
@@ -201,8 +314,11 @@ def eval_dn(model, cfg, data_loader, device, wo_class_error=False, args=None, vi
 
     # start test
     pbar = tqdm(range(len(data_loader)))
+    profiler = StageProfiler(args.profile, device)
     for _ in pbar:
+        profiler.tick()
         targets, meta_info = arctic_pre_process(args, targets, meta_info)
+        profiler.mark('pre_process')
 
         # implement & calc loss
         # with torch.cuda.amp.autocast(enabled=args.amp):
@@ -210,9 +326,11 @@ def eval_dn(model, cfg, data_loader, device, wo_class_error=False, args=None, vi
             outputs = model(samples, targets=targets)
         else:
             outputs = model(samples)
+        profiler.mark('forward')
 
         # vis or measure error
-        data = prepare_data(args, outputs, targets, meta_info, cfg)
+        data = prepare_data(args, outputs, targets, meta_info, cfg, fields=get_eval_fields(args, vis))
+        profiler.mark('prepare_data')
         if vis:
             visualize_arctic_result(args, data, 'pred')
         else:
@@ -222,6 +340,7 @@ def eval_dn(model, cfg, data_loader, device, wo_class_error=False, args=None, vi
                 data.overwrite("pred.object.v.cam", arctic_smoothing(data["pred.object.v.cam"], cnt))
                 data.overwrite("pred.mano.v3d.cam.r", arctic_smoothing(data["pred.mano.v3d.cam.r"], cnt))
                 data.overwrite("pred.mano.v3d.cam.l", arctic_smoothing(data["pred.mano.v3d.cam.l"], cnt))
+                profiler.mark('smoothing')
 
             # measure error
             try:
@@ -229,6 +348,7 @@ def eval_dn(model, cfg, data_loader, device, wo_class_error=False, args=None, vi
             except:
                 print('Fail to mesure the data of last iteration.')
                 break
+            profiler.mark('measure_error')
             
             # drop na
             for k,v in stats.items():
@@ -239,6 +359,12 @@ def eval_dn(model, cfg, data_loader, device, wo_class_error=False, args=None, vi
                     stats = stats.rm(k)
                 else:
                     stats.overwrite(k, replace_value)
+            if need_tgt_for_training:
+                stats = early_exit_stats(model, samples, outputs, targets, meta_info, stats, cfg, args,
+                                         fields=get_eval_fields(args, vis), targets=targets)
+            else:
+                stats = early_exit_stats(model, samples, outputs, targets, meta_info, stats, cfg, args,
+                                         fields=get_eval_fields(args, vis))
             
             # debug
             pbar.set_postfix(stat_round(**stats))
@@ -249,19 +375,108 @@ def eval_dn(model, cfg, data_loader, device, wo_class_error=False, args=None, vi
                 print("BREAK!"*5)
                 break
         samples, targets, meta_info = prefetcher.next()
+        profiler.mark('data')
+
+    # wait for the headless renderer
+    close_render_service()
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     stats = {k: meter.global_avg for k, meter in metric_logger.meters.items() if meter.count > 0}
 
     save_results(args, epoch, create_arctic_score_dict(stats), stats, flag='eval')
+    profiler.export(args, epoch, flag='eval')
     return stats
 
 
+@torch.no_grad()
+def eval_checkpoints(models, names, cfg, data_loader, device, args=None):
+    '''
+    Evaluate several checkpoints in a single pass over the validation set.
+    Each batch is loaded, pre-processed and its targets are prepared once, then every model runs on it.
+    Results of each checkpoint are saved in the same way as "eval_dn" and "test_pose".
+    :param models: models loaded with the checkpoints.
+    :param names: checkpoint paths, used for the epoch of each result.
+    :return: list of stats, one per checkpoint.
+    '''
+    assert args.dataset_file == 'arctic', 'Not implemented yet!'
+    need_tgt = args.modelname == 'dino' and getattr(args, 'use_dn', False)
+    for model in models:
+        model.eval()
+
+    prefetcher = arctic_prefetcher(data_loader, device, prefetch=True)
+    samples, targets, meta_info = prefetcher.next()
+    metric_loggers = [utils.MetricLogger(delimiter="  ") for _ in models]
+    fields = get_eval_fields(args)
+    print('Test:')
+
+    pbar = tqdm(range(len(data_loader)))
+    for _ in pbar:
+        targets, meta_info = arctic_pre_process(args, targets, meta_info)
+
+        gt = None
+        failed = False
+        for model, metric_logger in zip(models, metric_loggers):
+            if need_tgt:
+                outputs = model(samples, targets=targets)
+            else:
+                outputs = model(samples)
+
+            pred = post_process_arctic_output(outputs, meta_info, args, cfg)
+            if gt is None:
+                gt = prepare_targets(args, targets, meta_info, list(pred.keys()), fields=fields)
+            data = prepare_data(args, None, targets, meta_info, cfg, pred=pred, gt=gt, fields=fields)
+
+            # smoothing
+            if args.iter > 0:
+                cnt = args.iter
+                data.overwrite("pred.object.v.cam", arctic_smoothing(data["pred.object.v.cam"], cnt))
+                data.overwrite("pred.mano.v3d.cam.r", arctic_smoothing(data["pred.mano.v3d.cam.r"], cnt))
+                data.overwrite("pred.mano.v3d.cam.l", arctic_smoothing(data["pred.mano.v3d.cam.l"], cnt))
+
+            # measure error
+            try:
+                stats = measure_error(data, args.eval_metrics)
+            except:
+                print('Fail to mesure the data of last iteration.')
+                failed = True
+                break
+
+            # drop na
+            for k,v in stats.items():
+                not_non_idx = ~np.isnan(stats[k])
+                replace_value = float(stats[k][not_non_idx].mean())
+                # If all values are nan, drop that key.
+                if replace_value != replace_value:
+                    stats = stats.rm(k)
+                else:
+                    stats.overwrite(k, replace_value)
+            metric_logger.update(**stats)
+        if failed:
+            break
+
+        if args.debug:
+            if _ == args.num_debug:
+                print("BREAK!"*5)
+                break
+        samples, targets, meta_info = prefetcher.next()
+
+    # gather the stats from all processes
+    results = []
+    for name, metric_logger in zip(names, metric_loggers):
+        metric_logger.synchronize_between_processes()
+        stats = {k: meter.global_avg for k, meter in metric_logger.meters.items() if meter.count > 0}
+        print(f"\n{'='*10} current epoch :{extract_epoch(name)} {'='*10}")
+        save_results(args, extract_epoch(name), create_arctic_score_dict(stats), stats, flag='eval')
+        results.append(stats)
+    return results
+
+
 # just testing
 def test_debug(args, targets, samples, B=0, h=224, w=224):
     from arctic_tools.common.data_utils import denormalize_images
     from PIL import Image
+    import matplotlib.pyplot as plt
     import cv2
 
     root = os.path.join(args.coco_path, args.dataset_file)
@@ -289,8 +504,43 @@ def test_debug(args, targets, samples, B=0, h=224, w=224):
     # continue
 
 
+def run_base_model(base_model, samples, imgnames, cfg, args=None):
+    # windows repeat frames (padding, overlap), run the base model once per frame
+    rows = {}
+    for idx, imgname in enumerate(imgnames):
+        rows.setdefault(imgname, idx)
+    if len(rows) == len(imgnames):
+        return get_arctic_item(base_model(samples), cfg, args.device)
+
+    keep = torch.LongTensor(list(rows.values()))
+    order = {imgname: idx for idx, imgname in enumerate(rows.keys())}
+    inverse = torch.LongTensor([order[imgname] for imgname in imgnames]).to(args.device)
+    if isinstance(samples, (list, tuple)):
+        samples = [sample[keep.to(sample.device)] for sample in samples]
+    else:
+        samples = samples[keep.to(samples.device)]
+    arctic_out = get_arctic_item(base_model(samples), cfg, args.device)
+    return [[param[inverse] for param in group] for group in arctic_out]
+
+
+def build_base_cache(base_model, data_loader, device, cfg, args=None):
+    base_model.eval()
+    cache = BaseOutputCache()
+
+    prefetcher = arctic_prefetcher(data_loader, device, prefetch=(torch.device(device).type == 'cuda'))
+    samples, targets, meta_info = prefetcher.next()
+    pbar = tqdm(range(len(data_loader)))
+
+    for _ in pbar:
+        with torch.no_grad():
+            cache.add(meta_info["imgname"], run_base_model(base_model, samples, meta_info["imgname"], cfg, args))
+        samples, targets, meta_info = prefetcher.next()
+    return cache
+
+
 def train_smoothnet(
-        base_model, smoothnet, criterion, data_loader, optimizer, device, epoch, max_norm=0, args=None, cfg=None
+        base_model, smoothnet, criterion, data_loader, optimizer, device, epoch, max_norm=0, args=None, cfg=None,
+        base_cache=None
     ):
     # set model and criterion
     base_model.eval()
@@ -305,7 +555,7 @@ def train_smoothnet(
     print(header)
 
     # prefetcher settings
-    prefetcher = arctic_prefetcher(data_loader, device, prefetch=True)
+    prefetcher = arctic_prefetcher(data_loader, device, prefetch=(torch.device(device).type == 'cuda'))
     samples, targets, meta_info = prefetcher.next()
     # pbar = tqdm(data_loader)
     pbar = tqdm(range(len(data_loader)))
@@ -324,9 +574,10 @@ def train_smoothnet(
             # targets = xdict(targets).to(device)
             # meta_info = xdict(meta_info).to(device)            
             targets, meta_info = arctic_pre_process(args, targets, meta_info)
-            outputs = base_model(samples)
-
-            arctic_out = get_arctic_item(outputs, cfg, args.device)
+            if base_cache is not None:
+                arctic_out = base_cache.get(meta_info["imgname"], device)
+            else:
+                arctic_out = run_base_model(base_model, samples, meta_info["imgname"], cfg, args)
 
             # # select query
             # base_out = get_arctic_item(outputs, cfg, args.device)
@@ -338,8 +589,8 @@ def train_smoothnet(
                 for p_idx, param in enumerate(out):
                     s = scale[idx][p_idx] if isinstance(scale[idx], list) else scale[idx]
 
-                    mask = torch.cuda.FloatTensor(param.shape).uniform_() > (1-p_mask)
-                    param[mask] += torch.randn(param[mask].shape).cuda() * s
+                    mask = torch.rand_like(param) > (1-p_mask)
+                    param[mask] += torch.randn_like(param[mask]) * s
 
         # query_names = meta_info["query_names"]
         # K = meta_info["intrinsics"]
@@ -432,15 +683,21 @@ def train_smoothnet(
     return train_stat
 
 
-def test_smoothnet(base_model, smoothnet, data_loader, device, cfg, args=None, vis=False, epoch=None):
+def test_smoothnet(base_model, smoothnet, data_loader, device, cfg, args=None, vis=False, epoch=None, base_cache=None):
     # set model and criterion
     base_model.eval()
     smoothnet.eval()
 
     # prefetcher settings
-    prefetcher = arctic_prefetcher(data_loader, device, prefetch=True)
+    prefetcher = arctic_prefetcher(data_loader, device, prefetch=(torch.device(device).type == 'cuda'))
     samples, targets, meta_info = prefetcher.next()
 
+    # smooth whole sequences of the cache at once, with overlapping windows
+    smoothed_cache = None
+    if base_cache is not None and args.smooth_stride > 0:
+        with torch.no_grad():
+            smoothed_cache = base_cache.smoothed(smoothnet, device, stride=args.smooth_stride)
+
     # set logger
     metric_logger = utils.MetricLogger(delimiter="  ")
     pbar = tqdm(range(len(data_loader)))
@@ -451,16 +708,19 @@ def test_smoothnet(base_model, smoothnet, data_loader, device, cfg, args=None, v
 
         with torch.no_grad():
             # Inference baseline model
-            outputs = base_model(samples)
-
-            # select query
-            base_out = get_arctic_item(outputs, cfg, args.device)
-            smoothed_out = smoothnet(base_out)
+            if smoothed_cache is not None:
+                smoothed_out = smoothed_cache.get(meta_info["imgname"], device)
+            else:
+                if base_cache is not None:
+                    base_out = base_cache.get(meta_info["imgname"], device)
+                else:
+                    base_out = run_base_model(base_model, samples, meta_info["imgname"], cfg, args)
+                smoothed_out = smoothnet(base_out)
 
             query_names = meta_info["query_names"]
             K = meta_info["intrinsics"]
             pred = make_output(args, *smoothed_out, query_names, K)
-            data = prepare_data(args, None, targets, meta_info, cfg, pred=pred)
+            data = prepare_data(args, None, targets, meta_info, cfg, pred=pred, fields=get_eval_fields(args, vis))
 
             # # # base output test
             # # # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!반드시 수정!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
@@ -505,6 +765,11 @@ def test_smoothnet(base_model, smoothnet, data_loader, device, cfg, args=None, v
             # measure error
             else:
                 stats = measure_error(data, args.eval_metrics)
+                # stitch the windows: every frame is measured once, on the window that keeps it
+                if "window_valid" in meta_info:
+                    window_valid = meta_info["window_valid"].cpu().numpy() > 0
+                    for k in stats.keys():
+                        stats[k][~window_valid] = np.nan
                 for k,v in stats.items():
                     not_non_idx = ~np.isnan(stats[k])
                     replace_value = float(stats[k][not_non_idx].mean())
@@ -524,6 +789,9 @@ def test_smoothnet(base_model, smoothnet, data_loader, device, cfg, args=None, v
         # next step
         samples, targets, meta_info = prefetcher.next()
 
+    # wait for the headless renderer
+    close_render_service()
+
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
@@ -534,7 +802,8 @@ def test_smoothnet(base_model, smoothnet, data_loader, device, cfg, args=None, v
 
 def train_pose(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
-                    device: torch.device, epoch: int, max_norm: float = 0, args=None, cfg=None, lr_scheduler=None):
+                    device: torch.device, epoch: int, max_norm: float = 0, args=None, cfg=None, lr_scheduler=None,
+                    distiller=None):
     # scaler = torch.cuda.amp.GradScaler(enabled=True)
 
     model.train()
@@ -556,8 +825,12 @@ def train_pose(model: torch.nn.Module, criterion: torch.nn.Module,
         prefetcher = data_prefetcher(data_loader, device, prefetch=True)
         samples, targets = prefetcher.next()
     pbar = tqdm(range(len(data_loader)))
+    loss_tracker = utils.LossTracker(sync_freq=args.log_freq)
+    loss_value = None
+    profiler = StageProfiler(args.profile, device)
 
     for _ in pbar:
+        profiler.tick()
         # not exist images
         if samples is None:
             samples, targets = prefetcher.next()
@@ -566,6 +839,7 @@ def train_pose(model: torch.nn.Module, criterion: torch.nn.Module,
         # arctic pre process
         if args.dataset_file == 'arctic':
             targets, meta_info = arctic_pre_process(args, targets, meta_info)
+        profiler.mark('pre_process')
 
         # for feature map extraction mode
         if args.extract:
@@ -584,10 +858,13 @@ def train_pose(model: torch.nn.Module, criterion: torch.nn.Module,
         # with torch.cuda.amp.autocast(enabled=True):
         # Training script begin from here
         outputs = model(samples)
+        profiler.mark('forward')
 
         if args.dataset_file == 'arctic':
             # data = prepare_data(args, outputs, targets, meta_info, cfg)
             loss_dict = criterion(outputs, targets, args, meta_info)
+            if distiller is not None:
+                loss_dict.update(distiller(samples, outputs, meta_info, args))
         else:
             # check validation
             for i in range(len(targets)):
@@ -603,28 +880,13 @@ def train_pose(model: torch.nn.Module, criterion: torch.nn.Module,
         # calc losses
         weight_dict = criterion.weight_dict
         losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+        profiler.mark('criterion')
 
         # for arctic
         for k, v in loss_dict.items():
             if len(v.shape) == 1:
                 loss_dict[k] = v[0]
 
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        loss_dict_reduced_unscaled = {f'{k}_unscaled': v
-                                    for k, v in loss_dict_reduced.items()}
-        loss_dict_reduced_scaled = {k: v * weight_dict[k]
-                                    for k, v in loss_dict_reduced.items() if k in weight_dict}
-        losses_reduced_scaled = sum(loss_dict_reduced_scaled.values())
-        loss_value = losses_reduced_scaled.item()
-
-        # loss check
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            for k,v in (loss_dict_reduced.items()):
-                print(f'{k} : {v.item()}')
-            sys.exit(1)
-
         # back propagation
         # if scaler is not None:
         #     optimizer.zero_grad()
@@ -637,48 +899,61 @@ def train_pose(model: torch.nn.Module, criterion: torch.nn.Module,
         # else:        
         optimizer.zero_grad()
         losses.backward()
+        profiler.mark('backward')
         if max_norm > 0:
             grad_total_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
         else:
-            grad_total_norm = utils.get_total_grad_norm(model.parameters(), max_norm)
-        optimizer.step()
+            # L2 norm, as clip_grad_norm_ (the second argument is the norm type)
+            grad_total_norm = utils.get_total_grad_norm(model.parameters())
+        # the gradients are reduced over all GPUs, so every process skips the same steps
+        finite = torch.isfinite(grad_total_norm)
+        utils.guarded_step(optimizer, finite)
 
         if args.onecyclelr:
             lr_scheduler.step()
+        profiler.mark('optimizer')
 
-        # logger update
-        metric_logger.update(loss=loss_value, **loss_dict_reduced_scaled, **loss_dict_reduced_unscaled)
+        # logger update, losses are accumulated on device and reduced over all GPUs every "log_freq" steps
+        loss_tracker.update({**loss_dict, 'grad_norm': grad_total_norm}, valid=finite)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(backbone_lr=optimizer.param_groups[1]["lr"])
-        metric_logger.update(grad_norm=grad_total_norm)
-        if args.dataset_file == 'AssemblyHands':
-            metric_logger.update(class_error=loss_dict_reduced['class_error'])
+        if loss_tracker.should_sync():
+            loss_value, loss_dict_reduced_scaled = sync_loss_stats(loss_tracker, weight_dict, metric_logger)
+            if args.dataset_file == 'arctic':
+                pbar.set_postfix(
+                    create_loss_dict(
+                        loss_value, loss_dict_reduced_scaled,
+                        round_value=True, mode='small'
+                    )
+                )
+            elif args.dataset_file == 'AssemblyHands':
+                pbar.set_postfix({
+                    'loss' : loss_value,
+                    'ce_loss' : loss_dict_reduced_scaled['loss_ce'],
+                    'hand': loss_dict_reduced_scaled['loss_hand_keypoint'], 
+                })
+        profiler.mark('logging')
 
         # for early stop
         if args.debug:
             if args.num_debug == _:
                 break
 
-        # for debug
+        # next samples
         if args.dataset_file == 'arctic':
-            pbar.set_postfix(
-                create_loss_dict(
-                    loss_value, loss_dict_reduced_scaled,
-                    round_value=True, mode='small'
-                )
-            )
             samples, targets, meta_info = prefetcher.next()
         elif args.dataset_file == 'AssemblyHands':
-            pbar.set_postfix({
-                'loss' : loss_value,
-                'ce_loss' : loss_dict_reduced_scaled['loss_ce'].item(),
-                'hand': loss_dict_reduced_scaled['loss_hand_keypoint'].item(), 
-            })
             samples, targets = prefetcher.next()
+        profiler.mark('data')
 
     if args.extract:
         return 0
 
+    # flush the last window
+    last_value = sync_loss_stats(loss_tracker, weight_dict, metric_logger)[0]
+    if last_value is not None:
+        loss_value = last_value
+
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     train_stat = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
@@ -687,6 +962,7 @@ def train_pose(model: torch.nn.Module, criterion: torch.nn.Module,
 
     # for wandb
     save_results(args, epoch, result, train_stat, flag='train')
+    profiler.export(args, epoch, flag='train')
     return train_stat
 
 
@@ -701,14 +977,20 @@ def test_pose(model, data_loader, device, cfg, args=None, vis=False, save_pickle
         prefetcher = data_prefetcher(data_loader, device, prefetch=True)
         samples, targets = prefetcher.next()
 
+    if args.dataset_file == 'AssemblyHands':
+        evaluator = AssemblyEvaluator(data_loader.dataset, cfg, device)
+
     metric_logger = utils.MetricLogger(delimiter="  ")
     pbar = tqdm(range(len(data_loader)))
     header = 'Test:'
     print(header)
+    profiler = StageProfiler(args.profile, device)
 
     for _ in pbar:
+        profiler.tick()
         if args.dataset_file == 'arctic':
             targets, meta_info = arctic_pre_process(args, targets, meta_info)
+        profiler.mark('pre_process')
 
         # for feature map extraction mode
         if args.extract:
@@ -727,9 +1009,11 @@ def test_pose(model, data_loader, device, cfg, args=None, vis=False, save_pickle
         # Testing script begin from here
         # with torch.cuda.amp.autocast(enabled=True):
         outputs = model(samples)
+        profiler.mark('forward')
 
         if args.dataset_file == 'arctic':
-            data = prepare_data(args, outputs, targets, meta_info, cfg)
+            data = prepare_data(args, outputs, targets, meta_info, cfg, fields=get_eval_fields(args, args.visualization))
+            profiler.mark('prepare_data')
 
             # cnt = args.iter
             # data.overwrite("pred.object.v.cam", arctic_smoothing(data["pred.object.v.cam"], cnt))
@@ -745,7 +1029,7 @@ def test_pose(model, data_loader, device, cfg, args=None, vis=False, save_pickle
         else:
             if args.dataset_file == 'AssemblyHands':
                 # measure error
-                stats = eval_assembly_result(outputs, targets, cfg, data_loader)
+                stats = evaluator.update(outputs, targets, cfg)
 
                 pbar.set_postfix({
                     'MPJPE': stats['mpjpe'],
@@ -788,9 +1072,12 @@ def test_pose(model, data_loader, device, cfg, args=None, vis=False, save_pickle
                         stats = stats.rm(k)
                     else:
                         stats.overwrite(k, replace_value)
+                stats = early_exit_stats(model, samples, outputs, targets, meta_info, stats, cfg, args,
+                                         fields=get_eval_fields(args, args.visualization))
 
                 pbar.set_postfix(stat_round(**stats))
             metric_logger.update(**stats)
+            profiler.mark('measure_error')
 
         if args.debug == True:
             if args.num_debug == _:
@@ -800,14 +1087,23 @@ def test_pose(model, data_loader, device, cfg, args=None, vis=False, save_pickle
             samples, targets, meta_info = prefetcher.next()
         else:
             samples, targets = prefetcher.next()
+        profiler.mark('data')
+
+    # wait for the headless renderer
+    close_render_service()
 
     if args.extract:
         return 0
 
     metric_logger.synchronize_between_processes()
     stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    if args.dataset_file == 'AssemblyHands' and not args.visualization:
+        # average over all hands of the split, instead of the average of batch averages
+        evaluator.synchronize_between_processes()
+        stats.update(evaluator.summarize())
 
     save_results(args, epoch, create_arctic_score_dict(stats), stats, flag='eval')         
+    profiler.export(args, epoch, flag='eval')
     return stats
 
 
@@ -834,6 +1130,7 @@ def eval_coco(model, criterion, postprocessors, data_loader, device, output_dir,
         useCats = True
     if not useCats:
         print("useCats: {} !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!".format(useCats))
+    from datasets.coco_eval import CocoEvaluator
     coco_evaluator = CocoEvaluator(data_loader.dataset.coco, 'bbox', useCats=useCats)
     # coco_evaluator.coco_eval[iou_types[0]].params.iouThrs = [0, 0.1, 0.5, 0.75]
 
@@ -1,12 +1,16 @@
+import os
 import json
 import os.path as op
 import sys
+import threading
+from queue import Queue
 from pprint import pformat
 import pickle
 
 import torch
 from loguru import logger
 from tqdm import tqdm
+from torch.utils.data import DataLoader, Subset
 
 from util.tools import arctic_smoothing
 from arctic_tools.common.torch_utils import nanmean
@@ -44,60 +48,203 @@ def make_stat(res, cnt):
     return mean_list, bound_list
 
 
-def main(args=None, wrapper=None, cfg=None):
+def seq_of(imgname):
+    '''
+    e.g) ./arctic_data/data/images/s05/box_grab_01/1/00010.jpg -> s05/box_grab_01
+    '''
+    return "/".join(imgname.split("/")[-4:-2])
+
+
+def load_manifest(out_dir):
+    manifest_p = op.join(out_dir, "manifest.json")
+    if not op.exists(manifest_p):
+        return []
+    with open(manifest_p, "r") as f:
+        return json.load(f)["done"]
+
+
+def update_manifest(out_dir, done):
+    # write-then-rename so that an interrupted run never leaves a broken manifest.
+    manifest_p = op.join(out_dir, "manifest.json")
+    tmp_p = manifest_p + ".tmp"
+    with open(tmp_p, "w") as f:
+        json.dump({"done": sorted(done)}, f, indent=2)
+    os.replace(tmp_p, manifest_p)
+
+
+class SequenceWriter(threading.Thread):
+    '''
+    Saves per-sequence results in the background, so that the GPU keeps running the next sequence.
+    A sequence is recorded in the manifest only after all of its files are written.
+    '''
+
+    def __init__(self, out_dir, interface, done, max_pending=2):
+        super().__init__(daemon=True)
+        self.out_dir = out_dir
+        self.interface = interface
+        self.done = list(done)
+        self.queue = Queue(maxsize=max_pending)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # after a failure, keep consuming so that "put" and "close" never block on a full queue
+            if self.error is not None:
+                continue
+            seq, out_list = item
+            try:
+                out = self.interface.std_interface(out_list)
+                self.interface.save_results(out, self.out_dir)
+                self.done.append(seq)
+                update_manifest(self.out_dir, self.done)
+                logger.info(f"Done {seq}")
+            except Exception as e:
+                self.error = e
+
+    def put(self, seq, out_list):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((seq, out_list))
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def fetch_split_loader(args, factory, seqs):
+    '''
+    One dataloader for every sequence to export. Items are ordered by image name,
+    so that all frames of a sequence come out consecutively.
+    '''
+    if "submit_" in args.extraction_mode:
+        if args.method in ["arctic_sf", "field_sf"]:
+            DATASET = factory.ArcticDatasetEval
+        else:
+            DATASET = factory.TempoInferenceDatasetEval
+    else:
+        if args.method in ["arctic_sf", "field_sf"]:
+            DATASET = factory.ArcticDataset
+        else:
+            DATASET = factory.TempoInferenceDataset
+    dataset = DATASET(args=args, split=args.run_on, seq=None)
+
+    if hasattr(dataset, "windows"):
+        first_imgnames = [window[0] for window in dataset.windows]
+    else:
+        first_imgnames = dataset.imgnames
+    seqs = set(seqs)
+    indices = [idx for idx, imgname in enumerate(first_imgnames) if seq_of(imgname) in seqs]
+    indices.sort(key=lambda idx: first_imgnames[idx])
+
+    if type(dataset) in [factory.ArcticDataset, factory.ArcticDatasetEval]:
+        collate_fn = None
+    else:
+        collate_fn = factory.collate_custom_fn
+    return DataLoader(
+        dataset=Subset(dataset, indices),
+        batch_size=args.test_batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        pin_memory=True,
+        collate_fn=collate_fn,
+    )
+
+
+def export_predictions(args, wrapper, cfg, seqs, KEYS, out_dir):
+    '''
+    Production export path : model forward + make_output only.
+    Finished sequences are listed in "{out_dir}/manifest.json" and skipped when resuming.
+    '''
     import origin_arctic.common.thing as thing
     import origin_arctic.src.extraction.interface as interface
     import origin_arctic.src.factory as factory
     from origin_arctic.common.xdict import xdict
-    from origin_arctic.src.parsers.parser import construct_args
-    import origin_arctic.common.camera as camera
+    from arctic_tools.process import arctic_pre_process, post_process_arctic_output
+
+    done = load_manifest(out_dir)
+    todo = [seq for seq in seqs if seq not in done]
+    logger.info(f"Seqs to export ({len(todo)}/{len(seqs)}), {len(done)} already done")
+    if len(todo) == 0:
+        return
+
+    device = args.device
+    val_loader = fetch_split_loader(args, factory, todo)
+    overlap = 0 < getattr(args, "window_stride", 0) < args.window_size
+    os.makedirs(out_dir, exist_ok=True)
+    writer = SequenceWriter(out_dir, interface, done)
+    writer.start()
+
+    curr_seq = None
+    out_list = []
+    with torch.no_grad():
+        for batch in tqdm(val_loader, total=len(val_loader)):
+            inputs, targets, meta_info = thing.thing2dev(batch, device)
+            img = inputs["img"] if isinstance(inputs, dict) else inputs
+
+            # extract outputs
+            outputs = wrapper(img)
+            pred = post_process_arctic_output(outputs, meta_info, args, cfg)
+
+            out_dict = xdict(pred.prefix("pred."))
+            if "submit_" not in args.extraction_mode:
+                targets, meta_info = arctic_pre_process(args, targets, meta_info)
+                out_dict.merge(xdict(targets).prefix("targets."))
+            out_dict.merge(xdict(meta_info).prefix("meta_info."))
+            out_dict = out_dict.subset(KEYS).to("cpu")
+
+            # overlapping and padded frames of the windows are dropped, one prediction per frame is written
+            imgnames = out_dict["meta_info.imgname"]
+            if "window_valid" in meta_info:
+                valid = (meta_info["window_valid"].reshape(-1) > 0).tolist()
+            else:
+                assert not overlap, "--window_stride needs a dataset that returns \"window_valid\" to export."
+                valid = [True] * len(imgnames)
+
+            # a batch can cover the end of one sequence and the start of the next one
+            batch_seqs = [seq_of(imgname) for imgname in imgnames]
+            for seq in sorted(set(batch_seqs), key=batch_seqs.index):
+                if seq != curr_seq:
+                    if curr_seq is not None:
+                        writer.put(curr_seq, out_list)
+                    curr_seq = seq
+                    out_list = []
+                idx = [i for i, s in enumerate(batch_seqs) if s == seq and valid[i]]
+                if len(idx) == 0:
+                    continue
+                if len(idx) == len(batch_seqs):
+                    out_list.append(out_dict)
+                    continue
+                sub_dict = xdict()
+                for key, val in out_dict.items():
+                    if isinstance(val, torch.Tensor):
+                        sub_dict[key] = val[idx]
+                    else:
+                        sub_dict[key] = [val[i] for i in idx]
+                out_list.append(sub_dict)
+
+    if curr_seq is not None:
+        writer.put(curr_seq, out_list)
+    writer.close()
+    logger.info("Done")
+
+
+def inspect_predictions(args, wrapper, cfg, seqs):
+    '''
+    Debugging path : measure and visualize every batch of each sequence.
+    '''
+    import origin_arctic.common.thing as thing
+    import origin_arctic.src.factory as factory
     from arctic_tools.process import get_arctic_item, arctic_pre_process, make_output
-    from pytorch3d.transforms.rotation_conversions import axis_angle_to_matrix
-
-    args.experiment = None
-    args.exp_key = "xxxxxxx"
-
-    device = "cuda:0"
-    # wrapper.metric_dict = []
-
-    exp_key = op.abspath(args.load_ckpt).split("/")[-3]
-    if exp_key in model_dependencies.keys():
-        assert (
-            args.img_feat_version == model_dependencies[exp_key]
-        ), f"Image features used for training ({model_dependencies[exp_key]}) do not match the ones used for the current inference ({args.img_feat_version})"
-
-    out_dir = op.join(args.output_dir, "eval")
-
-    with open(
-        op.join(args.coco_path, args.dataset_file,f"data/arctic_data/data/splits_json/protocol_{args.setup}.json"), "r"
-    ) as f:
-        seqs = json.load(f)[args.run_on]
-
-    logger.info(f"Hyperparameters: \n {pformat(args)}")
-    logger.info(f"Seqs to process ({len(seqs)}): {seqs}")
-
-    if args.extraction_mode in ["eval_pose"]:
-        from origin_arctic.src.extraction.keys.eval_pose import KEYS
-    elif args.extraction_mode in ["eval_field"]:
-        from origin_arctic.src.extraction.keys.eval_field import KEYS
-    elif args.extraction_mode in ["submit_pose"]:
-        from origin_arctic.src.extraction.keys.submit_pose import KEYS
-    elif args.extraction_mode in ["submit_field"]:
-        from origin_arctic.src.extraction.keys.submit_field import KEYS
-    elif args.extraction_mode in ["feat_pose"]:
-        from origin_arctic.src.extraction.keys.feat_pose import KEYS
-    elif args.extraction_mode in ["feat_field"]:
-        from origin_arctic.src.extraction.keys.feat_field import KEYS
-    elif args.extraction_mode in ["vis_pose"]:
-        from origin_arctic.src.extraction.keys.vis_pose import KEYS
-    elif args.extraction_mode in ["vis_field"]:
-        from origin_arctic.src.extraction.keys.vis_field import KEYS
-    else:
-        assert False, f"Invalid extract ({args.extraction_mode})"
 
+    device = args.device
     for seq_idx, seq in enumerate(seqs):
         logger.info(f"Processing seq {seq} {seq_idx + 1}/{len(seqs)}")
-        out_list = []
         val_loader = factory.fetch_dataloader(args, "val", seq)
         # val_loader.dataset[0]
 
@@ -299,70 +446,6 @@ def main(args=None, wrapper=None, cfg=None):
                 #     # visualize_arctic_result(args, origin_data, 'pred')                    
                 # ####
 
-                continue
-                
-                root_l, root_r, root_o = root
-                mano_pose_l, mano_pose_r = mano_pose
-                mano_shape_l, mano_shape_r = mano_shape
-                obj_rot, obj_rad = obj
-
-                cam_t_l = camera.weak_perspective_to_perspective_torch(
-                    root_l, focal_length=avg_focal_length, img_res=args.img_res, min_s=0.1
-                )
-                cam_t_r = camera.weak_perspective_to_perspective_torch(
-                    root_r, focal_length=avg_focal_length, img_res=args.img_res, min_s=0.1
-                )
-                cam_t_o = camera.weak_perspective_to_perspective_torch(
-                    root_o, focal_length=avg_focal_length, img_res=args.img_res, min_s=0.1
-                )
-
-                mano_pose_r = axis_angle_to_matrix(mano_pose_r.reshape(-1, 3)).reshape(-1, 16, 3, 3)
-                mano_pose_l = axis_angle_to_matrix(mano_pose_l.reshape(-1, 3)).reshape(-1, 16, 3, 3)
-
-                # save
-                out_dict = {
-                    'pred.mano.cam_t.l' : cam_t_l.cpu(),
-                    'pred.mano.beta.l' : mano_shape_l.cpu(),
-                    'pred.mano.pose.l' : mano_pose_l.cpu(),
-                    'pred.mano.cam_t.r' : cam_t_r.cpu(),
-                    'pred.mano.beta.r' : mano_shape_r.cpu(),
-                    'pred.mano.pose.r' : mano_pose_r.cpu(),
-                    'pred.object.rot' : obj_rot.cpu(),
-                    'pred.object.cam_t' : cam_t_o.cpu(),
-                    'pred.object.radian' : obj_rad.cpu(),
-                    'meta_info.imgname' : meta_info['imgname']
-                }
-
-                if "submit_" not in args.extraction_mode:
-                    targets, meta_info = arctic_pre_process(args, targets, meta_info)
-
-                    out_dict['targets.mano.pose.r'] = targets['mano.pose.r']
-                    out_dict['targets.mano.pose.l'] = targets['mano.pose.l']
-                    out_dict['targets.mano.beta.r'] = targets['mano.beta.r']
-                    out_dict['targets.mano.beta.l'] = targets['mano.beta.l']
-                    out_dict['targets.object.radian'] = targets['object.radian']
-                    out_dict['targets.object.rot'] = targets['object.rot']
-                    out_dict['targets.is_valid'] = targets['is_valid']
-                    out_dict['targets.left_valid'] = targets['left_valid']
-                    out_dict['targets.right_valid'] = targets['right_valid']
-                    out_dict['targets.joints_valid_r'] = targets['joints_valid_r']
-                    out_dict['targets.joints_valid_l'] = targets['joints_valid_l']
-                    out_dict['targets.mano.cam_t.r'] = targets['mano.cam_t.r']
-                    out_dict['targets.mano.cam_t.l'] = targets['mano.cam_t.l']
-                    out_dict['targets.object.cam_t'] = targets['object.cam_t']
-                    out_dict['targets.object.bbox3d.cam'] = targets['object.bbox3d.cam']
-                    
-                    out_dict['meta_info.imgname'] = meta_info['imgname']
-                    out_dict['meta_info.query_names'] = meta_info['query_names']
-                    out_dict['meta_info.window_size'] = meta_info['window_size']
-                    out_dict['meta_info.center'] = meta_info['center']
-                    out_dict['meta_info.is_flipped'] = meta_info['is_flipped']
-                    out_dict['meta_info.rot_angle'] = meta_info['rot_angle']
-                    out_dict['meta_info.diameter'] = meta_info['diameter']
-
-                out_dict = xdict(out_dict)
-                out_dict = out_dict.subset(KEYS)
-                out_list.append(out_dict)
 
         # ####
 
@@ -393,11 +476,52 @@ def main(args=None, wrapper=None, cfg=None):
         #     pickle.dump([root, pose, shape, obj], f)
         # ####
 
-        continue
-        
-        out = interface.std_interface(out_list)
-        interface.save_results(out, out_dir)
-        logger.info("Done")
+
+def main(args=None, wrapper=None, cfg=None):
+    args.experiment = None
+    args.exp_key = "xxxxxxx"
+
+    # wrapper.metric_dict = []
+
+    exp_key = op.abspath(args.load_ckpt).split("/")[-3]
+    if exp_key in model_dependencies.keys():
+        assert (
+            args.img_feat_version == model_dependencies[exp_key]
+        ), f"Image features used for training ({model_dependencies[exp_key]}) do not match the ones used for the current inference ({args.img_feat_version})"
+
+    out_dir = op.join(args.output_dir, "eval")
+
+    with open(
+        op.join(args.coco_path, args.dataset_file,f"data/arctic_data/data/splits_json/protocol_{args.setup}.json"), "r"
+    ) as f:
+        seqs = json.load(f)[args.run_on]
+
+    logger.info(f"Hyperparameters: \n {pformat(args)}")
+    logger.info(f"Seqs to process ({len(seqs)}): {seqs}")
+
+    if args.extraction_mode in ["eval_pose"]:
+        from origin_arctic.src.extraction.keys.eval_pose import KEYS
+    elif args.extraction_mode in ["eval_field"]:
+        from origin_arctic.src.extraction.keys.eval_field import KEYS
+    elif args.extraction_mode in ["submit_pose"]:
+        from origin_arctic.src.extraction.keys.submit_pose import KEYS
+    elif args.extraction_mode in ["submit_field"]:
+        from origin_arctic.src.extraction.keys.submit_field import KEYS
+    elif args.extraction_mode in ["feat_pose"]:
+        from origin_arctic.src.extraction.keys.feat_pose import KEYS
+    elif args.extraction_mode in ["feat_field"]:
+        from origin_arctic.src.extraction.keys.feat_field import KEYS
+    elif args.extraction_mode in ["vis_pose"]:
+        from origin_arctic.src.extraction.keys.vis_pose import KEYS
+    elif args.extraction_mode in ["vis_field"]:
+        from origin_arctic.src.extraction.keys.vis_field import KEYS
+    else:
+        assert False, f"Invalid extract ({args.extraction_mode})"
+
+    if args.visualization:
+        inspect_predictions(args, wrapper, cfg, seqs)
+    else:
+        export_predictions(args, wrapper, cfg, seqs, KEYS, out_dir)
 
 
 if __name__ == "__main__":
@@ -9,9 +9,11 @@
 
 import os
 import sys
+import time
+STARTUP_TIME = time.perf_counter()
 sys.path = ["./arctic_tools"] + sys.path
 
-import time
+import copy
 import torch
 import random
 import argparse
@@ -19,25 +21,19 @@ import datetime
 import numpy as np
 import os.path as op
 from pathlib import Path
-import matplotlib.pyplot as plt
 import torch.backends.cudnn as cudnn
 
 import json
-import wandb
 from glob import glob
 from cfg import Config
 import util.misc as utils
 import datasets.samplers as samplers
 from torch.utils.data import DataLoader
-from util.slconfig import SLConfig
-
-from models import build_model
-from datasets import build_dataset
-from arctic_tools.src.factory import collate_custom_fn as lstm_fn
-from engine import train_pose, test_pose, train_dn, eval_dn, eval_coco
 
-from util.tools import extract_epoch
-from util.scripts import smoothnet_main, submit_result
+# models, datasets, engine and the optional subsystems (wandb, renderers, ...) are imported in "main",
+# once the arguments tell which of them are needed
+from util.profiler import StageProfiler
+from util.checkpoint import CheckpointWriter
 from util.settings import (
     get_general_args_parser, get_deformable_detr_args_parser, get_dino_arg_parser,
     load_resume, set_training_scheduler, set_arctic_environments,
@@ -46,7 +42,9 @@ from util.settings import (
 
 
 # main script
-def main(args):
+def main(args, startup=None):
+    if startup is None:
+        startup = StageProfiler(False)
     utils.init_distributed_mode(args)
     print("git:\n  {}\n".format(utils.get_sha()))
 
@@ -54,6 +52,7 @@ def main(args):
         set_dino_args(args)
 
     if args.wandb:
+        import wandb
         if args.distributed and utils.get_local_rank() != 0:
             pass
         else:
@@ -65,6 +64,11 @@ def main(args):
 
     if args.frozen_weights is not None:
         assert args.masks, "Frozen training is meant for segmentation only"
+    if args.keep_top_k > 0 and args.dataset_file == 'arctic':
+        # keys of measure_error, e.g. "mpjpe.ra" -> "mpjpe/ra/h"
+        prefixes = [m.replace('.', '/') for m in args.eval_metrics if m not in ['mdev', 'acc_err_pose']]
+        assert any(args.ckpt_metric == p or args.ckpt_metric.startswith(p + '/') for p in prefixes), \
+            f"--ckpt_metric {args.ckpt_metric} is not computed by --eval_metrics {' '.join(args.eval_metrics)}"
     print(args)
     cfg = Config(args)
     
@@ -82,18 +86,27 @@ def main(args):
 
     # test
     if args.extraction_mode != '':
+        from util.scripts import submit_result
         sys.path.pop(sys.path.index('./arctic_tools'))
         sys.path = ["./origin_arctic"] + sys.path # Change to your own path.
         submit_result(args, cfg)
         sys.exit(0)
 
+    from models import build_model
+    from datasets import build_dataset
+    from util.tools import extract_epoch
+    from engine import train_pose, test_pose, train_dn, eval_dn, eval_coco, find_unused_parameters, eval_checkpoints
+    startup.mark('import_engine')
+
     if not args.eval:
         dataset_train = build_dataset(image_set='train', args=args)
     dataset_val = build_dataset(image_set='val', args=args)
+    startup.mark('build_dataset')
 
     model, criterion = build_model(args, cfg)
     model.to(device)
     model_without_ddp = model
+    startup.mark('build_model')
 
     if args.wandb:
         if args.distributed:
@@ -104,6 +117,7 @@ def main(args):
 
 
     if args.dataset_file == 'arctic':
+        from arctic_tools.src.factory import collate_custom_fn as lstm_fn
         collate_fn=lstm_fn
         # if args.method == 'arctic_lstm' and args.split_window:
         #         collate_fn=lstm_fn
@@ -145,6 +159,15 @@ def main(args):
             sampler_train = torch.utils.data.RandomSampler(dataset_train)
         sampler_val = torch.utils.data.SequentialSampler(dataset_val)
 
+    # shuffle chunks of consecutive frames, instead of single frames
+    if args.seq_chunk_size > 0 and not args.eval:
+        if args.distributed:
+            sampler_train = samplers.SequenceChunkSampler(
+                dataset_train, args.seq_chunk_size, node_local=args.cache_mode, group_views=args.group_views)
+        else:
+            sampler_train = samplers.SequenceChunkSampler(
+                dataset_train, args.seq_chunk_size, num_replicas=1, rank=0, group_views=args.group_views)
+
     if not args.eval:
         batch_sampler_train = torch.utils.data.BatchSampler(
             sampler_train, args.batch_size, drop_last=True)
@@ -156,6 +179,23 @@ def main(args):
                                 drop_last=False, collate_fn=collate_fn, num_workers=args.num_workers,
                                 pin_memory=True)
 
+    # static graph DDP: parameters that never receive gradients are frozen before the optimizer is built,
+    # so that DDP can run without find_unused_parameters. The effect on the step time is not measured.
+    if args.static_graph and not (args.eval or args.train_smoothnet):
+        if args.unused_params_file:
+            with open(args.unused_params_file, 'r') as f:
+                report = json.load(f)
+            assert report['modelname'] == args.modelname and report['feature_type'] == args.feature_type, \
+                f"{args.unused_params_file} is made for {report['modelname']} / {report['feature_type']}."
+            unused_params = report['unused']
+        else:
+            unused_params = find_unused_parameters(model, criterion, data_loader_train, device, args, args.num_probe_steps)
+        unused_params = set(unused_params)
+        for n, p in model.named_parameters():
+            if n in unused_params:
+                p.requires_grad_(False)
+        print(f'Freeze {len(unused_params)} unused parameters for static graph DDP.')
+
     # lr_backbone_names = ["backbone.0", "backbone.neck", "input_proj", "transformer.encoder"]
     if args.eval or args.train_smoothnet:
         optimizer = lr_scheduler = None
@@ -163,7 +203,14 @@ def main(args):
         optimizer, lr_scheduler = set_training_scheduler(args, model_without_ddp, len_data_loader_train = len(data_loader_train))
 
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True)
+        device_ids = [args.gpu] if device.type == 'cuda' else None
+        if args.static_graph:
+            model = torch.nn.parallel.DistributedDataParallel(
+                model, device_ids=device_ids, static_graph=True,
+                bucket_cap_mb=args.bucket_cap_mb, gradient_as_bucket_view=True
+            )
+        else:
+            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=True)
         model_without_ddp = model.module
 
     if args.frozen_weights is not None:
@@ -181,12 +228,24 @@ def main(args):
             print(lr_scheduler.state_dict())
             print('\n\n')
 
+    # the teacher supervises the deformable detr training loop
+    distiller = None
+    if args.distill_teacher and not args.eval:
+        assert args.modelname != 'dino', 'Not implemented yet!'
+        from models.distill import build_teacher, Distiller
+        distiller = Distiller(build_teacher(args, cfg), cfg, *args.distill_coef)
+        criterion.weight_dict.update(distiller.weight_dict)
+
+    startup.mark('setup')
+    startup.export(args, 0, flag='startup')
+
     print("Start training")
     start_time = time.time()
 
 
     if args.train_smoothnet:
         assert utils.get_local_size() == 1, 'Not implemented yet!'
+        from util.scripts import smoothnet_main
         if args.eval:
             data_loader_train = None
         smoothnet_main(model_without_ddp, data_loader_train, data_loader_val, args, cfg)
@@ -199,8 +258,25 @@ def main(args):
         if args.resume_dir:
             assert not args.resume
             resume_list = glob(op.join(args.resume_dir,'*.pth'))
+            # prefer weights-only checkpoints, they skip the optimizer state and only swap changed tensors
+            weights_list = glob(op.join(args.resume_dir,'*.weights'))
+            weights_epochs = [extract_epoch(p) for p in weights_list]
+            resume_list = weights_list + [p for p in resume_list if extract_epoch(p) not in weights_epochs]
             resume_list.sort(key=extract_epoch)
 
+            # evaluate a group of checkpoints per pass over the validation set
+            if args.eval_group_size > 1 and args.dataset_file == 'arctic' and not args.visualization:
+                models = [model_without_ddp] + [
+                    copy.deepcopy(model_without_ddp) for _ in range(min(args.eval_group_size, len(resume_list)) - 1)
+                ]
+                for idx in range(0, len(resume_list), args.eval_group_size):
+                    group = resume_list[idx:idx + args.eval_group_size]
+                    for resume, group_model in zip(group, models):
+                        args.resume = resume
+                        load_resume(args, group_model, resume)
+                    eval_checkpoints(models[:len(group)], group, cfg, data_loader_val, device, args=args)
+                sys.exit(0)
+
             for resume in resume_list:
                 args.resume = resume
                 model_without_ddp, optimizer, lr_scheduler = load_resume(args, model_without_ddp, args.resume, optimizer, lr_scheduler)
@@ -228,8 +304,12 @@ def main(args):
 
     # for training
     else:
+        ckpt_writer = CheckpointWriter(
+            args.output_dir, keep_last_k=args.keep_last_k, keep_top_k=args.keep_top_k,
+            metric=args.ckpt_metric, higher_is_better=args.ckpt_metric_higher
+        )
         for epoch in range(args.start_epoch, args.epochs):
-            if args.distributed:
+            if args.distributed or args.seq_chunk_size > 0:
                 sampler_train.set_epoch(epoch)
 
             # origin training
@@ -242,41 +322,51 @@ def main(args):
                 if not args.onecyclelr:
                     lr_scheduler.step()
 
-                utils.save_on_master({
+                ckpt_writer.save({
                     'model': model_without_ddp.state_dict(),
                     'optimizer': optimizer.state_dict(),
                     'lr_scheduler': lr_scheduler.state_dict(),
                     'epoch': epoch,
                     'args': args,
-                }, f'{args.output_dir}/{epoch}.pth')
+                }, epoch)
 
-                eval_dn(model, cfg, data_loader_val, device, wo_class_error=False, args=args, vis=args.visualization, epoch=epoch)
+                stats = eval_dn(model, cfg, data_loader_val, device, wo_class_error=False, args=args, vis=args.visualization, epoch=epoch)
+                ckpt_writer.update_metric(epoch, stats)
 
             # for deformable detr
             else:
                 train_pose(
-                    model, criterion, data_loader_train, optimizer, device, epoch, args.clip_max_norm, args, cfg=cfg, lr_scheduler=lr_scheduler
+                    model, criterion, data_loader_train, optimizer, device, epoch, args.clip_max_norm, args, cfg=cfg, lr_scheduler=lr_scheduler,
+                    distiller=distiller
                 )
                 if not args.onecyclelr:
                     lr_scheduler.step()                
 
-                utils.save_on_master({
+                ckpt_writer.save({
                     'model': model_without_ddp.state_dict(),
                     'optimizer': optimizer.state_dict(),
                     'lr_scheduler': lr_scheduler.state_dict(),
                     'epoch': epoch,
                     'args': args,
-                }, f'{args.output_dir}/{epoch}.pth')
+                }, epoch)
 
                 # evaluate
-                test_pose(model, data_loader_val, device, cfg, args=args, vis=args.visualization, epoch=epoch)
-            
+                stats = test_pose(model, data_loader_val, device, cfg, args=args, vis=args.visualization, epoch=epoch)
+                ckpt_writer.update_metric(epoch, stats)
+
+        # wait for the last checkpoints
+        ckpt_writer.close()
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('Training time {}'.format(total_time_str))
 
 
 if __name__ == '__main__':
+    # time from the interpreter start to the first step, reported with --profile
+    startup = StageProfiler(True)
+    startup.tick(STARTUP_TIME)
+    startup.mark('import')
+
     # get general parser
     parser = argparse.ArgumentParser('Deformable DETR training and evaluation script', parents=[get_general_args_parser()])
     args = parser.parse_known_args()[0]
@@ -299,11 +389,11 @@ if __name__ == '__main__':
 
     if args.output_dir:
         Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    startup.mark('parse_args')
 
     # check arctic env
     set_arctic_environments(args)
-    from datasets import build_dataset
-    import datasets.samplers as samplers
-    from engine import train_pose, test_pose
+    startup.mark('environment')
+    startup.enabled = args.profile
 
-    main(args)
\ No newline at end of file
+    main(args, startup)
\ No newline at end of file
@@ -7,24 +7,25 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 # ------------------------------------------------------------------------
 
-from .actic_detr import build as build_arctic
-from .assembly_detr import build as build_assembly
-# from .dn_dab_dino_deformable_detr import build_dab_dino_deformable_detr
-from .dino import build_dino
 
+# builders are imported on demand, so only the selected model is loaded
 def build_model(args, cfg):
     if args.modelname == 'dino':
+        from .dino import build_dino
         return build_dino(args, cfg)
     
     # for dn-dino-deformable-detr
     # if args.modelname == 'dn_detr':
+    #     from .dn_dab_dino_deformable_detr import build_dab_dino_deformable_detr
     #     return build_dab_dino_deformable_detr(args, cfg)
     
     # for deformable detr
     else:
         if args.dataset_file == 'arctic':
+            from .actic_detr import build as build_arctic
             return build_arctic(args, cfg)
         elif args.dataset_file == 'AssemblyHands':
+            from .assembly_detr import build as build_assembly
             return build_assembly(args, cfg)
         else:
             raise Exception('Not implemented!')
\ No newline at end of file
@@ -20,6 +20,7 @@ from .matcher import build_matcher
 from .backbone import build_backbone
 from .segmentation import sigmoid_focal_loss
 from .arctic_transformer import build_deforamble_transformer, _get_activation_fn
+from .early_exit import DecoderEarlyExit
 
 from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
                        accuracy, get_world_size, interpolate,
@@ -27,6 +28,7 @@ from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
 
 from arctic_tools.common.body_models import build_mano_aa
 from arctic_tools.common.object_tensors import ObjectTensors
+from arctic_tools.common.object_sdf import ObjectSDF
 from arctic_tools.process import prepare_data, get_arctic_item
 from arctic_tools.src.callbacks.loss.loss_arctic_sf import compute_loss, compute_small_loss
 
@@ -39,7 +41,7 @@ class DeformableDETR(nn.Module):
     """ This is the Deformable DETR module that performs object detection """
     def __init__(self, backbone, transformer, num_classes, num_queries, num_feature_levels, 
                  aux_loss=True, with_box_refine=False, two_stage=False, cfg=None,
-                 method=None, window_size=None, feature_type='local_fm'):
+                 method=None, window_size=None, feature_type='local_fm', early_exit=0.0):
         """ Initializes the model.
         Parameters:
             backbone: torch module of the backbone to be used. See backbone.py
@@ -50,10 +52,12 @@ class DeformableDETR(nn.Module):
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
             with_box_refine: iterative bounding box refinement
             two_stage: two-stage Deformable DETR
+            early_exit: at inference, stop the decoder once the selected queries change less than this. 0 disables it.
         """
         super().__init__()
         self.num_queries = num_queries
         self.transformer = transformer
+        self.early_exit = early_exit
         self.hidden_dim = transformer.d_model
         self.method = method
         self.window_size = window_size
@@ -246,8 +250,15 @@ class DeformableDETR(nn.Module):
         if not self.two_stage:
             query_embeds = self.query_embed.weight  # (num_query, self.hidden_dim)
 
+        # early exit of the decoder, only at inference
+        exit_fn = None
+        if not self.training and self.early_exit > 0:
+            exit_fn = DecoderEarlyExit(self._layer_outputs, self.cfg, self.early_exit)
+        self.transformer.decoder.exit_fn = exit_fn
+
         ### backbone ###
         hs, init_reference, inter_references, enc_outputs_class, enc_outputs_hand_coord_unact, enc_outputs_obj_coord_unact = self.transformer(srcs, masks, pos, query_embeds)
+        self.transformer.decoder.exit_fn = None
         # hs : result include intermeditate feature (num_decoder_layer, B, num_queries, hidden_dim)
         # dataset = 'H2O' if len(self.cfg.hand_idx) == 2 else 'FPHA'
 
@@ -294,21 +305,16 @@ class DeformableDETR(nn.Module):
                 outputs_hand_coord_list.append(layer_key_outputs_unsig)
                 outputs_obj_coord_list.append(layer_obj_outputs_unsig)
 
-            outputs_class = self.cls_embed[lvl](hs_lvl)
-            out_mano_pose = self.mano_pose_embed[lvl](hs_lvl)
-            out_mano_beta = self.mano_beta_embed[lvl](hs_lvl)
-            out_hand_cam = self.hand_cam[lvl](hs_lvl)
-            out_obj_cam = self.obj_cam[lvl](hs_lvl)
-            out_obj_rot = self.obj_rot[lvl](hs_lvl)
-            out_obj_rad = self.obj_rad[lvl](hs_lvl)
-            
-            outputs_classes.append(outputs_class.to(torch.float32))
-            outputs_mano_pose.append(out_mano_pose)
-            outputs_mano_beta.append(out_mano_beta)
-            outputs_hand_cams.append(out_hand_cam)
-            outputs_obj_cams.append(out_obj_cam)
-            outputs_obj_radians.append(out_obj_rad)
-            outputs_obj_rotations.append(out_obj_rot)
+            # the early exit already applied the heads of this layer
+            layer_out = exit_fn.heads[lvl] if exit_fn is not None else self._layer_outputs(lvl, hs_lvl)
+
+            outputs_classes.append(layer_out['pred_logits'])
+            outputs_mano_pose.append(layer_out['pred_mano_params'][0])
+            outputs_mano_beta.append(layer_out['pred_mano_params'][1])
+            outputs_hand_cams.append(layer_out['pred_cams'][0])
+            outputs_obj_cams.append(layer_out['pred_cams'][1])
+            outputs_obj_radians.append(layer_out['pred_obj_params'][0])
+            outputs_obj_rotations.append(layer_out['pred_obj_params'][1])
 
         if self.two_stage:
             outputs_hand_coord = torch.stack(outputs_hand_coord_list)
@@ -330,6 +336,8 @@ class DeformableDETR(nn.Module):
                 outputs_class, outputs_hand_coord, outputs_obj_coord,
                 outputs_mano_params, outputs_obj_params, outputs_cams
             )
+        if exit_fn is not None:
+            out['dec_layers'] = levels
 
         if self.two_stage:
             enc_outputs_hand_coord = enc_outputs_hand_coord_unact.sigmoid() * 2 - 1
@@ -342,6 +350,14 @@ class DeformableDETR(nn.Module):
             }
         return out
 
+    def _layer_outputs(self, lvl, hs_lvl):
+        return {
+            'pred_logits': self.cls_embed[lvl](hs_lvl).to(torch.float32),
+            'pred_mano_params': [self.mano_pose_embed[lvl](hs_lvl), self.mano_beta_embed[lvl](hs_lvl)],
+            'pred_obj_params': [self.obj_rad[lvl](hs_lvl), self.obj_rot[lvl](hs_lvl)],
+            'pred_cams': [self.hand_cam[lvl](hs_lvl), self.obj_cam[lvl](hs_lvl)],
+        }
+
     @torch.jit.unused
     def _set_aux_loss(
             self, outputs_class, outputs_hand_coord, outputs_obj_coord,
@@ -396,7 +412,7 @@ class SetArcticCriterion(nn.Module):
         idx = self._get_src_permutation_idx(indices)
 
         labels = [t for i, t in enumerate(targets['labels']) if targets['is_valid'][i] == 1]
-        target_classes_o = torch.cat([torch.tensor(t)[indices[i][1]] for i, t in enumerate(labels)]).to('cuda')
+        target_classes_o = torch.cat([torch.tensor(t)[indices[i][1]] for i, t in enumerate(labels)]).to(src_logits.device)
 
         target_classes = torch.full(src_logits.shape[:2], self.num_classes,
                                     dtype=torch.int64, device=src_logits.device)
@@ -446,8 +462,8 @@ class SetArcticCriterion(nn.Module):
         labels = [t for i, t in enumerate(targets['labels']) if targets['is_valid'][i] == 1]
         keypoints = [t for i, t in enumerate(targets['keypoints']) if targets['is_valid'][i] == 1]
 
-        target_keypoints = torch.cat([t[indices[i][1]] for i, t in enumerate(keypoints)]).to('cuda')
-        target_labels = torch.cat([torch.tensor(t)[indices[i][1]] for i, t in enumerate(labels)]).to('cuda')
+        target_keypoints = torch.cat([t[indices[i][1]] for i, t in enumerate(keypoints)]).to(src_hand_key.device)
+        target_labels = torch.cat([torch.tensor(t)[indices[i][1]] for i, t in enumerate(labels)]).to(src_hand_key.device)
 
         #
         hand_cal_idx = (target_labels == 12) + (target_labels == 13)
@@ -460,7 +476,7 @@ class SetArcticCriterion(nn.Module):
         if len(loss_handkey) != 0:
             losses['loss_hand_keypoint'] = (loss_handkey.sum() / hand_cal_idx.sum().item()) / 21
         else:
-            losses['loss_hand_keypoint'] = torch.tensor(0).cuda()
+            losses['loss_hand_keypoint'] = torch.tensor(0, device=src_hand_key.device)
         losses['loss_obj_keypoint'] = (loss_objkey.sum() / obj_cal_idx.sum().item()) / 21
 
         return losses    
@@ -518,7 +534,7 @@ class SetArcticCriterion(nn.Module):
             # losses.update(self.get_loss(loss, outputs, targets, idx, num_boxes, **kwargs))
 
         pred = get_arctic_item(outputs, self.cfg, args.device)
-        losses.update(compute_small_loss(pred, targets, meta_info, self.pre_process_models, args.img_res))
+        losses.update(compute_small_loss(pred, targets, meta_info, self.pre_process_models, args.img_res, args.device))
         # arctic_pred = data.search('pred.', replace_to='')
         # arctic_gt = data.search('targets.', replace_to='')
         # losses.update(compute_loss(arctic_pred, arctic_gt, meta_info, args))
@@ -543,7 +559,7 @@ class SetArcticCriterion(nn.Module):
                     l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
                     losses.update(l_dict)
                 # l_dict = compute_loss(aux_arctic_pred, aux_arctic_gt, meta_info, args)
-                l_dict = compute_small_loss(aux_pred, targets, meta_info, self.pre_process_models, args.img_res)
+                l_dict = compute_small_loss(aux_pred, targets, meta_info, self.pre_process_models, args.img_res, args.device)
                 l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
                 losses.update(l_dict)
 
@@ -582,7 +598,6 @@ class MLP(nn.Module):
 
 def build(args, cfg):
     num_classes = cfg.num_obj_classes
-    device = torch.device(args.device)
 
     backbone = build_backbone(args)
 
@@ -599,8 +614,17 @@ def build(args, cfg):
         cfg = cfg,
         method = args.method,
         window_size= args.window_size,
-        feature_type=args.feature_type
+        feature_type=args.feature_type,
+        early_exit=args.early_exit
     )
+    criterion = build_criterion(args, cfg)
+
+    return model, criterion
+
+
+def build_criterion(args, cfg):
+    num_classes = cfg.num_obj_classes
+    device = torch.device(args.device)
     matcher = build_matcher(args, cfg)
 
     # TODO this is a hack
@@ -666,6 +690,8 @@ def build(args, cfg):
         # "loss/smooth/2d": 1.0,
         # "loss/smooth/3d": 1.0,
     }
+    if args.penetr_loss_coef > 0:
+        loss_weights["loss/penetr"] = args.penetr_loss_coef
     if args.two_stage:
         loss_weights['loss_hand_keypoint'] = args.keypoint_loss_coef
         loss_weights['loss_obj_keypoint'] = args.keypoint_loss_coef
@@ -691,9 +717,11 @@ def build(args, cfg):
         "mano_r": build_mano_aa(is_rhand=True).to(args.device),
         "mano_l": build_mano_aa(is_rhand=False).to(args.device),
         "arti_head": obj_tensor
-    }    
+    }
+    if args.penetr_loss_coef > 0:
+        pre_process_models["object_sdf"] = ObjectSDF(args.object_sdf).to(args.device)
     criterion = SetArcticCriterion(num_classes, matcher, loss_weights, losses, focal_alpha=args.focal_alpha, cfg=cfg,
                                    pre_process_models=pre_process_models)
     criterion.to(device)
 
-    return model, criterion
\ No newline at end of file
+    return criterion
\ No newline at end of file
@@ -401,6 +401,8 @@ class DeformableTransformerDecoder(nn.Module):
         self.cls_embed = None
         self.key_embed = None # modify
         self.obj_key_embed = None
+        # (layer index, layer output) -> True to skip the next layers, set by the model at inference
+        self.exit_fn = None
 
     def forward(self, tgt, reference_points, src, src_spatial_shapes, src_level_start_index, src_valid_ratios,
                 query_pos=None, src_padding_mask=None):
@@ -450,6 +452,9 @@ class DeformableTransformerDecoder(nn.Module):
                 intermediate.append(output)
                 intermediate_reference_points.append(reference_points)
 
+            if self.exit_fn is not None and self.exit_fn(lid, output):
+                break
+
         if self.return_intermediate:
             return torch.stack(intermediate), torch.stack(intermediate_reference_points)
 
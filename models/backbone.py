@@ -11,6 +11,7 @@
 Backbone modules.
 """
 from collections import OrderedDict
+from functools import partial
 
 import torch
 import torch.nn.functional as F
@@ -103,12 +104,43 @@ class Backbone(BackboneBase):
         backbone = getattr(torchvision.models, name)(
             replace_stride_with_dilation=[False, False, dilation],
             pretrained=is_main_process(), norm_layer=norm_layer)
-        assert name not in ('resnet18', 'resnet34'), "number of channels are hard coded"
         super().__init__(backbone, train_backbone, return_interm_layers)
+        if name in ('resnet18', 'resnet34'):
+            # basic blocks, 4 times fewer channels than the bottlenecks of resnet50/101
+            self.num_channels = [c // 4 for c in self.num_channels]
         if dilation:
             self.strides[-1] = self.strides[-1] // 2
 
 
+class LightBackbone(nn.Module):
+    """MobileNetV3-Large backbone with frozen BatchNorm, for CPU inference."""
+    # index in mobilenet_v3_large().features of the last block of each stride
+    return_layers = {"6": "0", "12": "1", "16": "2"}
+    all_strides = [8, 16, 32]
+    all_channels = [40, 112, 960]
+
+    def __init__(self, train_backbone: bool, return_interm_layers: bool, dilation: bool):
+        super().__init__()
+        assert not dilation, "dilation is not supported by mobilenet_v3_large"
+        backbone = torchvision.models.mobilenet_v3_large(
+            pretrained=is_main_process(), norm_layer=partial(FrozenBatchNorm2d, eps=0.001))
+        for name, parameter in backbone.features.named_parameters():
+            # the stem and the stride 2 and 4 blocks stay frozen, as the stem and layer1 of ResNet
+            if not train_backbone or int(name.split('.')[0]) < 4:
+                parameter.requires_grad_(False)
+        if return_interm_layers:
+            return_layers = self.return_layers
+            self.strides = list(self.all_strides)
+            self.num_channels = list(self.all_channels)
+        else:
+            return_layers = {"16": "0"}
+            self.strides = self.all_strides[-1:]
+            self.num_channels = self.all_channels[-1:]
+        self.body = IntermediateLayerGetter(backbone.features, return_layers=return_layers)
+
+    forward = BackboneBase.forward
+
+
 class Joiner(nn.Sequential):
     def __init__(self, backbone, position_embedding):
         super().__init__(backbone, position_embedding)
@@ -143,6 +175,8 @@ def build_backbone(args):
                     pretrain_img_size=pretrain_img_size, \
                     out_indices=tuple(return_interm_indices), \
                 dilation=args.dilation, use_checkpoint=False)
+    elif args.backbone == 'mobilenet_v3_large':
+        backbone = LightBackbone(train_backbone, return_interm_layers, args.dilation)
     else:
         backbone = Backbone(args.backbone, train_backbone, return_interm_layers, args.dilation)
     model = Joiner(backbone, position_embedding)
@@ -668,6 +668,8 @@ class TransformerDecoder(nn.Module):
             self.query_scale = MLP(d_model, d_model, d_model, 2)
         self.bbox_embed = None
         self.class_embed = None
+        # (layer index, layer output) -> True to skip the next layers, set by the model at inference
+        self.exit_fn = None
 
         self.d_model = d_model
         self.modulate_hw_attn = modulate_hw_attn
@@ -821,6 +823,9 @@ class TransformerDecoder(nn.Module):
                 if nq_now != select_number:
                     output = torch.gather(output, 0, topk_proposals.unsqueeze(-1).repeat(1, 1, self.d_model)) # unsigmoid
 
+            if self.exit_fn is not None and self.exit_fn(layer_id, intermediate[-1].transpose(0, 1)):
+                break
+
         return [
             [itm_out.transpose(0, 1) for itm_out in intermediate],
             [itm_refpoint.transpose(0, 1) for itm_refpoint in ref_points]
@@ -32,6 +32,7 @@ from .segmentation import (DETRsegm, PostProcessPanoptic, PostProcessSegm,
                            dice_loss)
 from .deformable_transformer import build_deformable_transformer
 from .utils import sigmoid_focal_loss, MLP
+from ..early_exit import DecoderEarlyExit
 from arctic_tools.process import prepare_data
 from arctic_tools.src.callbacks.loss.loss_arctic_sf import compute_loss
 
@@ -40,6 +41,7 @@ from arctic_tools.src.callbacks.loss.loss_arctic_sf import compute_small_loss
 
 from arctic_tools.common.body_models import build_mano_aa
 from arctic_tools.common.object_tensors import ObjectTensors
+from arctic_tools.common.object_sdf import ObjectSDF
 
 # from ..registry import MODULE_BUILD_FUNCS
 from .dn_components import prepare_for_cdn,dn_post_process
@@ -65,6 +67,8 @@ class DINO(nn.Module):
                     dn_box_noise_scale = 0.4,
                     dn_label_noise_ratio = 0.5,
                     dn_labelbook_size = 100,
+                    early_exit = 0.0,
+                    cfg = None,
                     ):
         """ Initializes the model.
         Parameters:
@@ -101,6 +105,10 @@ class DINO(nn.Module):
         self.dn_label_noise_ratio = dn_label_noise_ratio
         self.dn_labelbook_size = dn_labelbook_size
 
+        # early exit of the decoder at inference, 0 disables it
+        self.early_exit = early_exit
+        self.cfg = cfg
+
         # prepare input projection layers
         if num_feature_levels > 1:
             num_backbone_outs = len(backbone.num_channels)
@@ -318,7 +326,14 @@ class DINO(nn.Module):
             assert targets is None
             input_query_bbox = input_query_label = attn_mask = dn_meta = None
 
+        # early exit of the decoder, only at inference
+        exit_fn = None
+        if not self.training and self.early_exit > 0 and dn_meta is None:
+            exit_fn = DecoderEarlyExit(self._layer_outputs, self.cfg, self.early_exit)
+        self.transformer.decoder.exit_fn = exit_fn
+
         hs, reference, hs_enc, ref_enc, init_box_proposal = self.transformer(srcs, masks, input_query_bbox, poss,input_query_label,attn_mask)
+        self.transformer.decoder.exit_fn = None
         # In case num object=0
         hs[0] += self.label_enc.weight[0,0]*0.0
 
@@ -338,13 +353,24 @@ class DINO(nn.Module):
         outputs_hand_coord_list = torch.stack(outputs_hand_coord_list)
         outputs_obj_coord_list = torch.stack(outputs_obj_coord_list)
 
-        outputs_class = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.class_embed, hs)])
-        outputs_mano_pose = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.mano_pose_embed, hs)])
-        outputs_mano_beta = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.mano_beta_embed, hs)])
-        outputs_hand_cam = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.hand_cam, hs)])
-        outputs_obj_cam = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.obj_cam, hs)])
-        outputs_obj_rot = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.obj_rot, hs)])
-        outputs_obj_rad = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.obj_rad, hs)])
+        if exit_fn is not None:
+            # the early exit already applied the heads of every layer that ran
+            layer_outs = [exit_fn.heads[lid] for lid in range(len(hs))]
+            outputs_class = torch.stack([out['pred_logits'] for out in layer_outs])
+            outputs_mano_pose = torch.stack([out['pred_mano_params'][0] for out in layer_outs])
+            outputs_mano_beta = torch.stack([out['pred_mano_params'][1] for out in layer_outs])
+            outputs_hand_cam = torch.stack([out['pred_cams'][0] for out in layer_outs])
+            outputs_obj_cam = torch.stack([out['pred_cams'][1] for out in layer_outs])
+            outputs_obj_rot = torch.stack([out['pred_obj_params'][1] for out in layer_outs])
+            outputs_obj_rad = torch.stack([out['pred_obj_params'][0] for out in layer_outs])
+        else:
+            outputs_class = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.class_embed, hs)])
+            outputs_mano_pose = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.mano_pose_embed, hs)])
+            outputs_mano_beta = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.mano_beta_embed, hs)])
+            outputs_hand_cam = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.hand_cam, hs)])
+            outputs_obj_cam = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.obj_cam, hs)])
+            outputs_obj_rot = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.obj_rot, hs)])
+            outputs_obj_rad = torch.stack([embed(layer_hs) for embed, layer_hs in zip(self.obj_rad, hs)])
 
         outputs_mano_param = [outputs_mano_pose, outputs_mano_beta]
         outputs_cam_param = [outputs_hand_cam, outputs_obj_cam]
@@ -396,8 +422,18 @@ class DINO(nn.Module):
                 ]
 
         out['dn_meta'] = dn_meta
+        if exit_fn is not None:
+            out['dec_layers'] = len(hs)
 
         return out
+
+    def _layer_outputs(self, lid, layer_hs):
+        return {
+            'pred_logits': self.class_embed[lid](layer_hs),
+            'pred_mano_params': [self.mano_pose_embed[lid](layer_hs), self.mano_beta_embed[lid](layer_hs)],
+            'pred_obj_params': [self.obj_rad[lid](layer_hs), self.obj_rot[lid](layer_hs)],
+            'pred_cams': [self.hand_cam[lid](layer_hs), self.obj_cam[lid](layer_hs)],
+        }
     
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, hand_coord, obj_coord,
@@ -676,7 +712,7 @@ class SetCriterion(nn.Module):
             losses.update(self.get_loss(loss, outputs, targets, indices, num_boxes))
         
         pred = get_arctic_item(outputs, self.cfg, args.device)
-        losses.update(compute_small_loss(pred, targets, meta_info, self.pre_process_models, args.img_res))
+        losses.update(compute_small_loss(pred, targets, meta_info, self.pre_process_models, args.img_res, args.device))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
@@ -702,7 +738,7 @@ class SetCriterion(nn.Module):
                     losses.update(l_dict)
                 # l_dict = compute_loss(aux_arctic_pred, aux_arctic_gt, meta_info, args)
                 aux_pred = get_arctic_item(aux_outputs, self.cfg, args.device)
-                l_dict = compute_small_loss(aux_pred, targets, meta_info, self.pre_process_models, args.img_res)
+                l_dict = compute_small_loss(aux_pred, targets, meta_info, self.pre_process_models, args.img_res, args.device)
                 l_dict = {k + f'_{idx}': v for k, v in l_dict.items()}
                 losses.update(l_dict)
 
@@ -900,6 +936,8 @@ def build_dino(args, cfg):
         dn_box_noise_scale = args.dn_box_noise_scale,
         dn_label_noise_ratio = args.dn_label_noise_ratio,
         dn_labelbook_size = dn_labelbook_size,
+        early_exit = args.early_exit,
+        cfg = cfg,
     )
     if args.masks:
         model = DETRsegm(model, freeze_detr=(args.frozen_weights is not None))
@@ -972,6 +1010,8 @@ def build_dino(args, cfg):
     #     # "loss/smooth/2d": 10.0,
     #     # "loss/smooth/3d": 10.0,
     # }    
+    if args.penetr_loss_coef > 0:
+        weight_dict["loss/penetr"] = args.penetr_loss_coef
     clean_weight_dict_wo_dn = copy.deepcopy(weight_dict)
 
     
@@ -1025,6 +1065,8 @@ def build_dino(args, cfg):
         "mano_l": build_mano_aa(is_rhand=False).to(args.device),
         "arti_head": obj_tensor
     }
+    if args.penetr_loss_coef > 0:
+        pre_process_models["object_sdf"] = ObjectSDF(args.object_sdf).to(args.device)
 
     criterion = SetCriterion(num_classes, matcher=matcher, weight_dict=weight_dict,
                              focal_alpha=args.focal_alpha, losses=losses, cfg=cfg,
@@ -0,0 +1,89 @@
+"""
+Distillation of a trained checkpoint into another model, used with --distill_teacher.
+The usual use is a lightweight backbone for CPU (e.g. --backbone mobilenet_v3_large) supervised by a Swin/ResNet-50
+checkpoint.
+"""
+import copy
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from arctic_tools.process import get_arctic_item, make_output
+from util.base_cache import pack
+
+# joints of make_output compared between the student and the teacher
+KIN_KEYS = ["mano.j3d.cam.r", "mano.j3d.cam.l", "object.kp3d.cam"]
+
+
+def build_from_checkpoint(args, cfg, path, **overrides):
+    """
+    Model of a checkpoint of main.py, built with the options saved in the checkpoint and then "overrides".
+    Options added after the checkpoint was saved keep their current value.
+    :return: model in eval mode and its args.
+    """
+    from models import build_model
+
+    checkpoint = torch.load(path, map_location='cpu')
+    model_args = copy.deepcopy(args)
+    vars(model_args).update(vars(checkpoint['args']))
+    model_args.device = args.device
+    model_args.distributed = False
+    vars(model_args).update(overrides)
+
+    model, _ = build_model(model_args, cfg)
+    missing_keys, unexpected_keys = model.load_state_dict(checkpoint['model'], strict=False)
+    unexpected_keys = [k for k in unexpected_keys if not (k.endswith('total_params') or k.endswith('total_ops'))]
+    assert len(missing_keys) == 0, f"{path} misses {missing_keys}"
+    for key in unexpected_keys:
+        print(f'unexpected_keys : {key}')
+    return model.to(args.device).eval(), model_args
+
+
+def build_teacher(args, cfg):
+    """
+    Model of the checkpoint args.distill_teacher, frozen and in eval mode.
+    """
+    # the teacher only runs the full decoder and needs no extra losses
+    teacher, teacher_args = build_from_checkpoint(
+        args, cfg, args.distill_teacher, early_exit=0.0, penetr_loss_coef=0.0, distill_teacher=''
+    )
+    print(f"teacher: {teacher_args.modelname} with {teacher_args.backbone} from {args.distill_teacher}")
+    for parameter in teacher.parameters():
+        parameter.requires_grad_(False)
+    return teacher
+
+
+class Distiller(nn.Module):
+    """
+    Losses between the outputs of the trained model and those of the frozen teacher on the same samples:
+        loss/distill/params  L1 on the parameters of the queries selected by get_arctic_item
+        loss/distill/kin     L1 on the joints of make_output (KIN_KEYS), in meters
+    The queries of two models are not aligned, so only the selected queries are compared, as for the ground truth.
+    """
+    def __init__(self, teacher, cfg, coef_params=1.0, coef_kin=1.0):
+        super().__init__()
+        self.teacher = teacher
+        self.cfg = cfg
+        self.weight_dict = {
+            "loss/distill/params": coef_params,
+            "loss/distill/kin": coef_kin,
+        }
+
+    def train(self, mode=True):
+        # the teacher stays in eval mode
+        super().train(mode)
+        self.teacher.eval()
+        return self
+
+    def forward(self, samples, outputs, meta_info, args):
+        with torch.no_grad():
+            teacher_out = get_arctic_item(self.teacher(samples), self.cfg, args.device)
+            teacher_kin = make_output(args, *teacher_out, meta_info["query_names"], meta_info["intrinsics"])
+        student_out = get_arctic_item(outputs, self.cfg, args.device)
+        student_kin = make_output(args, *student_out, meta_info["query_names"], meta_info["intrinsics"])
+
+        losses = {}
+        losses["loss/distill/params"] = F.l1_loss(pack(student_out), pack(teacher_out))
+        losses["loss/distill/kin"] = sum(F.l1_loss(student_kin[key], teacher_kin[key]) for key in KIN_KEYS) / len(KIN_KEYS)
+        return losses
@@ -0,0 +1,38 @@
+"""
+Confidence-based early exit of the decoder, used at inference with --early_exit.
+"""
+import torch
+
+from arctic_tools.process import get_arctic_item
+
+
+class DecoderEarlyExit(object):
+    """
+    Stops the decoder once the queries used by get_arctic_item stop changing.
+    After each layer, the heads of that layer are applied to its output, and the parameters of the selected left hand,
+    right hand and object queries are compared with those of the previous layer. The decoder stops when no parameter
+    of any sample changed by more than the threshold.
+    The head outputs are kept in "heads" so that the model does not compute them again.
+
+    :param heads_fn: (layer index, layer output (B, num_queries, C)) -> outputs of the heads in the format of the
+        model outputs ("pred_logits", "pred_cams", "pred_mano_params", "pred_obj_params").
+    :param min_layers: number of layers that always run.
+    """
+    def __init__(self, heads_fn, cfg, threshold, min_layers=2):
+        self.heads_fn = heads_fn
+        self.cfg = cfg
+        self.threshold = threshold
+        self.min_layers = min_layers
+        self.heads = {}
+        self.prev = None
+
+    def __call__(self, lid, hs_lvl):
+        out = self.heads_fn(lid, hs_lvl)
+        self.heads[lid] = out
+        selected = get_arctic_item(out, self.cfg, hs_lvl.device)
+        params = torch.cat([param for group in selected for param in group], dim=-1)
+
+        prev, self.prev = self.prev, params
+        if prev is None or lid + 1 < self.min_layers:
+            return False
+        return bool((params - prev).abs().max() < self.threshold)
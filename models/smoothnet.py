@@ -146,10 +146,7 @@ class ArcticSmoother(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-    def forward(self, output):
-        B = self.batch_size
-        T = self.window_size
-
+    def _smooth_params(self, output, fn):
         # select query
         root, mano_pose, mano_shape, obj_angle = output
         root_l, root_r, root_o = root
@@ -158,25 +155,84 @@ class ArcticSmoother(nn.Module):
         obj_rot, obj_rad = obj_angle
 
         smoothed_root = [
-            self.mano_root_smoother(root_l.view(B, T, -1)).reshape(-1, 3),
-            self.mano_root_smoother(root_r.view(B, T, -1)).reshape(-1, 3),
-            self.obj_root_smoother(root_o.view(B, T, -1)).reshape(-1, 3)
+            fn(self.mano_root_smoother, root_l),
+            fn(self.mano_root_smoother, root_r),
+            fn(self.obj_root_smoother, root_o)
         ]
         smoothed_pose = [
-            self.mano_pose_smoother(mano_pose_l.view(B, T, -1)).reshape(-1, 48),
-            self.mano_pose_smoother(mano_pose_r.view(B, T, -1)).reshape(-1, 48)
+            fn(self.mano_pose_smoother, mano_pose_l),
+            fn(self.mano_pose_smoother, mano_pose_r)
         ]
         smoothed_shape = [
-            self.mano_shape_smoother(mano_shape_l.view(B, T, -1)).reshape(-1, 10),
-            self.mano_shape_smoother(mano_shape_r.view(B, T, -1)).reshape(-1, 10)
+            fn(self.mano_shape_smoother, mano_shape_l),
+            fn(self.mano_shape_smoother, mano_shape_r)
         ]
         smoothed_obj = [
-            self.obj_rot_smoother(obj_rot.view(B, T, -1)).reshape(-1,3),
-            self.obj_rad_smoother(obj_rad.view(B, T, -1)).reshape(-1,1)
+            fn(self.obj_rot_smoother, obj_rot),
+            fn(self.obj_rad_smoother, obj_rad)
         ]
 
         return smoothed_root, smoothed_pose, smoothed_shape, smoothed_obj
 
+    def forward(self, output):
+        # (B*T, C) in windows of T frames, B follows from the input
+        T = self.window_size
+
+        def smooth(smoother, x):
+            C = x.shape[-1]
+            return smoother(x.view(-1, T, C)).reshape(-1, C)
+
+        return self._smooth_params(output, smooth)
+
+    def window_index(self, lengths, stride, device=None):
+        """
+        Frames of the overlapping windows of a ragged batch of sequences.
+        :param lengths: number of frames of each sequence, concatenated in this order
+        :param stride: step between the windows of a sequence; the last window ends at the last frame
+        :return: (W, T) indices into the concatenated frames. Sequences shorter than T repeat their last frame.
+        """
+        T = self.window_size
+        index = []
+        offset = 0
+        for length in lengths:
+            last = max(length - T, 0)
+            starts = list(range(0, last + 1, stride))
+            if starts[-1] != last:
+                starts.append(last)
+            starts = torch.LongTensor(starts)
+            frames = (starts[:, None] + torch.arange(T)[None, :]).clamp(max=length - 1)
+            index.append(frames + offset)
+            offset += length
+        return torch.cat(index, dim=0).to(device)
+
+    def smooth_sequences(self, output, lengths, stride=None):
+        """
+        Smooth whole sequences of any length in one call.
+        The windows of all the sequences are smoothed as one batch and blended where they overlap, with weights that
+        decay towards the ends of a window.
+        :param output: the nested lists of get_arctic_item, each (sum(lengths), C)
+        :param lengths: number of frames of each sequence
+        :param stride: step between the windows, window_size // 2 by default
+        """
+        T = self.window_size
+        stride = stride or max(T // 2, 1)
+        device = output[0][0].device
+        index = self.window_index(lengths, stride, device)
+        W = index.shape[0]
+        flat_index = index.view(-1)
+
+        t = torch.arange(T, device=device)
+        weight = torch.min(t + 1, T - t).float()
+        norm = torch.zeros(sum(lengths), device=device).index_add_(0, flat_index, weight.repeat(W))
+
+        def smooth(smoother, x):
+            C = x.shape[-1]
+            windows = smoother(x[index]) * weight[None, :, None].to(x.dtype)
+            out = x.new_zeros(x.shape).index_add_(0, flat_index, windows.reshape(-1, C))
+            return out / norm[:, None].to(x.dtype)
+
+        return self._smooth_params(output, smooth)
+
 
 class OldArcticSmoother(nn.Module):
     def __init__(self, batch_size, window_size):
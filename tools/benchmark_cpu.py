@@ -0,0 +1,281 @@
+"""
+CPU benchmark of the ARCTIC data, loss and evaluation pipeline on synthetic data.
+
+    python tools/benchmark_cpu.py --coco_path /tmp/synthetic --dataset_file arctic --setup p1
+    python tools/benchmark_cpu.py --coco_path /tmp/synthetic --dataset_file arctic --setup p1 --update_thresholds
+
+A synthetic dataset (arctic_tools/src/arctic/synthetic.py) is generated under "{coco_path}/{dataset_file}"
+unless one with the same setup already exists there, so no ARCTIC download is needed.
+Each stage is called "--bench_iters" times after "--bench_warmup" untimed calls, and its median time is compared
+with the baseline in "--thresholds". The script exits with status 1 if a stage is slower than
+baseline * (1 + --bench_tolerance). No baseline is shipped with the repository: baselines are machine dependent,
+so first record one with "--update_thresholds" on the machine that runs the comparison. Without a baseline the
+timings are only printed.
+"""
+
+import os
+import sys
+import os.path as op
+REPO_ROOT = op.dirname(op.dirname(op.abspath(__file__)))
+# absolute paths, the benchmark runs from the synthetic data root
+sys.path = [op.join(REPO_ROOT, "arctic_tools"), REPO_ROOT] + sys.path
+
+import copy
+import json
+import time
+import random
+import argparse
+
+import numpy as np
+import torch
+
+from cfg import Config
+from util.settings import get_general_args_parser, get_deformable_detr_args_parser
+
+STAGES = [
+    'getitem', 'getitem_tempo', 'getitem_tempo_inf', 'collate', 'pre_process', 'matcher',
+    'criterion', 'make_output', 'prepare_data', 'measure_error', 'smoothing',
+]
+
+
+def get_benchmark_args_parser():
+    parser = argparse.ArgumentParser('CPU benchmark', add_help=False)
+    parser.add_argument('--bench_iters', default=20, type=int)
+    parser.add_argument('--bench_warmup', default=3, type=int)
+    parser.add_argument('--bench_threads', default=4, type=int)
+    parser.add_argument('--bench_split', default='train', choices=['train', 'val'])
+    parser.add_argument('--bench_seqs', default=2, type=int, help='synthetic sequences per split')
+    parser.add_argument('--bench_frames', default=40, type=int, help='frames per synthetic sequence')
+    parser.add_argument('--bench_window_size', default=8, type=int, help='window size of TempoDataset and TempoInferenceDataset')
+    parser.add_argument('--bench_smooth_iters', default=20, type=int, help='"count" of arctic_smoothing')
+    parser.add_argument('--bench_tolerance', default=0.2, type=float)
+    parser.add_argument('--thresholds', default=op.join(REPO_ROOT, 'tools/benchmark_thresholds.json'), type=str)
+    parser.add_argument('--update_thresholds', default=False, action='store_true')
+    return parser
+
+
+def timeit(fn, iters, warmup, setup=None):
+    '''
+    :param setup: returns the arguments of "fn" for one call; not timed.
+    :return: last result and the timing summary in ms.
+    '''
+    times = []
+    result = None
+    for i in range(warmup + iters):
+        inputs = setup() if setup is not None else ()
+        start = time.perf_counter()
+        result = fn(*inputs)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            times.append(1000 * elapsed)
+    times = np.array(times)
+    summary = {
+        'median_ms': float(np.median(times)),
+        'mean_ms': float(times.mean()),
+        'min_ms': float(times.min()),
+        'max_ms': float(times.max()),
+    }
+    return result, summary
+
+
+def make_outputs(args, cfg, batch_size):
+    '''
+    Random outputs with the layout of DeformableDETR.forward (models/actic_detr.py).
+    '''
+    Q = args.num_queries
+
+    def head(dim, scale=0.1):
+        return (torch.randn(batch_size, Q, dim) * scale).requires_grad_()
+
+    def cam():
+        # weak perspective (s, tx, ty)
+        return (torch.randn(batch_size, Q, 3) * 0.1 + torch.tensor([0.8, 0.0, 0.0])).requires_grad_()
+
+    def layer():
+        return {
+            'pred_logits': head(cfg.num_obj_classes, scale=1.0),
+            'pred_hand_key': head(42), 'pred_obj_key': head(42),
+            'pred_mano_params': [head(48), head(10)],
+            'pred_obj_params': [head(1), head(3)],
+            'pred_cams': [cam(), cam()],
+        }
+
+    outputs = layer()
+    if args.aux_loss:
+        outputs['aux_outputs'] = [layer() for _ in range(args.dec_layers - 1)]
+    return outputs
+
+
+def prepare_synthetic(args):
+    from src.arctic.synthetic import generate
+
+    root = op.abspath(op.join(args.coco_path, args.dataset_file))
+    config_p = op.join(root, 'synthetic.json')
+    if op.exists(config_p):
+        with open(config_p, 'r') as f:
+            config = json.load(f)
+        if config['setup'] == args.setup and args.bench_split in config['splits'] and config['local_fm']:
+            return root, config
+    # TempoDataset reads the "local_fm" features
+    config = generate(
+        root, setup=args.setup, splits=['train', 'val'],
+        num_seqs=args.bench_seqs, num_frames=args.bench_frames, local_fm=True,
+        hidden_dim=args.hidden_dim, img_res=args.img_res, num_feature_levels=args.num_feature_levels,
+    )
+    return root, config
+
+
+def run(args, cfg, config):
+    from src.factory import collate_custom_fn
+    from src.datasets.arctic_dataset import ArcticDataset
+    from src.datasets.tempo_dataset import TempoDataset
+    from src.datasets.tempo_inference_dataset import TempoInferenceDataset
+    from models.matcher import build_matcher
+    from models.actic_detr import build_criterion
+    from arctic_tools.process import arctic_pre_process, get_arctic_item, make_output, prepare_data, measure_error
+    from util.tools import arctic_smoothing
+
+    iters, warmup = args.bench_iters, args.bench_warmup
+    B = args.batch_size
+    results = {}
+
+    # data
+    dataset = ArcticDataset(args, split=args.bench_split)
+    _, results['getitem'] = timeit(
+        lambda idx: dataset[idx], iters, warmup, setup=lambda: (random.randrange(len(dataset)),)
+    )
+
+    tempo_args = copy.deepcopy(args)
+    tempo_args.feature_type = 'global_fm'
+    tempo_args.img_feat_version = config['img_feat_version']
+    tempo_args.window_size = args.bench_window_size
+    tempo_dataset = TempoDataset(tempo_args, split=args.bench_split)
+    _, results['getitem_tempo'] = timeit(
+        lambda idx: tempo_dataset[idx], iters, warmup, setup=lambda: (random.randrange(len(tempo_dataset)),)
+    )
+    tempo_inf_dataset = TempoInferenceDataset(tempo_args, split=args.bench_split)
+    _, results['getitem_tempo_inf'] = timeit(
+        lambda idx: tempo_inf_dataset[idx], iters, warmup, setup=lambda: (random.randrange(len(tempo_inf_dataset)),)
+    )
+
+    items = [dataset[idx] for idx in range(B)]
+    (samples, targets, meta_info), results['collate'] = timeit(
+        collate_custom_fn, iters, warmup, setup=lambda: (items,)
+    )
+
+    # process_data adds keys to targets and meta_info, so each call gets its own copy
+    (targets, meta_info), results['pre_process'] = timeit(
+        lambda t, m: arctic_pre_process(args, t, m), iters, warmup,
+        setup=lambda: (dict(targets), dict(meta_info))
+    )
+
+    # loss
+    outputs = make_outputs(args, cfg, B)
+    matcher = build_matcher(args, cfg)
+    outputs_without_aux = {k: v for k, v in outputs.items() if k not in ['aux_outputs', 'interm_outputs']}
+    _, results['matcher'] = timeit(lambda: matcher(outputs_without_aux, targets), iters, warmup)
+
+    criterion = build_criterion(args, cfg)
+    _, results['criterion'] = timeit(lambda: criterion(outputs, targets, args, meta_info), iters, warmup)
+
+    # evaluation
+    with torch.no_grad():
+        root, mano_pose, mano_shape, obj_angle = get_arctic_item(outputs, cfg, args.device)
+        query_names, K = meta_info['query_names'], meta_info['intrinsics']
+
+        def output():
+            return make_output(args, root, mano_pose, mano_shape, obj_angle, query_names, K)
+        _, results['make_output'] = timeit(output, iters, warmup)
+
+        # prepare_data updates the prediction in place
+        data, results['prepare_data'] = timeit(
+            lambda pred: prepare_data(args, None, targets, meta_info, cfg, pred=pred), iters, warmup,
+            setup=lambda: (output(),)
+        )
+        _, results['measure_error'] = timeit(
+            lambda d: measure_error(d, args.eval_metrics), iters, warmup, setup=lambda: (copy.deepcopy(data),)
+        )
+        _, results['smoothing'] = timeit(
+            lambda v: arctic_smoothing(v, args.bench_smooth_iters), iters, warmup,
+            setup=lambda: (data['pred.object.v.cam'].clone(),)
+        )
+    return results
+
+
+def bench_config(args):
+    # timings are only comparable under the same settings
+    return {
+        'setup': args.setup, 'batch_size': args.batch_size, 'num_queries': args.num_queries,
+        'dec_layers': args.dec_layers, 'aux_loss': args.aux_loss, 'threads': args.bench_threads,
+        'window_size': args.bench_window_size, 'smooth_iters': args.bench_smooth_iters,
+    }
+
+
+def compare(args, results):
+    '''
+    :return: names of the stages slower than their threshold.
+    '''
+    baseline = {}
+    if op.exists(args.thresholds):
+        with open(args.thresholds, 'r') as f:
+            saved = json.load(f)
+        if saved['config'] != bench_config(args):
+            print(f"Warning: {args.thresholds} was recorded with {saved['config']}")
+        baseline = saved['stages']
+    else:
+        print(f"Warning: no baseline at {args.thresholds}, record one with --update_thresholds. Nothing is compared.")
+
+    regressions = []
+    print(f"{'stage':16} {'median':>10} {'max':>10} {'threshold':>10}")
+    for name in STAGES:
+        stat = results[name]
+        if name in baseline:
+            threshold = baseline[name] * (1 + args.bench_tolerance)
+            status = 'ok' if stat['median_ms'] <= threshold else 'REGRESSION'
+            threshold = f'{threshold:8.2f}ms'
+        else:
+            threshold, status = '-', 'no baseline'
+        if status == 'REGRESSION':
+            regressions.append(name)
+        print(f"{name:16} {stat['median_ms']:8.2f}ms {stat['max_ms']:8.2f}ms {threshold:>10}  {status}")
+    return regressions
+
+
+def main(args):
+    assert args.dataset_file == 'arctic', 'The benchmark runs on (synthetic) ARCTIC data.'
+    assert args.modelname == 'deformable_detr', 'The benchmark uses the Deformable DETR criterion.'
+    args.device = 'cpu'
+    args.distributed = False
+    torch.set_num_threads(args.bench_threads)
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    root, config = prepare_synthetic(args)
+    # meta data and body models are read relative to the working directory
+    os.chdir(root)
+    cfg = Config(args)
+    results = run(args, cfg, config)
+    regressions = compare(args, results)
+
+    if args.update_thresholds:
+        with open(args.thresholds, 'w') as f:
+            json.dump({
+                'config': bench_config(args),
+                'stages': {name: results[name]['median_ms'] for name in STAGES},
+            }, f, indent=2)
+        print(f"Saved the baseline to {args.thresholds}")
+    elif len(regressions) > 0:
+        print(f"Slower than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        'ARCTIC CPU benchmark',
+        parents=[get_general_args_parser(), get_benchmark_args_parser()]
+    )
+    parser = get_deformable_detr_args_parser(parser)
+
+    from arctic_tools.src.parsers.parser import construct_args
+    args = construct_args(parser)
+    main(args)
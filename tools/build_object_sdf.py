@@ -0,0 +1,71 @@
+"""
+Build the signed-distance grids of the ARCTIC object parts used by the penetration loss (--penetr_loss_coef).
+
+    python tools/build_object_sdf.py --out data/arctic_data/data/meta/object_sdf.pt
+
+Run from the repository root, the object templates are read from "./data/arctic_data/data/meta/object_vtemplates".
+For each object and part (top: 1, bottom: 2), the grid covers the part's bounding box plus a margin in canonical
+space. The sign of a grid point comes from the normal of its closest triangle, so open part meshes are supported.
+"""
+
+import sys
+sys.path = ["./arctic_tools", "."] + sys.path
+
+import argparse
+import os.path as op
+
+import numpy as np
+import torch
+import trimesh
+
+from common.object_tensors import OBJECTS, construct_obj
+
+
+def part_sdf(v, f, res, margin, chunk=65536):
+    mesh = trimesh.Trimesh(vertices=v, faces=f, process=False)
+    part_v = v[np.unique(f)]
+    bbox_min = part_v.min(axis=0) - margin
+    bbox_max = part_v.max(axis=0) + margin
+    xs, ys, zs = [np.linspace(bbox_min[i], bbox_max[i], res) for i in range(3)]
+    # (z, y, x) order as grid_sample expects
+    zz, yy, xx = np.meshgrid(zs, ys, xs, indexing="ij")
+    points = np.stack((xx, yy, zz), axis=-1).reshape(-1, 3)
+
+    sdf = np.zeros(len(points))
+    for start in range(0, len(points), chunk):
+        query = points[start : start + chunk]
+        closest, dist, tri = trimesh.proximity.closest_point(mesh, query)
+        inside = ((query - closest) * mesh.face_normals[tri]).sum(axis=1) < 0
+        sdf[start : start + chunk] = np.where(inside, -dist, dist)
+
+    return {
+        "sdf": torch.FloatTensor(sdf.reshape(res, res, res)),
+        "bbox_min": torch.FloatTensor(bbox_min),
+        "bbox_max": torch.FloatTensor(bbox_max),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Object part SDF grids")
+    parser.add_argument("--out", default="data/arctic_data/data/meta/object_sdf.pt", type=str)
+    parser.add_argument("--res", default=48, type=int, help="grid points per axis")
+    parser.add_argument("--margin", default=0.02, type=float, help="margin (m) around each part")
+    args = parser.parse_args()
+
+    out = {}
+    for name in OBJECTS:
+        obj = construct_obj(f"./data/arctic_data/data/meta/object_vtemplates/{name}")
+        v = obj.v.numpy() / 1000
+        f = obj.f.numpy()
+        # same part ids as ObjectTensors
+        parts_ids = obj.parts.numpy() + 1
+        out[name] = {}
+        for part in [1, 2]:
+            in_part = parts_ids == part
+            part_f = f[in_part[f].all(axis=1)]
+            assert len(part_f) > 0, f"{name} has no faces in part {part}"
+            out[name][part] = part_sdf(v, part_f, args.res, args.margin)
+            print(f"{name} part {part}: {len(part_f)} faces")
+
+    torch.save(out, args.out)
+    print(f"Saved to {args.out}")
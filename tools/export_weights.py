@@ -0,0 +1,35 @@
+"""
+Convert full checkpoints ({epoch}.pth) to the weights-only format used by --resume_dir.
+
+    python tools/export_weights.py --ckpt_dir exps/{name} --out_dir exps/{name}/weights
+"""
+
+import sys
+sys.path = ["."] + sys.path
+
+import os
+import argparse
+import os.path as op
+from glob import glob
+
+import torch
+
+from util.checkpoint import save_weights
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Weights-only checkpoint export')
+    parser.add_argument('--ckpt_dir', required=True, type=str)
+    parser.add_argument('--out_dir', default=None, type=str)
+    args = parser.parse_args()
+
+    out_dir = args.out_dir if args.out_dir is not None else op.join(args.ckpt_dir, 'weights')
+    os.makedirs(out_dir, exist_ok=True)
+    for ckpt_p in sorted(glob(op.join(args.ckpt_dir, '*.pth'))):
+        name = op.splitext(op.basename(ckpt_p))[0]
+        out_p = op.join(out_dir, f'{name}.weights')
+        if op.exists(out_p):
+            continue
+        checkpoint = torch.load(ckpt_p, map_location='cpu')
+        save_weights(checkpoint['model'], out_p)
+        print(f'{ckpt_p} -> {out_p}')
@@ -0,0 +1,137 @@
+"""
+Latency versus accuracy of trained models on CPU, e.g. a distilled lightweight model (--distill_teacher) and its teacher.
+
+    python tools/profile_cpu.py --dataset_file arctic --setup p1 --val_batch_size 1 \
+        --profile_ckpts weights/teacher.pth weights/mobilenet_student.pth
+
+Run from the repository root. Each checkpoint is built with the options saved in it (models/distill.py) and
+evaluated on the first "--profile_batches" batches of the validation split with "--profile_threads" threads.
+The forward pass of the model is timed alone, after "--profile_warmup" untimed batches; the metrics are
+"--eval_metrics" averaged over the frames. "--early_exit" applies to every checkpoint.
+The report is printed and saved to "{output_dir}/profile_cpu.json".
+"""
+
+import sys
+sys.path = ["./arctic_tools", "."] + sys.path
+
+import os
+import json
+import time
+import random
+import argparse
+import os.path as op
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, SequentialSampler
+
+from cfg import Config
+from util.settings import get_general_args_parser, get_deformable_detr_args_parser
+
+
+def get_profile_args_parser():
+    parser = argparse.ArgumentParser('CPU profile', add_help=False)
+    parser.add_argument('--profile_ckpts', default=[], nargs='+', type=str, help='checkpoints of main.py to compare')
+    parser.add_argument('--profile_batches', default=50, type=int)
+    parser.add_argument('--profile_warmup', default=2, type=int)
+    parser.add_argument('--profile_threads', default=4, type=int)
+    return parser
+
+
+def profile(args, cfg, path, data_loader):
+    from datasets.arctic_prefetcher import data_prefetcher as arctic_prefetcher
+    from arctic_tools.process import arctic_pre_process, prepare_data, measure_error, get_eval_fields
+    from models.distill import build_from_checkpoint
+
+    model, model_args = build_from_checkpoint(args, cfg, path, early_exit=args.early_exit)
+    fields = get_eval_fields(args)
+
+    times = []
+    metrics = {}
+    frames = 0
+    prefetcher = arctic_prefetcher(data_loader, args.device, prefetch=False)
+    samples, targets, meta_info = prefetcher.next()
+    for i in range(args.profile_warmup + args.profile_batches):
+        if samples is None:
+            break
+        targets, meta_info = arctic_pre_process(args, targets, meta_info)
+        batch_size = len(meta_info['imgname'])
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            outputs = model(samples)
+            elapsed = time.perf_counter() - start
+
+            if i >= args.profile_warmup:
+                times.append(1000 * elapsed / batch_size)
+                frames += batch_size
+                data = prepare_data(args, outputs, targets, meta_info, cfg, fields=fields)
+                for k, v in measure_error(data, args.eval_metrics).items():
+                    metrics.setdefault(k, []).append(np.asarray(v, dtype=np.float64).reshape(-1))
+        samples, targets, meta_info = prefetcher.next()
+
+    assert len(times) > 0, 'No batch is left after the warmup.'
+    times = np.array(times)
+    result = {
+        'modelname': model_args.modelname,
+        'backbone': model_args.backbone,
+        'params_m': sum(p.numel() for p in model.parameters()) / 1e6,
+        'frames': frames,
+        'ms_per_frame': float(np.median(times)),
+        'ms_per_frame_p90': float(np.percentile(times, 90)),
+        'fps': float(1000 / np.median(times)),
+    }
+    # frames where a metric is not defined are nan
+    result['metrics'] = {k: float(np.nanmean(np.concatenate(v))) for k, v in metrics.items()}
+    return result
+
+
+def main(args):
+    assert args.dataset_file == 'arctic', 'The profile uses the ARCTIC metrics.'
+    assert len(args.profile_ckpts) > 0, 'Set --profile_ckpts.'
+    args.device = 'cpu'
+    args.distributed = False
+    torch.set_num_threads(args.profile_threads)
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    from datasets import build_dataset
+    from arctic_tools.src.factory import collate_custom_fn
+
+    cfg = Config(args)
+    dataset_val = build_dataset(image_set='val', args=args)
+    data_loader = DataLoader(dataset_val, args.val_batch_size, sampler=SequentialSampler(dataset_val),
+                             drop_last=False, collate_fn=collate_custom_fn, num_workers=args.num_workers)
+
+    report = {
+        'threads': args.profile_threads,
+        'batch_size': args.val_batch_size,
+        'early_exit': args.early_exit,
+        'models': {path: profile(args, cfg, path, data_loader) for path in args.profile_ckpts},
+    }
+
+    metric_names = list(next(iter(report['models'].values()))['metrics'].keys())
+    print(f"{'checkpoint':40} {'backbone':20} {'params':>8} {'ms/frame':>9} {'p90':>8} {'fps':>7} " +
+          ' '.join(f'{k:>12}' for k in metric_names))
+    for path, res in report['models'].items():
+        print(f"{op.basename(path):40} {res['backbone']:20} {res['params_m']:7.1f}M {res['ms_per_frame']:9.1f} "
+              f"{res['ms_per_frame_p90']:8.1f} {res['fps']:7.1f} " +
+              ' '.join(f"{res['metrics'].get(k, float('nan')):12.4f}" for k in metric_names))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    out_p = op.join(args.output_dir, 'profile_cpu.json')
+    with open(out_p, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved to {out_p}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        'ARCTIC CPU profile',
+        parents=[get_general_args_parser(), get_profile_args_parser()]
+    )
+    parser = get_deformable_detr_args_parser(parser)
+
+    from arctic_tools.src.parsers.parser import construct_args
+    args = construct_args(parser)
+    main(args)
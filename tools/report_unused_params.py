@@ -0,0 +1,92 @@
+"""
+Report parameters that never receive gradients for the chosen model configuration.
+
+The report is consumed by "main.py --static_graph --unused_params_file {report}", which freezes
+these parameters up front so that DDP can run without find_unused_parameters.
+
+    python tools/report_unused_params.py --modelname dino --feature_type origin \
+        --dataset_file arctic --coco_path {data} --unused_params_file unused_dino_origin.json
+"""
+
+import os
+import sys
+sys.path = ["./arctic_tools", "."] + sys.path
+
+import json
+import argparse
+from collections import defaultdict
+
+import torch
+from torch.utils.data import DataLoader
+
+from cfg import Config
+from models import build_model
+from util.settings import (
+    get_general_args_parser, get_deformable_detr_args_parser, get_dino_arg_parser,
+    set_arctic_environments, set_dino_args
+)
+
+
+def main(args):
+    if args.modelname == 'dino':
+        set_dino_args(args)
+    cfg = Config(args)
+    device = torch.device(args.device)
+
+    from datasets import build_dataset
+    from engine import find_unused_parameters
+    from arctic_tools.src.factory import collate_custom_fn as lstm_fn
+
+    dataset_train = build_dataset(image_set='train', args=args)
+    data_loader = DataLoader(
+        dataset_train, args.batch_size, shuffle=True, drop_last=True,
+        collate_fn=lstm_fn, num_workers=args.num_workers
+    )
+
+    model, criterion = build_model(args, cfg)
+    model.to(device)
+
+    unused = find_unused_parameters(model, criterion, data_loader, device, args, args.num_probe_steps)
+    num_params = {n: p.numel() for n, p in model.named_parameters()}
+
+    # summary per top-level module
+    groups = defaultdict(int)
+    for n in unused:
+        groups[n.split('.')[0]] += num_params[n]
+    print(f"{args.modelname} / {args.feature_type} : {len(unused)} of {len(num_params)} parameter tensors are unused.")
+    for k, v in sorted(groups.items()):
+        print(f"    {k} : {v} params")
+    for n in unused:
+        print(f"  - {n}")
+
+    out_p = args.unused_params_file or f'unused_params_{args.modelname}_{args.feature_type}.json'
+    with open(out_p, 'w') as f:
+        json.dump({
+            'modelname': args.modelname,
+            'feature_type': args.feature_type,
+            'num_probe_steps': args.num_probe_steps,
+            'unused': unused,
+            'num_unused_params': sum(num_params[n] for n in unused),
+        }, f, indent=2)
+    print(f"Saved to {out_p}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Unused parameter report', parents=[get_general_args_parser()])
+    args = parser.parse_known_args()[0]
+
+    if args.modelname == 'dino':
+        parser = get_dino_arg_parser(parser)
+    elif args.modelname == 'deformable_detr':
+        parser = get_deformable_detr_args_parser(parser)
+    else:
+        raise Exception('Please be specific model names.')
+    args = parser.parse_known_args()[0]
+
+    if args.dataset_file == 'arctic':
+        from arctic_tools.src.parsers.parser import construct_args
+        args = construct_args(parser)
+    args.distributed = False
+
+    set_arctic_environments(args)
+    main(args)
@@ -0,0 +1,154 @@
+"""
+Per-frame outputs of the frozen base model, used with --base_cache to train and test SmoothNet without the backbone.
+
+The store is built once per split by engine.build_base_cache and saved to "{base_cache}/{split}.pt":
+    seqs      {"sid/seq_name/view_idx": {"frames": (T,) image indices, sorted, "params": (T, 129) float32}}
+    layout    the columns of "params", see LAYOUT
+    meta      the base checkpoint and the options the store was built with, see cache_meta
+A row holds the parameters of the queries chosen by get_arctic_item, so the rows of a window unpack to the same
+nested lists that SmoothNet gets from the base model.
+"""
+
+import os
+import os.path as op
+
+import torch
+
+# (name, size) in the order of get_arctic_item
+LAYOUT = [
+    ("root_l", 3), ("root_r", 3), ("root_o", 3),
+    ("pose_l", 48), ("pose_r", 48),
+    ("shape_l", 10), ("shape_r", 10),
+    ("obj_rot", 3), ("obj_rad", 1),
+]
+# grouping of get_arctic_item: [root_l, root_r, root_o], [pose_l, pose_r], [shape_l, shape_r], [obj_rot, obj_rad]
+GROUPS = [3, 2, 2, 2]
+SIZES = [size for _, size in LAYOUT]
+DIM = sum(SIZES)
+
+
+def _split_name(imgname):
+    sid, seq_name, view_idx, image_idx = imgname.split("/")[-4:]
+    return f"{sid}/{seq_name}/{view_idx}", int(op.splitext(image_idx)[0])
+
+
+def pack(arctic_out):
+    return torch.cat([param.float() for group in arctic_out for param in group], dim=-1)
+
+
+def unpack(params):
+    flat = list(torch.split(params, SIZES, dim=-1))
+    out = []
+    for num in GROUPS:
+        out.append(flat[:num])
+        flat = flat[num:]
+    return out
+
+
+def cache_path(args, split):
+    return op.join(args.base_cache, f"{split}.pt")
+
+
+def cache_meta(args, split):
+    """
+    Identity of the outputs: the base checkpoint (--resume) and the options that select the frames.
+    A store built with other values is stale.
+    """
+    meta = {"split": split}
+    for key in ["resume", "modelname", "backbone", "setup", "feature_type", "img_feat_version",
+                "window_size", "window_stride"]:
+        meta[key] = getattr(args, key, None)
+    if meta["resume"]:
+        meta["resume"] = op.abspath(meta["resume"])
+        stat = os.stat(meta["resume"])
+        meta["resume_mtime"] = stat.st_mtime
+        meta["resume_size"] = stat.st_size
+    return meta
+
+
+class BaseOutputCache(object):
+    def __init__(self):
+        # imgname -> row of self.params
+        self.index = {}
+        self.params = torch.zeros(0, DIM)
+        # number of frames of each sequence, whose rows are contiguous and sorted by frame
+        self.lengths = []
+        self.meta = None
+        self._rows = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, imgnames, arctic_out):
+        params = pack(arctic_out).detach().cpu()
+        assert len(imgnames) == len(params)
+        # padded windows repeat their last frame, the last write wins
+        for imgname, param in zip(imgnames, params):
+            self._rows[_split_name(imgname)] = param
+
+    def save(self, path, meta=None):
+        seqs = {}
+        for (seq, frame) in sorted(self._rows.keys()):
+            seqs.setdefault(seq, []).append(frame)
+        seqs = {
+            seq: {
+                "frames": torch.LongTensor(frames),
+                "params": torch.stack([self._rows[(seq, frame)] for frame in frames], dim=0),
+            }
+            for seq, frames in seqs.items()
+        }
+        torch.save({"layout": LAYOUT, "meta": meta, "seqs": seqs}, path)
+
+    @classmethod
+    def load(cls, path):
+        data = torch.load(path, map_location="cpu")
+        assert [tuple(item) for item in data["layout"]] == LAYOUT, f"{path} was built with another layout"
+        cache = cls()
+        cache.meta = data.get("meta")
+        params = []
+        row = 0
+        for seq, item in data["seqs"].items():
+            for frame in item["frames"].tolist():
+                cache.index[(seq, frame)] = row
+                row += 1
+            params.append(item["params"])
+            cache.lengths.append(len(item["frames"]))
+        if len(params) > 0:
+            cache.params = torch.cat(params, dim=0)
+        return cache
+
+    def get(self, imgnames, device):
+        try:
+            rows = [self.index[_split_name(imgname)] for imgname in imgnames]
+        except KeyError as e:
+            raise KeyError(f"{e.args[0]} is not in the base cache, build it again with the current split.")
+        params = self.params[torch.LongTensor(rows)].to(device, non_blocking=True)
+        return unpack(params)
+
+    def smoothed(self, smoother, device, stride=None, max_frames=8192):
+        """
+        Cache of the outputs smoothed over whole sequences by ArcticSmoother.smooth_sequences.
+        Sequences are smoothed in groups of about max_frames frames.
+        """
+        out = torch.zeros_like(self.params)
+        groups, group = [], []
+        for length in self.lengths:
+            if len(group) > 0 and sum(group) + length > max_frames:
+                groups.append(group)
+                group = []
+            group.append(length)
+        if len(group) > 0:
+            groups.append(group)
+
+        start = 0
+        for lengths in groups:
+            end = start + sum(lengths)
+            params = self.params[start:end].to(device)
+            out[start:end] = pack(smoother.smooth_sequences(unpack(params), lengths, stride)).cpu()
+            start = end
+
+        cache = BaseOutputCache()
+        cache.index = self.index
+        cache.lengths = self.lengths
+        cache.params = out
+        return cache
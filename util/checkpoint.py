@@ -0,0 +1,226 @@
+"""
+Asynchronous checkpointing used in main.py
+
+The training thread only copies the state to host memory; serialization runs in a background thread.
+Files are written to a temporary path and renamed when complete, so a crash never leaves a broken checkpoint.
+Each epoch produces
+    {output_dir}/{epoch}.pth                model, optimizer, lr_scheduler, epoch, args (for --resume)
+    {output_dir}/weights/{epoch}.weights    model weights only (for evaluation, e.g. --resume_dir {output_dir}/weights)
+
+Weights-only format:
+    {name}.weights        json index, {tensor name: dtype, shape, offset, nbytes, hash}
+    {name}.weights.bin    raw tensor bytes, memory-mapped at load time
+Tensors are read lazily, and a tensor whose hash matches the one already loaded into the model is skipped.
+"""
+
+import os
+import json
+import queue
+import hashlib
+import threading
+import os.path as op
+
+import numpy as np
+import torch
+
+import util.misc as utils
+
+
+def snapshot(obj):
+    '''
+    Copy every tensor in a (nested) state dict to host memory.
+    '''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return obj.__class__((k, snapshot(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return obj.__class__(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_weights(state_dict, path, align=64):
+    '''
+    Save a state dict in the weights-only format. The index is renamed last, so it marks a complete file.
+    '''
+    index = {}
+    offset = 0
+    blob_p = path + '.bin'
+    with open(blob_p + '.tmp', 'wb') as f:
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach().cpu().contiguous()
+            data = tensor.reshape(-1).view(torch.uint8).numpy().tobytes()
+            pad = (-offset) % align
+            f.write(b'\0' * pad)
+            offset += pad
+            f.write(data)
+            index[name] = {
+                'dtype': str(tensor.dtype).replace('torch.', ''),
+                'shape': list(tensor.shape),
+                'offset': offset,
+                'nbytes': len(data),
+                'hash': hashlib.sha1(data).hexdigest(),
+            }
+            offset += len(data)
+    os.replace(blob_p + '.tmp', blob_p)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+
+def load_weights(model, path, not_use_params=[]):
+    '''
+    Load a weights-only checkpoint into a resident model.
+    Only the tensors whose hash differs from the one loaded last time are read and copied.
+    :return: missing keys, unexpected keys, number of copied tensors.
+    '''
+    with open(path, 'r') as f:
+        index = json.load(f)
+    blob = np.memmap(path + '.bin', dtype=np.uint8, mode='r')
+
+    # hashes of the tensors currently in the model, set by the previous call
+    resident = model.__dict__.setdefault('_resident_weights', {})
+    state_dict = model.state_dict()
+    unexpected_keys = []
+    num_copied = 0
+    for name, entry in index.items():
+        if any(ig_key in name for ig_key in not_use_params):
+            print(f'ignored params : {name}')
+            continue
+        if name not in state_dict:
+            unexpected_keys.append(name)
+            continue
+        if resident.get(name) == entry['hash']:
+            continue
+
+        data = np.asarray(blob[entry['offset']:entry['offset'] + entry['nbytes']])
+        tensor = torch.from_numpy(data.copy()).view(getattr(torch, entry['dtype'])).reshape(entry['shape'])
+        with torch.no_grad():
+            state_dict[name].copy_(tensor)
+        resident[name] = entry['hash']
+        num_copied += 1
+    missing_keys = [k for k in state_dict.keys() if k not in index]
+    return missing_keys, unexpected_keys, num_copied
+
+
+def invalidate_weights(model):
+    '''
+    Forget the resident hashes, e.g. after the model was updated by other means.
+    '''
+    model.__dict__.pop('_resident_weights', None)
+
+
+class CheckpointWriter(threading.Thread):
+    '''
+    Background checkpoint writer with a retention policy.
+    :param keep_last_k: keep the last k epochs. 0 keeps all of them, unless keep_top_k is set.
+    :param keep_top_k: keep the k best epochs w.r.t "metric" (reported by "update_metric", which fails if the
+        evaluation does not produce it).
+    :param max_pending: number of snapshots waiting in host memory before "save" blocks.
+    '''
+
+    def __init__(self, output_dir, keep_last_k=0, keep_top_k=0, metric='cdev/ho', higher_is_better=False, max_pending=1):
+        super().__init__(daemon=True)
+        self.output_dir = output_dir
+        self.weights_dir = op.join(output_dir, 'weights')
+        self.keep_last_k = keep_last_k
+        self.keep_top_k = keep_top_k
+        self.metric = metric
+        self.higher_is_better = higher_is_better
+        self.enabled = utils.is_main_process()
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+
+        self.manifest_p = op.join(output_dir, 'checkpoints.json')
+        self.records = {}
+        if op.exists(self.manifest_p):
+            with open(self.manifest_p, 'r') as f:
+                self.records = {int(k): v for k, v in json.load(f).items()}
+
+        if self.enabled:
+            os.makedirs(self.weights_dir, exist_ok=True)
+            self.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                if job[0] == 'save':
+                    self._write(*job[1:])
+                else:
+                    self._score(*job[1:])
+                self._apply_retention()
+            except Exception as e:
+                self.error = e
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError('Checkpoint writer failed.') from self.error
+
+    def save(self, state, epoch):
+        if not self.enabled:
+            return
+        self._check_error()
+        state = snapshot(state)
+        self.jobs.put(('save', state, epoch))
+
+    def update_metric(self, epoch, stats):
+        if not self.enabled or self.keep_top_k <= 0:
+            return
+        if not isinstance(stats, dict) or self.metric not in stats:
+            # the epochs would never be ranked and --keep_top_k would keep all of them
+            available = sorted(stats.keys()) if isinstance(stats, dict) else []
+            raise ValueError(f'--ckpt_metric {self.metric} is not in the evaluation stats {available}.')
+        self._check_error()
+        self.jobs.put(('score', epoch, float(stats[self.metric])))
+
+    def close(self):
+        if not self.enabled or not self.is_alive():
+            return
+        self.jobs.put(None)
+        self.join()
+        self._check_error()
+
+    def _write(self, state, epoch):
+        ckpt_p = op.join(self.output_dir, f'{epoch}.pth')
+        weights_p = op.join(self.weights_dir, f'{epoch}.weights')
+        save_weights(state['model'], weights_p)
+        atomic_save(state, ckpt_p)
+        record = self.records.get(epoch, {})
+        record.update({'ckpt': ckpt_p, 'weights': weights_p})
+        self.records[epoch] = record
+
+    def _score(self, epoch, value):
+        if epoch in self.records:
+            self.records[epoch]['metric'] = value
+
+    def _apply_retention(self):
+        epochs = sorted(self.records.keys())
+        if self.keep_last_k > 0 or self.keep_top_k > 0:
+            keep = set(epochs[-self.keep_last_k:]) if self.keep_last_k > 0 else set()
+            if self.keep_top_k > 0:
+                # not evaluated yet
+                keep |= set(e for e in epochs if 'metric' not in self.records[e])
+                scored = [e for e in epochs if 'metric' in self.records[e]]
+                scored.sort(key=lambda e: self.records[e]['metric'], reverse=self.higher_is_better)
+                keep |= set(scored[:self.keep_top_k])
+            for epoch in epochs:
+                if epoch in keep:
+                    continue
+                record = self.records.pop(epoch)
+                for path in [record['ckpt'], record['weights'], record['weights'] + '.bin']:
+                    if op.exists(path):
+                        os.remove(path)
+
+        tmp_p = self.manifest_p + '.tmp'
+        with open(tmp_p, 'w') as f:
+            json.dump(self.records, f, indent=2)
+        os.replace(tmp_p, self.manifest_p)
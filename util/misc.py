@@ -194,17 +194,112 @@ def reduce_dict(input_dict, average=True):
     return reduced_dict
 
 
+class LossTracker(object):
+    """
+    Accumulate scalar loss terms on device and reduce them over all processes with a single
+    all_reduce every "sync_freq" steps. The host only reads the values in "sync",
+    which returns the window averages of every term, the number of steps they cover and
+    the number of skipped (non-finite) steps.
+    """
+
+    def __init__(self, sync_freq=20):
+        self.sync_freq = max(int(sync_freq), 1)
+        self.names = None
+        self.sums = None
+        self.counts = None
+        self.skipped = None
+        self.count = 0
+
+    def update(self, input_dict, valid=None):
+        """
+        :param valid: 0-dim bool tensor, False for a step whose update was skipped (see "guarded_step").
+            The terms of such a step are not accumulated.
+        """
+        with torch.no_grad():
+            if self.names is None:
+                # sort the keys so that they are consistent across processes, terms added later are ignored
+                self.names = sorted(input_dict.keys())
+            ref = next(iter(input_dict.values()))
+            # a term may be missing at some steps, it is averaged over the steps that have it
+            values = torch.stack([
+                input_dict[k].detach().float().reshape(()) if k in input_dict else ref.new_zeros((), dtype=torch.float)
+                for k in self.names
+            ])
+            present = torch.tensor([k in input_dict for k in self.names], device=values.device)
+            if valid is not None:
+                values = torch.where(valid, values, torch.zeros_like(values))
+                present = present & valid
+            if self.sums is None:
+                self.sums = torch.zeros_like(values)
+                self.counts = torch.zeros_like(values)
+                self.skipped = torch.zeros((), device=values.device)
+            self.sums += values
+            self.counts += present
+            if valid is not None:
+                self.skipped += ~valid
+        self.count += 1
+
+    def should_sync(self):
+        return self.count >= self.sync_freq
+
+    def sync(self):
+        if self.count == 0:
+            return None, 0, 0
+        with torch.no_grad():
+            count = self.count
+            stats = torch.cat([self.sums, self.counts, self.skipped[None]])
+            world_size = get_world_size()
+            if world_size > 1:
+                dist.all_reduce(stats)
+            stats = stats.tolist()
+        num = len(self.names)
+        sums, counts, skipped = stats[:num], stats[num:2 * num], int(stats[-1])
+        self.sums.zero_()
+        self.counts.zero_()
+        self.skipped.zero_()
+        self.count = 0
+        values = {k: v / c for k, v, c in zip(self.names, sums, counts) if c > 0}
+        return values, count, skipped
+
+
+def guarded_step(optimizer, finite):
+    """
+    optimizer.step() whose update is discarded on device when "finite" (0-dim bool tensor) is False,
+    as GradScaler skips the step on inf/NaN gradients, but without reading the flag on the host.
+    The parameters and the optimizer state on the device of "finite" are restored; host-side state
+    (e.g. the step count of non-capturable optimizers) still advances.
+    """
+    def step_tensors():
+        tensors = []
+        for group in optimizer.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                tensors.append(p)
+                tensors += [v for v in optimizer.state[p].values()
+                            if torch.is_tensor(v) and v.device == finite.device]
+        return tensors
+
+    with torch.no_grad():
+        backup = {id(t): t.clone() for t in step_tensors()}
+        optimizer.step()
+        for t in step_tensors():
+            # state created by this step starts from zeros
+            prev = backup.get(id(t))
+            t.copy_(torch.where(finite, t, prev if prev is not None else torch.zeros_like(t)))
+
+
 class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
 
-    def update(self, **kwargs):
+    def update(self, n=1, **kwargs):
         for k, v in kwargs.items():
             if isinstance(v, torch.Tensor):
                 v = v.item()
             assert isinstance(v, (float, int))
-            self.meters[k].update(v)
+            self.meters[k].update(v, n=n)
 
     def __getattr__(self, attr):
         if attr in self.meters:
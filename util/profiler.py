@@ -0,0 +1,111 @@
+"""
+Opt-in per-stage timers for the training and evaluation loops in engine.py
+
+A step is split into consecutive stages with "mark":
+    profiler.tick()                  # start of the step
+    ...                              # data loading
+    profiler.mark('data')
+    outputs = model(samples)
+    profiler.mark('forward')
+The elapsed time (and the peak device memory) since the previous mark is attributed to the named stage.
+When the profiler is disabled, every call is a no-op, so the loops are unchanged.
+"""
+
+import os
+import json
+import time
+
+import torch
+
+import util.misc as utils
+
+
+class StageProfiler(object):
+    def __init__(self, enabled=False, device=None):
+        self.enabled = enabled
+        self.cuda = enabled and device is not None and torch.device(device).type == 'cuda'
+        self.stats = {}
+        self.num_steps = 0
+        self.last = None
+
+    def _sync(self):
+        # kernels are asynchronous, so wait for them before reading the clock
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def tick(self, start=None):
+        '''
+        :param start: time.perf_counter() value at which the step started, if not now.
+        '''
+        if not self.enabled:
+            return
+        self._sync()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self.last = time.perf_counter() if start is None else start
+        self.num_steps += 1
+
+    def mark(self, name):
+        if not self.enabled or self.last is None:
+            return
+        self._sync()
+        now = time.perf_counter()
+        elapsed = now - self.last
+
+        stat = self.stats.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'peak_mem': 0})
+        stat['count'] += 1
+        stat['total'] += elapsed
+        stat['max'] = max(stat['max'], elapsed)
+        if self.cuda:
+            stat['peak_mem'] = max(stat['peak_mem'], torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+
+        # do not count the bookkeeping above
+        self.last = time.perf_counter()
+
+    def summary(self):
+        total = sum(stat['total'] for stat in self.stats.values())
+        summary = {}
+        for name, stat in self.stats.items():
+            summary[name] = {
+                'count': stat['count'],
+                'total_s': stat['total'],
+                'mean_ms': 1000 * stat['total'] / max(stat['count'], 1),
+                'max_ms': 1000 * stat['max'],
+                'ratio': stat['total'] / total if total > 0 else 0.0,
+                'peak_mem_mb': stat['peak_mem'] / 2**20,
+            }
+        return summary
+
+    def export(self, args, epoch, flag):
+        '''
+        Print the summary, and save it to "{output_dir}/profile_{flag}.json" (and wandb).
+        '''
+        if not self.enabled or not utils.is_main_process():
+            return
+        summary = self.summary()
+
+        print(f"{'='*10} profile ({flag}, epoch {epoch}, {self.num_steps} steps) {'='*10}")
+        for name, stat in sorted(summary.items(), key=lambda x: -x[1]['total_s']):
+            print(
+                f"{name:20} : {stat['mean_ms']:9.2f} ms/step  {100 * stat['ratio']:5.1f} %"
+                f"  max {stat['max_ms']:9.2f} ms  peak {stat['peak_mem_mb']:9.1f} MB"
+            )
+
+        if args.output_dir:
+            save_p = os.path.join(args.output_dir, f'profile_{flag}.json')
+            history = {}
+            if os.path.exists(save_p):
+                with open(save_p, 'r') as f:
+                    history = json.load(f)
+            history[str(epoch)] = {'num_steps': self.num_steps, 'stages': summary}
+            with open(save_p, 'w') as f:
+                json.dump(history, f, indent=2)
+
+        if args.wandb:
+            import wandb
+            log = {}
+            for name, stat in summary.items():
+                log[f'profile/{flag}/{name}_ms'] = stat['mean_ms']
+                log[f'profile/{flag}/{name}_peak_mb'] = stat['peak_mem_mb']
+            wandb.log(log, step=epoch)
@@ -1,17 +1,53 @@
+import os
 import sys
+import os.path as op
 import util.misc as utils
+from torch.utils.data import DataLoader, SequentialSampler
 
 from models import build_model
 from extract_predicts import main as submit_main
-from engine import train_smoothnet, test_smoothnet
+from engine import train_smoothnet, test_smoothnet, build_base_cache
+from util.base_cache import BaseOutputCache, cache_path, cache_meta
 from arctic_tools.common.body_models import build_mano_aa
 from arctic_tools.common.object_tensors import ObjectTensors
 from models.smoothnet import ArcticSmoother, SmoothCriterion
 from util.settings import set_training_scheduler, load_resume
 
 
+def get_base_cache(model, data_loader, args, cfg):
+    if data_loader is None:
+        return None
+    dataset = data_loader.dataset
+    # the cached outputs are of images without augmentation, so are the targets
+    dataset.aug_data = False
+
+    path = cache_path(args, dataset.split)
+    meta = cache_meta(args, dataset.split)
+    cache = BaseOutputCache.load(path) if op.exists(path) else None
+    if cache is not None and cache.meta != meta:
+        # e.g. another base checkpoint or split, the outputs are stale
+        print(f'The base cache {path} was built with {cache.meta}, rebuilding it for {meta}')
+        cache = None
+    if cache is None:
+        print(f'Building the base cache of {dataset.split} split: {path}')
+        os.makedirs(args.base_cache, exist_ok=True)
+        loader = DataLoader(dataset, args.val_batch_size, sampler=SequentialSampler(dataset),
+                            collate_fn=data_loader.collate_fn, num_workers=args.num_workers, pin_memory=True)
+        build_base_cache(model, loader, args.device, cfg, args=args).save(path, meta)
+        cache = BaseOutputCache.load(path)
+
+    print(f'Loaded the base cache of {dataset.split} split: {len(cache)} frames')
+    dataset.load_inputs = False
+    return cache
+
+
 def smoothnet_main(model, data_loader_train, data_loader_val, args, cfg):
     device = args.device
+    if args.base_cache:
+        cache_train = get_base_cache(model, data_loader_train, args, cfg)
+        cache_val = get_base_cache(model, data_loader_val, args, cfg)
+    else:
+        cache_train = cache_val = None
     smoother = ArcticSmoother(args.batch_size, args.window_size).to(device)
     WEIGHT_DICT = {
         "loss/cd":10.0,
@@ -47,14 +83,15 @@ def smoothnet_main(model, data_loader_train, data_loader_val, args, cfg):
     # for evaluation
     if args.eval:
         smoother.batch_size = args.val_batch_size
-        test_smoothnet(model, smoother, data_loader_val, device, cfg, args=args, vis=args.visualization)    
+        test_smoothnet(model, smoother, data_loader_val, device, cfg, args=args, vis=args.visualization, base_cache=cache_val)
         sys.exit(0)
 
     # for train
     else:
         for epoch in range(args.start_epoch, args.epochs):
             smoother.batch_size = args.batch_size
-            train_smoothnet(model, smoother, smoother_criterion, data_loader_train, optimizer, device, epoch, args.clip_max_norm, args=args, cfg=cfg)
+            train_smoothnet(model, smoother, smoother_criterion, data_loader_train, optimizer, device, epoch, args.clip_max_norm, args=args, cfg=cfg,
+                            base_cache=cache_train)
             if not args.onecyclelr:
                 lr_scheduler.step()
 
@@ -67,7 +104,8 @@ def smoothnet_main(model, data_loader_train, data_loader_val, args, cfg):
             }, f'{args.output_dir}/{epoch}.pth')
 
             smoother.batch_size = args.val_batch_size
-            test_smoothnet(model, smoother, data_loader_val, device, cfg, args=args, vis=args.visualization, epoch=epoch)
+            test_smoothnet(model, smoother, data_loader_val, device, cfg, args=args, vis=args.visualization, epoch=epoch,
+                           base_cache=cache_val)
 
 
 def submit_result(args, cfg):
@@ -6,7 +6,7 @@ import argparse
 import numpy as np
 import os.path as op
 from collections import OrderedDict
-from util.slconfig import DictAction, SLConfig
+from util.checkpoint import load_weights, invalidate_weights
 
 
 # general arguments
@@ -20,6 +20,10 @@ def get_general_args_parser():
     # for eval
     parser.add_argument('--eval', default=False, action='store_true')
     parser.add_argument('--visualization', default=False, action='store_true')
+    parser.add_argument('--headless', default=False, action='store_true',
+                        help='Render the visualization offline with a pool of headless renderers.')
+    parser.add_argument('--render_workers', default=2, type=int,
+                        help='Number of render processes for --headless. 0 renders on the main process.')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('--val_batch_size', default=4, type=int)
     parser.add_argument('--eval_metrics', default=["aae","mpjpe.ra","mrrpe","success_rate","cdev","mdev","acc_err_pose"], nargs='+', \
@@ -31,6 +35,10 @@ def get_general_args_parser():
                             e.g) --test_viewpoint nusar-2021_action_both_9081-c11b_9081_user_id_2021-02-12_161433/HMC_21110305_mono10bit')
     parser.add_argument('--extract', default=False, action='store_true',
                         help='Save pred_keypoints to json format.')
+    parser.add_argument('--early_exit', default=0.0, type=float,
+                        help='Stop the decoder once the parameters of the selected queries change less than this between layers. 0 runs every layer.')
+    parser.add_argument('--early_exit_compare', default=False, action='store_true',
+                        help='With --early_exit, also run the full decoder on every batch and report the change of the metrics.')
 
     # for train
     parser.add_argument('--not_use_params', default=[], nargs='+', help='The params, including this keywords, are ignored when the model imports the checkpoint.')
@@ -41,12 +49,28 @@ def get_general_args_parser():
     parser.add_argument('--not_use_lr_scheduler_ckpt', default=False, action='store_true')
     parser.add_argument('--onecyclelr', default=False, action='store_true')
     parser.add_argument('--resume_dir', default='', help='resume dir from checkpoint')
+    parser.add_argument('--eval_group_size', default=1, type=int,
+                        help='With --resume_dir, evaluate this many checkpoints per pass over the validation set.')
     parser.add_argument('--smooth_resume', default='', help='resume dir from checkpoint of smoothnet')
     parser.add_argument('--use_augm', default=False, action='store_true')
+    parser.add_argument('--static_graph', default=False, action='store_true',
+                        help='Freeze parameters that never receive gradients and run DDP with a static graph.')
+    parser.add_argument('--unused_params_file', default='', type=str,
+                        help='Report made by tools/report_unused_params.py. If empty, --static_graph probes the model on the first batches.')
+    parser.add_argument('--num_probe_steps', default=2, type=int)
+    parser.add_argument('--bucket_cap_mb', default=25, type=int, help='DDP bucket size for --static_graph.')
+    parser.add_argument('--keep_last_k', default=0, type=int, help='Keep the checkpoints of the last k epochs. 0 keeps all.')
+    parser.add_argument('--keep_top_k', default=0, type=int, help='Keep the checkpoints of the k best epochs w.r.t --ckpt_metric.')
+    parser.add_argument('--ckpt_metric', default='cdev/ho', type=str, help='Evaluation metric used by --keep_top_k.')
+    parser.add_argument('--ckpt_metric_higher', default=False, action='store_true', help='Higher --ckpt_metric is better.')
 
     # for debug
     parser.add_argument('--debug', default=False, action='store_true')
     parser.add_argument('--num_debug', default=3, type=int)
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Time each stage of the training/evaluation steps and save the summary to output_dir.')
+    parser.add_argument('--log_freq', default=20, type=int,
+                        help='Reduce and log the training losses every this many steps. 1 checks the loss at every step.')
 
     # for custom arctic
     parser.add_argument('--seq', default=None, type=str)
@@ -54,11 +78,32 @@ def get_general_args_parser():
     parser.add_argument('--feature_type', default='origin', choices=['origin', 'global_fm', 'local_fm'])
     parser.add_argument('--train_smoothnet', default=False, action='store_true')
     parser.add_argument('--iter', default=0, type=int, help='Number of iteration of frame smoothing.')
+    parser.add_argument('--base_cache', default='', type=str,
+                        help='Dir of the base model outputs for --train_smoothnet, built on the first run. Empty runs the base model on every window.')
+    parser.add_argument('--window_stride', default=0, type=int,
+                        help='Step between the windows of the temporal datasets. 0 uses window_size (no overlap).')
+    parser.add_argument('--smooth_stride', default=0, type=int,
+                        help='With --base_cache, test SmoothNet on whole sequences with windows overlapping by window_size - stride. 0 smooths the windows of the data loader.')
+    parser.add_argument('--seq_chunk_size', default=0, type=int,
+                        help='Shuffle chunks of this many consecutive frames (windows) of a sequence instead of single items. 0 disables it.')
+    parser.add_argument('--group_views', default=False, action='store_true',
+                        help='With --seq_chunk_size, chunk frames over all camera views and keep the views of a frame in the same batch.')
+    parser.add_argument('--interfield_index', default=False, action='store_true',
+                        help='Compute the hand-object distance fields of the targets with KD-trees over the object parts in canonical space instead of brute-force knn.')
+    parser.add_argument('--penetr_loss_coef', default=0.0, type=float,
+                        help='Weight of the hand-object penetration loss. 0 disables it.')
+    parser.add_argument('--object_sdf', default='data/arctic_data/data/meta/object_sdf.pt', type=str,
+                        help='Signed-distance grids of the object parts for the penetration loss (tools/build_object_sdf.py).')
+    parser.add_argument('--distill_teacher', default='', type=str,
+                        help='Checkpoint of the teacher model. If set, the outputs of the teacher supervise the trained model.')
+    parser.add_argument('--distill_coef', default=[1.0, 5.0], type=float, nargs=2,
+                        help='Weights of the distillation losses on the selected parameters and on the joints of make_output.')
 
     # for coco
     parser.add_argument('--img_size', default=(960, 540), type=tuple)
     parser.add_argument('--make_pickle', default=False, action='store_true')
     parser.add_argument('--cache_mode', default=False, action='store_true', help='whether to cache images on memory')
+    parser.add_argument('--cache_size', default=16, type=float, help='Size (GB) of the node-wide shared-memory image cache of --cache_mode.')
 
     return parser
 
@@ -88,7 +133,7 @@ def get_deformable_detr_args_parser(parser):
 
     # * Backbone
     parser.add_argument('--backbone', default='resnet50', type=str,
-                        help="Name of the convolutional backbone to use")
+                        help="Name of the convolutional backbone to use. mobilenet_v3_large and resnet18/34 are the lightweight ones for CPU.")
     parser.add_argument('--dilation', action='store_true',
                         help="If true, we replace stride with dilation in the last convolutional block (DC5)")
     parser.add_argument('--position_embedding', default='sine', type=str, choices=('sine', 'learned'),
@@ -152,6 +197,8 @@ def get_deformable_detr_args_parser(parser):
 
 
 def get_dino_arg_parser(parser):
+    from util.slconfig import DictAction
+
     parser.add_argument('--config_file', '-c', type=str, required=True)
     parser.add_argument('--options',
         nargs='+',
@@ -442,6 +489,17 @@ def set_training_scheduler(args, model, len_data_loader_train=None, general_lr=N
 
 
 def load_resume(args, model, resume, optimizer=None, lr_scheduler=None):
+    # weights-only checkpoint: no optimizer and lr_scheduler state, and only changed tensors are copied
+    if resume.endswith('.weights'):
+        missing_keys, unexpected_keys, num_copied = load_weights(model, resume, args.not_use_params)
+        for key in missing_keys:
+            print(f'missing_keys : {key}')
+        for key in unexpected_keys:
+            print(f'unexpected_keys : {key}')
+        print(f'{num_copied} tensors are updated from {resume}')
+        return model, optimizer, lr_scheduler
+
+    invalidate_weights(model)
     checkpoint = torch.load(resume, map_location='cpu')
     ckpt = checkpoint['model'].copy()
     for key in ckpt.keys():
@@ -513,16 +571,26 @@ def load_resume(args, model, resume, optimizer=None, lr_scheduler=None):
 
 
 def set_arctic_environments(args):
+    # only read by the datasets/arctic package
+    if args.dataset_file != 'arctic':
+        return
     check_dir = 'datasets/arctic/common/environments.py'
     env_dir = op.join(args.coco_path, args.dataset_file)
+    content = f"DATASET_ROOT = '{env_dir}'"
 
-    with open(check_dir, 'w') as f:
-        f.write(
-            f"DATASET_ROOT = '{env_dir}'"
-        )
+    # rewrite it only when the root changed, so concurrent launches do not race on it
+    if op.exists(check_dir):
+        with open(check_dir, 'r') as f:
+            if f.read() == content:
+                return
+    with open(check_dir + f'.{os.getpid()}', 'w') as f:
+        f.write(content)
+    os.replace(check_dir + f'.{os.getpid()}', check_dir)
 
 
 def set_dino_args(args):
+    from util.slconfig import SLConfig
+
     # load cfg file and update the args
     print("Loading config file from {}".format(args.config_file))
     time.sleep(args.rank * 0.02)
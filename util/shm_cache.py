@@ -0,0 +1,208 @@
+"""
+Node-local cache of encoded images in shared memory, used with --cache_mode
+
+Every rank and DataLoader worker on a node maps the same file in /dev/shm, so an image is read from disk once per node
+and host memory does not grow with the number of processes. Layout of the file:
+    header    magic, capacity, num_slots, head
+    slots     num_slots x (key hash, start, length), direct-mapped by the key hash
+    arena     capacity bytes, filled as a ring buffer
+"start" and "head" are positions in the stream of bytes written so far, so the arena offset is "start % capacity".
+A new image is written at "head", which overwrites (evicts) the oldest images: an entry is intact while
+head - start <= capacity. Writers are serialized with a file lock. Readers take no lock; they decode straight from the
+mapped memory and check afterwards that the entry was not evicted meanwhile, otherwise the image is read from disk.
+
+The file is named after the job (see _job_id), so a new run never reads the bytes of an older one, and it is
+removed when local rank 0 exits. Every process that maps it holds a shared flock on it; a cache with another size
+is only reset when no other process holds it.
+"""
+
+import os
+import mmap
+import atexit
+import fcntl
+import hashlib
+import tempfile
+import os.path as op
+
+import numpy as np
+
+_MAGIC = 0x43474d49
+_HEADER_SIZE = 64
+
+
+def _hash(key):
+    h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+    # 0 marks an empty slot
+    return h or 1
+
+
+def _job_id():
+    # shared by the ranks and DataLoader workers of a job on a node, distinct between jobs
+    if 'SLURM_JOB_ID' in os.environ:
+        return f"slurm{os.environ['SLURM_JOB_ID']}"
+    if 'MASTER_PORT' in os.environ:
+        return f"{os.environ.get('MASTER_ADDR', 'localhost')}_{os.environ['MASTER_PORT']}"
+    # single process: the workers are forked from it
+    return f"pid{os.getpid()}"
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class SharedImageCache(object):
+    '''
+    :param capacity: size of the arena in bytes. Every process of a node must use the same value.
+    :param avg_size: expected size of an encoded image, sets the number of slots.
+    '''
+    def __init__(self, capacity, name='detr_image_cache', avg_size=2**16):
+        shm_dir = '/dev/shm' if op.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = op.join(shm_dir, f'{name}_{os.getuid()}_{_job_id()}.cache')
+        self.capacity = int(capacity)
+        self.num_slots = max(2 * self.capacity // avg_size, 1024)
+        self.pid = None
+        if int(os.environ.get('LOCAL_RANK', 0)) == 0:
+            atexit.register(self._remove, os.getpid())
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.cache_size * 2**30)
+
+    def __getstate__(self):
+        # the mapping is opened again in each process
+        state = self.__dict__.copy()
+        for key in ['pid', 'mm', 'lock_fd', 'data_fd', 'buf', 'header', 'slots']:
+            state.pop(key, None)
+        state['pid'] = None
+        return state
+
+    def _open(self):
+        if self.pid == os.getpid():
+            return
+        # flock is shared by forked processes through the file description, so each process opens its own
+        self.lock_fd = os.open(self.path + '.lock', os.O_CREAT | os.O_RDWR, 0o666)
+        size = _HEADER_SIZE + 24 * self.num_slots + self.capacity
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o666)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            header = np.frombuffer(os.pread(fd, 32, 0).ljust(32, b'\0'), dtype=np.uint64)
+            if tuple(header[:3].tolist()) != (_MAGIC, self.capacity, self.num_slots):
+                # new cache, or one created with another size: truncating it under other mappings would crash them
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    raise RuntimeError(f'{self.path} is in use with another size, all processes of a node must use the same --cache_size.')
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                header = np.array([_MAGIC, self.capacity, self.num_slots, 0], dtype=np.uint64)
+                os.pwrite(fd, header.tobytes(), 0)
+            # held while the file is mapped
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        self.mm = mmap.mmap(fd, size)
+        self.data_fd = fd
+
+        self.buf = np.frombuffer(self.mm, dtype=np.uint8, offset=_HEADER_SIZE + 24 * self.num_slots)
+        self.header = np.frombuffer(self.mm, dtype=np.uint64, count=4)
+        self.slots = np.frombuffer(self.mm, dtype=np.uint64, count=3 * self.num_slots, offset=_HEADER_SIZE)
+        self.slots = self.slots.reshape(self.num_slots, 3)
+        self.pid = os.getpid()
+
+    def _remove(self, pid):
+        # only in the process that created the cache, not in forked workers
+        if os.getpid() != pid:
+            return
+        # the processes that still map the file keep their mapping
+        for path in [self.path, self.path + '.lock']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _intact(self, start):
+        return int(self.header[3]) - start <= self.capacity
+
+    def _lookup(self, h):
+        slot = self.slots[h % self.num_slots]
+        if int(slot[0]) != h:
+            return None, None
+        start, length = int(slot[1]), int(slot[2])
+        # the slot may have been rewritten while reading it
+        if int(slot[0]) != h or not self._intact(start):
+            return None, None
+        offset = start % self.capacity
+        return self.buf[offset:offset + length], start
+
+    def put(self, key, data):
+        '''
+        :return: False if "data" does not fit in the cache.
+        '''
+        self._open()
+        length = len(data)
+        if length == 0 or length > self.capacity // 4:
+            return False
+        h = _hash(key)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            slot = self.slots[h % self.num_slots]
+            if int(slot[0]) == h and self._intact(int(slot[1])):
+                # added by another process
+                return True
+            start = int(self.header[3])
+            if start % self.capacity + length > self.capacity:
+                # do not wrap an image around the end of the arena
+                start += self.capacity - start % self.capacity
+            # move the head first, so readers see the evicted entries as invalid before they are overwritten
+            self.header[3] = start + length
+            offset = start % self.capacity
+            self.buf[offset:offset + length] = np.frombuffer(data, dtype=np.uint8)
+            slot[0] = 0
+            slot[1] = start
+            slot[2] = length
+            slot[0] = h
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        return True
+
+    def contains(self, key):
+        self._open()
+        return self._lookup(_hash(key))[0] is not None
+
+    def load(self, path, decode):
+        '''
+        :param decode: function of a uint8 array of the encoded image. On a hit, the array is a view of the shared memory.
+        :return: decoded image of the file "path".
+        '''
+        self._open()
+        view, start = self._lookup(_hash(path))
+        if view is not None:
+            try:
+                img = decode(view)
+            except Exception:
+                img = None
+            if img is not None and self._intact(start):
+                return img
+
+        data = _read_file(path)
+        self.put(path, data)
+        return decode(np.frombuffer(data, dtype=np.uint8))
+
+    def preload(self, paths):
+        '''
+        Add the files to the cache until it is full.
+        :return: number of bytes added.
+        '''
+        self._open()
+        total = 0
+        for path in paths:
+            if total >= self.capacity:
+                break
+            if self.contains(path):
+                continue
+            data = _read_file(path)
+            if self.put(path, data):
+                total += len(data)
+        return total
@@ -1,14 +1,12 @@
 import os
-import cv2
-import wandb
 import torch
 import pickle
 import numpy as np
 import os.path as op
-from PIL import Image
 import util.misc as utils
-import matplotlib.pyplot as plt
-from pytorch3d.ops.knn import knn_points
+
+# cv2, PIL, matplotlib, wandb and pytorch3d are imported by the functions that use them,
+# so that importing this module (e.g. for the loss/score dicts) stays cheap
 
 
 def arctic_smoothing(target, count):
@@ -40,6 +38,7 @@ def create_loss_dict(loss_value, loss_out, flag='', round_value=False, mode='bas
         'loss_smooth_2d' : ['loss/smooth/2d'],
         'loss_smooth_3d' : ['loss/smooth/3d'],
         'loss_penetr' : ['loss/penetr'],
+        'loss_distill' : ['loss/distill/params', 'loss/distill/kin'],
         'loss_mano' : ['loss/mano/pose/r', 'loss/mano/beta/r', 'loss/mano/pose/l', 'loss/mano/beta/l'],
         'loss_rot' : ['loss/object/radian', 'loss/object/rot'],
         'loss_transl' : ['loss/mano/transl/l', 'loss/object/transl'],
@@ -80,6 +79,7 @@ def create_loss_dict(loss_value, loss_out, flag='', round_value=False, mode='bas
             'loss_ce', 'loss_CDev', 'loss_mano', 'loss_rot', 'loss_transl',
             # 'loss_cam', 'loss_3d_kp', 'loss_2d_kp'
             'loss_cam', 'loss_3d_kp', 'loss_2d_kp', 'loss_hand_key', 'loss_obj_key',
+            'loss_distill',
             # 'loss_smooth_2d', 'loss_smooth_3d'
         ]        
     elif mode == 'baseline':
@@ -127,6 +127,7 @@ def create_arctic_score_dict(stats):
 def test(meta_info, targets, data_loader):
     from util.tools import cam2pixel
     from PIL import Image
+    import matplotlib.pyplot as plt
     import cv2
 
     B = 60
@@ -205,46 +206,98 @@ def stat_round(round_num=2, **kwargs):
     return result
 
 
-def eval_assembly_result(outputs, targets, cfg, data_loader):
-    key_points, target_sizes = extract_assembly_output(outputs, targets, cfg)
-    gt_keypoints = [t['keypoints'] for t in targets]
-
-    if 'labels' in targets[0].keys():
-        gt_labels = [t['labels'].detach().cpu().numpy() for t in targets]
-
-    # measure
-    mpjpe_ra_list = []
-    for i, batch in enumerate(gt_labels):
-        target = targets[i]
-        img_id = target['image_id'].item()
-        joint_valid = data_loader.dataset.coco.loadAnns(img_id)[0]['joint_valid']
-        joint_valid = torch.stack([torch.tensor(joint_valid[:21]), torch.tensor(joint_valid[21:])]).type(torch.bool)
-
-        cam_fx, cam_fy, cam_cx, cam_cy, _, _ = target['cam_param']
-
-        for k, label in enumerate(batch):
-            if label == cfg.hand_idx[0]: j=0
-            else: j=1
-            
-            pred_kp = key_points[i][j]
-            pred_joint_cam = pixel2cam(pred_kp, (cam_fx.item(), cam_fy.item()), (cam_cx.item(), cam_cy.item()))
-
-            x, y = target_sizes[0].detach().cpu().numpy()
-            gt_scaled_keypoints = gt_keypoints[i][k] * torch.tensor([x, y, 1000]).cuda()
-            gt_joint_cam = pixel2cam(gt_scaled_keypoints, (cam_fx.item(), cam_fy.item()), (cam_cx.item(), cam_cy.item()))
-
-            joints3d_cam_gt_ra = gt_joint_cam - gt_joint_cam[:1, :]
-            joints3d_cam_pred_ra = pred_joint_cam - pred_joint_cam[:1, :]
-
-            mpjpe_ra = ((joints3d_cam_gt_ra - joints3d_cam_pred_ra) ** 2)[joint_valid[j]].sum(dim=-1).sqrt()
-            mpjpe_ra = mpjpe_ra.cpu().numpy()
-            mpjpe_ra_list.append(mpjpe_ra.mean())
-    return {
-        'mpjpe':float(np.array(mpjpe_ra_list).mean())
-    }
+class AssemblyEvaluator(object):
+    '''
+    Root-relative MPJPE on AssemblyHands, accumulated over the split.
+    The ground truth of every image (camera space joints, joint validity, camera intrinsics) is gathered once
+    from the annotations into dense tensors, so a batch is scored with a few tensor operations.
+    '''
+    def __init__(self, dataset, cfg, device):
+        self.hand_idx = torch.tensor(cfg.hand_idx, device=device)
+        self.device = device
+
+        # shared by every evaluation on this dataset
+        gt = dataset.__dict__.get('_assembly_gt')
+        if gt is None:
+            gt = self.load_gt(dataset.coco)
+            dataset._assembly_gt = gt
+        self.index = gt['index']
+        self.joints = gt['joints'].to(device)
+        self.valid = gt['valid'].to(device)
+        self.cam = gt['cam'].to(device)
+
+        self.sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.count = torch.zeros((), dtype=torch.float64, device=device)
+
+    @staticmethod
+    def load_gt(coco):
+        img_ids = sorted(coco.imgs.keys())
+        joints = np.zeros((len(img_ids), 2, 21, 3), dtype=np.float32)
+        valid = np.zeros((len(img_ids), 2, 21), dtype=bool)
+        cam = np.zeros((len(img_ids), 4), dtype=np.float32)
+        for row, img_id in enumerate(img_ids):
+            anns = coco.imgToAnns[img_id]
+            if len(anns) == 0:
+                continue
+            ann = anns[0]
+            joints[row] = np.array([ann['joint3d']['right'], ann['joint3d']['left']], dtype=np.float32).reshape(2, 21, 3)
+            valid[row] = np.array(ann['joint_valid'], dtype=bool).reshape(2, 21)
+            cam[row] = sum(list(ann['cam_param'].values()), [])[:4]
+
+        # root-relative camera coordinates
+        joints = joints - joints[:, :, :1]
+        return {
+            'index': {img_id: row for row, img_id in enumerate(img_ids)},
+            'joints': torch.from_numpy(joints),
+            'valid': torch.from_numpy(valid),
+            'cam': torch.from_numpy(cam),
+        }
+
+    def update(self, outputs, targets, cfg):
+        '''
+        :return: MPJPE of this batch.
+        '''
+        key_points, _ = extract_assembly_output(outputs, targets, cfg)
+        img_ids = torch.cat([t['image_id'].view(-1) for t in targets]).tolist()
+        rows = torch.tensor([self.index[img_id] for img_id in img_ids], device=self.device)
+
+        # hands annotated in each image, (B, 2)
+        present = torch.stack([(t['labels'][:, None] == self.hand_idx).any(dim=0) for t in targets])
+        valid = self.valid[rows] & present[..., None]
+
+        fx, fy, cx, cy = self.cam[rows].T[..., None, None]
+        pred_joint_cam = pixel2cam(key_points, (fx, fy), (cx, cy))
+        pred_joint_cam_ra = pred_joint_cam - pred_joint_cam[:, :, :1]
+
+        err = ((self.joints[rows] - pred_joint_cam_ra) ** 2).sum(dim=-1).sqrt()
+        num_valid = valid.sum(dim=-1)
+        hand_err = (err * valid).sum(dim=-1) / num_valid.clamp(min=1)
+        has_valid = num_valid > 0
+
+        batch_sum = hand_err[has_valid].sum()
+        batch_count = has_valid.sum()
+        self.sum += batch_sum
+        self.count += batch_count
+        return {
+            'mpjpe': float(batch_sum / batch_count.clamp(min=1))
+        }
+
+    def synchronize_between_processes(self):
+        if not utils.is_dist_avail_and_initialized():
+            return
+        torch.distributed.barrier()
+        torch.distributed.all_reduce(self.sum)
+        torch.distributed.all_reduce(self.count)
+
+    def summarize(self):
+        return {
+            'mpjpe': float(self.sum / self.count.clamp(min=1))
+        }
 
 
 def visualize_assembly_result(args, cfg, outputs, targets, data_loader, ):
+    from PIL import Image
+    import matplotlib.pyplot as plt
     filename = data_loader.dataset.coco.loadImgs(targets[0]['image_id'][0].item())[0]['file_name']
     filepath = data_loader.dataset.root / filename
     source_img = np.array(Image.open(filepath))
@@ -270,7 +323,7 @@ def visualize_assembly_result(args, cfg, outputs, targets, data_loader, ):
     orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
     im_h, im_w = orig_target_sizes[:,0], orig_target_sizes[:,1]
     target_sizes = torch.cat([im_w.unsqueeze(-1), im_h.unsqueeze(-1)], dim=-1)
-    target_sizes =target_sizes.cuda()
+    target_sizes = target_sizes.to(pred_keypoints.device)
 
     hand_kp[...,:2] *=  target_sizes.unsqueeze(1).unsqueeze(1); hand_kp[...,2] *= 1000
 
@@ -293,6 +346,7 @@ def visualize_assembly_result(args, cfg, outputs, targets, data_loader, ):
 
 
 def make_line(cv_img, img_points, idx_1, idx_2, color, line_thickness=2):
+    import cv2
     if -1 not in tuple(img_points[idx_1][:-1]):
         if -1 not in tuple(img_points[idx_2][:-1]):
             cv2.line(cv_img, tuple(img_points[idx_1][:-1]), tuple(
@@ -336,6 +390,7 @@ def visualize(cv_img, img_points, mode='left'):
 
 
 def visualize_obj(cv_img, img_points):
+    import cv2
     cv2.line(cv_img, tuple(img_points[1][:-1]), tuple(
         img_points[2][:-1]), (0, 255, 0), 5)
     cv2.line(cv_img, tuple(img_points[2][:-1]), tuple(
@@ -372,6 +427,7 @@ def get_NN(src_xyz, trg_xyz, k=1):
     :param trg_xyz: [B, N2, 3]
     :return: nn_dists, nn_dix: all [B, 3000] tensor for NN distance and index in N2
     '''
+    from pytorch3d.ops.knn import knn_points
     B = src_xyz.size(0)
     src_lengths = torch.full(
         (src_xyz.shape[0],), src_xyz.shape[1], dtype=torch.int64, device=src_xyz.device
@@ -424,6 +480,8 @@ def rigid_transform_3D_numpy(A, B):
 
 
 def vis(data_loader, targets, FPHA=False):
+    from PIL import Image
+    import cv2
     filename = data_loader.dataset.coco.loadImgs(targets[0]['image_id'][0].item())[0]['file_name']
     if FPHA:
         filepath = data_loader.dataset.root / 'Video_files'/ filename
@@ -518,7 +576,7 @@ def extract_assembly_output(outputs, targets, cfg):
     orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
     im_h, im_w = orig_target_sizes[:,0], orig_target_sizes[:,1]
     target_sizes = torch.cat([im_w.unsqueeze(-1), im_h.unsqueeze(-1)], dim=-1)
-    target_sizes =target_sizes.cuda()
+    target_sizes = target_sizes.to(pred_keypoints.device)
 
     hand_kp[...,:2] *=  target_sizes.unsqueeze(1).unsqueeze(1); hand_kp[...,2] *= 1000
     return hand_kp, target_sizes
@@ -629,6 +687,7 @@ def save_results(args, epoch, result, stats, flag):
                 f.write('\n\n')
 
         if args.wandb:
+            import wandb
             wandb.log(result, step=epoch)    
 
 
@@ -819,7 +878,7 @@ def extract_epoch(file_path):
 #                 orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
 #                 im_h, im_w = orig_target_sizes[:,0], orig_target_sizes[:,1]
 #                 target_sizes = torch.cat([im_w.unsqueeze(-1), im_h.unsqueeze(-1)], dim=-1)
-#                 target_sizes =target_sizes.cuda()
+#                 target_sizes = target_sizes.to(pred_keypoints.device)
 
 #                 labels = torch.gather(out_logits, 1, keep.unsqueeze(2).repeat(1,1,num_classes)).softmax(dim=-1)
 #                 hand_kp[...,:2] *=  target_sizes.unsqueeze(1).unsqueeze(1); hand_kp[...,2] *= 1000